@@ -1,72 +1,653 @@
+import asyncio
 import json
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
 
-from fastapi import FastAPI
-from baml_py import ClientRegistry, Collector
+import httpx
+
+from fastapi import Body, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from baml_py import Collector
 from dotenv import load_dotenv
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from baml_client.async_client import b
 
-from app.services.categorize_query import categorize_query, categorize_with_confidence
-from app.services.generate_form import fill_form, stream_fill_form
-from app.schemas import ClassificationInput, ExtractionInput
-from typing import Any
+from app.services.chunked_extraction import extract_chunked, stream_extract_chunked
+from app.services.categorize_query import (
+    categorize_batch,
+    categorize_query,
+    categorize_with_confidence,
+    categorize_with_taxonomy,
+    stream_categorize_with_confidence,
+)
+from app.services.extraction_sessions import build_extraction_sessions_from_env
+from app.services.job_queue import JobQueue, build_job_queue_from_env, missing_themes, read_jsonl
+from app.services.hierarchical import categorize_hierarchical
+from app.services.generate_form import PARTITION_CACHE, SCHEMA_CACHE, fill_form, schema_key, stream_fill_form, stream_fill_form_delta
+from app.services.admission import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_DEFAULT,
+    PRIORITY_INTERACTIVE,
+    build_admission_controller_from_env,
+)
+from app.services.client_pool import PROFILES, ClientPool
+from app.services.hedging import HedgedBamlClient, build_hedge_policy_from_env
+from app.services.local_classifier import LocalClassifier
+from app.services.metrics import build_baml_metrics, record_collector, render_gauges
+from app.services.router import NoBackendAvailable, Router, RoutedBamlClient, load_backends_from_env
+from app.services.schema_registry import InvalidSchema, SchemaRegistry
+from app.services.taxonomy_registry import TaxonomyRegistry
+from app.services.result_cache import build_result_cache_from_env, cache_key
+from app.services.single_flight import SingleFlight
+from app.schemas import (
+    BatchClassificationInput,
+    ClassificationInput,
+    ExtractionInput,
+    HierarchicalClassificationInput,
+    JobInput,
+    TaxonomyClassificationInput,
+    TaxonomyInput,
+)
+from typing import Any, Literal
 
 
 load_dotenv()
 
 with open("app/data/completion_format.json", "r") as f:
     COMPLETION_FORM = json.load(f)
+COMPLETION_FORM_KEY = schema_key(COMPLETION_FORM)
+SCHEMA_REGISTRY = SchemaRegistry(os.getenv("SCHEMA_REGISTRY_DIR"))
+SCHEMA_REGISTRY.register(COMPLETION_FORM, schema_id="completion_format", persist=False)
+TAXONOMY_REGISTRY = TaxonomyRegistry(os.getenv("TAXONOMY_REGISTRY_DIR"))
+# Forms with more leaf fields than this are filled as concurrent sub-forms (0: never).
+EXTRACT_PARTITION_SIZE = int(os.getenv("EXTRACT_PARTITION_SIZE", "0")) or None
+# Conversations longer than this many characters are extracted chunk by chunk (0: never).
+EXTRACT_CHUNK_CHARS = int(os.getenv("EXTRACT_CHUNK_CHARS", "0"))
+EXTRACT_CHUNK_OVERLAP = int(os.getenv("EXTRACT_CHUNK_OVERLAP", "1"))
+
+RESULT_CACHE = build_result_cache_from_env()
+LOCAL_CLASSIFIER = LocalClassifier.load(os.environ["LOCAL_CLASSIFIER_PATH"]) if os.getenv("LOCAL_CLASSIFIER_PATH") else None
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.9"))
+SINGLE_FLIGHT = SingleFlight()
+EXTRACT_SESSIONS = build_extraction_sessions_from_env()
+ADMISSION = build_admission_controller_from_env()
+BAML_INSTRUMENTATION = os.getenv("BAML_INSTRUMENTATION", "").lower() in ("1", "true", "yes")
+METRICS = build_baml_metrics()
+HEDGE_POLICY = build_hedge_policy_from_env()
+HEDGE_SECONDARY_CLIENT = os.getenv("HEDGE_SECONDARY_CLIENT")
+PROVIDER_BACKENDS = load_backends_from_env()
+ROUTER = Router([backend["name"] for backend in PROVIDER_BACKENDS]) if PROVIDER_BACKENDS else None
+# Directory bulk jobs may read input files from (unset: jobs only take inline JSONL).
+JOB_INPUT_DIR = os.getenv("JOB_INPUT_DIR")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_client_pool()
+    job_queue = get_job_queue()
+    job_queue.start()
+    yield
+    await job_queue.stop()
+    if getattr(app.state, "http_client", None) is not None:
+        await app.state.http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(NoBackendAvailable)
+async def no_backend_available(request: Request, exc: NoBackendAvailable) -> JSONResponse:
+    '''Every backend circuit breaker is open: the service is unavailable, not failing.'''
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
+def get_client_pool() -> ClientPool:
+    '''Returns the shared client pool, building it on first use if the lifespan did not run.'''
+    if getattr(app.state, "client_pool", None) is None:
+        profiles = dict(PROFILES)
+        if HEDGE_SECONDARY_CLIENT:
+            profiles["hedge"] = HEDGE_SECONDARY_CLIENT
+        app.state.client_pool = ClientPool(b, profiles, backends=PROVIDER_BACKENDS)
+    return app.state.client_pool
+
+
+def get_http_client() -> httpx.AsyncClient:
+    '''Returns the HTTP client of the raw provider requests, shared for the app's lifetime.'''
+    if getattr(app.state, "http_client", None) is None:
+        app.state.http_client = httpx.AsyncClient(timeout=60)
+    return app.state.http_client
+
+
+def get_job_queue() -> JobQueue:
+    '''Returns the bulk job queue, opening its SQLite file on first use.'''
+    if getattr(app.state, "job_queue", None) is None:
+        app.state.job_queue = build_job_queue_from_env(
+            lambda kind: baml_client(f"jobs-{kind}", "default", PRIORITY_BACKGROUND), schema_cache=SCHEMA_REGISTRY
+        )
+    return app.state.job_queue
+
+
+def job_queue_stats() -> dict[str, int]:
+    job_queue = getattr(app.state, "job_queue", None)
+    return job_queue.stats() if job_queue is not None else {}
+
+
+def pooled_client(profile: str, priority: int, collector: Collector | None = None):
+    '''
+    Returns the pooled client handle of `profile` behind the admission controller, or, when
+    PROVIDER_BACKENDS is configured, a client routing each call to one of the backends.
+    '''
+    pool = get_client_pool()
+    backends = pool.get_backends(profile, collector=collector)
+    if ROUTER is not None and backends:
+        return RoutedBamlClient(ROUTER, {
+            name: ADMISSION.wrap(handle, name, priority) for name, handle in backends.items()
+        })
+    return ADMISSION.wrap(pool.get(profile, collector=collector), pool.client_names[profile], priority)
+
+
+def raw_call_admission(profile: str, priority: int):
+    '''
+    Returns the context of a raw HTTP request (see sample_feedbacks_single_request). It
+    yields the `profile` handle to render the request from and holds an admission slot of
+    its client; with routing, the backend is picked by ROUTER and the outcome is reported to
+    it.
+    '''
+    pool = get_client_pool()
+    backends = pool.get_backends(profile) if ROUTER is not None else {}
+
+    @asynccontextmanager
+    async def admit():
+        if backends:
+            name = ROUTER.choose()
+            if name is None:
+                raise NoBackendAvailable("Every backend circuit breaker is open")
+            handle = backends[name]
+        else:
+            name, handle = pool.client_names[profile], pool.get(profile)
+        start = time.perf_counter()
+        async with ADMISSION.admit(name, priority):
+            try:
+                yield handle
+            except Exception:
+                if backends:
+                    ROUTER.record(name, time.perf_counter() - start, ok=False)
+                raise
+        if backends:
+            ROUTER.record(name, time.perf_counter() - start, ok=True)
+    return admit
+
+
+@contextmanager
+def baml_client(endpoint: str, profile: str, priority: int, hedge: bool = False):
+    '''
+    Yields a pooled client handle. When BAML_INSTRUMENTATION is enabled, a Collector is
+    attached and harvested into the metrics once the block exits.
+
+    With `hedge`, slow calls are duplicated according to HEDGE_POLICY, on the
+    HEDGE_SECONDARY_CLIENT if one is configured.
+    '''
+    collector = Collector(name=endpoint) if BAML_INSTRUMENTATION else None
+    try:
+        client = pooled_client(profile, priority, collector)
+        if hedge:
+            secondary = pooled_client("hedge", priority, collector) if HEDGE_SECONDARY_CLIENT else None
+            client = HedgedBamlClient(client, HEDGE_POLICY, secondary)
+        yield client
+    finally:
+        if collector is not None:
+            record_collector(METRICS, collector, endpoint)
+
 
-app = FastAPI()
+async def harvest_when_done(stream, collector: Collector, endpoint: str):
+    '''Forwards a streamed response and harvests its Collector once the stream ends.'''
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        record_collector(METRICS, collector, endpoint)
+
+
+@app.get("/stats/")
+async def get_stats() -> dict[str, Any]:
+    '''Returns the schema cache and result cache counters.'''
+    return {
+        "schema_cache": SCHEMA_CACHE.stats(),
+        "schema_registry": SCHEMA_REGISTRY.stats(),
+        "partition_cache": PARTITION_CACHE.stats(),
+        "taxonomy_registry": TAXONOMY_REGISTRY.stats(),
+        "result_cache": RESULT_CACHE.stats(),
+        "single_flight": SINGLE_FLIGHT.stats(),
+        "admission": ADMISSION.stats(),
+        "hedging": HEDGE_POLICY.stats(),
+        "routing": ROUTER.snapshot() if ROUTER else {},
+        "extract_sessions": EXTRACT_SESSIONS.stats(),
+        "jobs": job_queue_stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    '''Exports the token, latency, cache and admission metrics in the Prometheus text format.'''
+    return (
+        METRICS.render()
+        + render_gauges("schema_cache", SCHEMA_CACHE.stats())
+        + render_gauges("schema_registry", SCHEMA_REGISTRY.stats())
+        + render_gauges("partition_cache", PARTITION_CACHE.stats())
+        + render_gauges("taxonomy_registry", TAXONOMY_REGISTRY.stats())
+        + render_gauges("result_cache", RESULT_CACHE.stats(), label="endpoint")
+        + render_gauges("single_flight", SINGLE_FLIGHT.stats())
+        + render_gauges("admission", ADMISSION.stats(), label="client")
+        + render_gauges("hedging", HEDGE_POLICY.stats())
+        + render_gauges("routing", ROUTER.snapshot() if ROUTER else {}, label="backend")
+        + render_gauges("extract_sessions", EXTRACT_SESSIONS.stats())
+        + render_gauges("jobs", job_queue_stats())
+    )
 
 
 @app.post("/categorize/")
-async def categorize_informations(data: ClassificationInput) -> dict[str, Any]:
+async def categorize_informations(
+    data: ClassificationInput,
+    response: Response,
+    shortlist_k: int | None = Query(default=None, ge=1),
+    hedge: bool = False,
+    cache_control: str | None = Header(default=None),
+) -> dict[str, Any]:
     '''Categorizes a query into one of the predefined categories.'''
-    collector = Collector(name="my-collector")
-    client_registry = ClientRegistry()
-    my_b = b.with_options(collector=collector, client_registry=client_registry)
+    async def compute():
+        with baml_client("categorize", "default", PRIORITY_INTERACTIVE, hedge=hedge) as my_b:
+            return jsonable_encoder(await categorize_query(
+                data, my_b, shortlist_k=shortlist_k,
+                local_model=LOCAL_CLASSIFIER, local_threshold=LOCAL_CLASSIFIER_THRESHOLD,
+            ))
+
+    context = [theme.model_dump() for theme in data.themes]
+    if shortlist_k is not None:
+        context = [context, shortlist_k]
+    key = cache_key("categorize", data.text, context)
+    res, status = await RESULT_CACHE.get_or_compute(
+        "categorize", key, lambda: SINGLE_FLIGHT.do(key, compute), cache_control
+    )
+    response.headers["X-Cache"] = status
+
+    return res
+
+@app.post("/categorize/batch")
+async def categorize_informations_batch(
+    data: BatchClassificationInput,
+    batch_size: int = Query(default=10, ge=1),
+    max_concurrency: int = Query(default=4, ge=1),
+) -> dict[str, Any]:
+    '''Categorizes many queries sharing the same themes, several queries per LLM call.'''
+    with baml_client("categorize-batch", "default", PRIORITY_BACKGROUND) as my_b:
+        res = await categorize_batch(data, my_b, batch_size=batch_size, max_concurrency=max_concurrency)
+
+    return {"results": res}
+
+@app.post("/taxonomies/")
+async def register_taxonomy(data: TaxonomyInput) -> dict[str, Any]:
+    """Registers a theme list once and returns its id for /categorize/{taxonomy_id}."""
+    try:
+        taxonomy = TAXONOMY_REGISTRY.register(data.themes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return TAXONOMY_REGISTRY.describe(taxonomy)
+
+@app.get("/taxonomies/")
+async def list_taxonomies() -> dict[str, Any]:
+    """Lists the registered taxonomies."""
+    return {"taxonomies": TAXONOMY_REGISTRY.list()}
 
-    res =  await categorize_query(data, my_b)
+@app.delete("/taxonomies/{taxonomy_id}")
+async def delete_taxonomy(taxonomy_id: str) -> dict[str, Any]:
+    """Unregisters a taxonomy."""
+    if not TAXONOMY_REGISTRY.delete(taxonomy_id):
+        raise HTTPException(status_code=404, detail=f"Unknown taxonomy {taxonomy_id}")
+
+    return {"taxonomy_id": taxonomy_id, "deleted": True}
+
+@app.post("/categorize/{taxonomy_id}")
+async def categorize_with_registered_taxonomy(
+    taxonomy_id: str,
+    data: TaxonomyClassificationInput,
+    response: Response,
+    cache_control: str | None = Header(default=None),
+) -> dict[str, Any]:
+    """Categorizes a query into one of the themes of the registered taxonomy `taxonomy_id`."""
+    taxonomy = TAXONOMY_REGISTRY.get(taxonomy_id)
+    if taxonomy is None:
+        raise HTTPException(status_code=404, detail=f"Unknown taxonomy {taxonomy_id}")
+
+    async def compute():
+        with baml_client("categorize", "default", PRIORITY_INTERACTIVE) as my_b:
+            return await categorize_with_taxonomy(data.text, taxonomy, my_b)
+
+    key = cache_key("categorize", data.text, taxonomy.key)
+    res, status = await RESULT_CACHE.get_or_compute(
+        "categorize", key, lambda: SINGLE_FLIGHT.do(key, compute), cache_control
+    )
+    response.headers["X-Cache"] = status
+
+    return res
+
+@app.post("/categorize-hierarchical/")
+async def categorize_informations_hierarchical(
+    data: HierarchicalClassificationInput,
+    response: Response,
+    n: int | None = Query(default=None, ge=1),
+    adaptive: bool = False,
+    stop_confidence: float | None = None,
+    cache_control: str | None = Header(default=None),
+) -> dict[str, Any]:
+    '''Categorizes a query into a tree of themes, one short prompt per level.'''
+    if n is not None:
+        with baml_client("categorize-hierarchical", "sampling", PRIORITY_BACKGROUND) as my_b:
+            return await categorize_hierarchical(data, my_b, n=n, adaptive=adaptive, stop_confidence=stop_confidence)
+
+    async def compute():
+        with baml_client("categorize-hierarchical", "default", PRIORITY_INTERACTIVE) as my_b:
+            return await categorize_hierarchical(data, my_b)
+
+    key = cache_key("categorize-hierarchical", data.text, [theme.model_dump() for theme in data.themes])
+    res, status = await RESULT_CACHE.get_or_compute(
+        "categorize", key, lambda: SINGLE_FLIGHT.do(key, compute), cache_control
+    )
+    response.headers["X-Cache"] = status
 
     return res
 
 @app.post("/categorize-score/")
-async def categorize_informations_with_confidence(data: ClassificationInput, n: int = 10) -> dict[str, Any]:
+async def categorize_informations_with_confidence(
+    data: ClassificationInput,
+    n: int = Query(default=10, ge=1),
+    adaptive: bool = False,
+    wave_size: int = Query(default=3, ge=1),
+    stop_confidence: float | None = None,
+    single_request: bool = False,
+) -> dict[str, Any]:
     '''Categorizes a query into one of the predefined categories with confidence scores.'''
-    collector = Collector(name="my-collector")
-    client_registry = ClientRegistry()
-    client_registry.set_primary("CustomGenericProviderTemp")
-    my_b = b.with_options(collector=collector, client_registry=client_registry)
-
-    res =  await categorize_with_confidence(data, my_b, n)
+    with baml_client("categorize-score", "sampling", PRIORITY_BACKGROUND) as my_b:
+        res =  await categorize_with_confidence(
+            data, my_b, n, adaptive=adaptive, wave_size=wave_size, stop_confidence=stop_confidence,
+            single_request=single_request, http_client=get_http_client(),
+            admit=raw_call_admission("sampling", PRIORITY_BACKGROUND),
+        )
 
     return res
 
 
 
+@app.post("/stream-categorize-score/")
+async def stream_categorize_informations_with_confidence(
+    data: ClassificationInput,
+    n: int = Query(default=10, ge=1),
+    adaptive: bool = False,
+    stop_confidence: float | None = None,
+    format: Literal["ndjson", "sse"] = "ndjson",
+) -> StreamingResponse:
+    """
+    Streams /categorize-score/: after each sample, the running vote counts and the current
+    leader, then a final message (`"final": true`). Outstanding samples are cancelled as soon
+    as the client disconnects.
+    """
+    collector = Collector(name="stream-categorize-score") if BAML_INSTRUMENTATION else None
+    my_b = pooled_client("sampling", PRIORITY_BACKGROUND, collector)
+
+    async def messages():
+        async for message in stream_categorize_with_confidence(
+            data, my_b, n, adaptive=adaptive, stop_confidence=stop_confidence
+        ):
+            line = json.dumps(message, ensure_ascii=False)
+            yield f"data: {line}\n\n" if format == "sse" else line + "\n"
+
+    stream = messages()
+    if collector is not None:
+        stream = harvest_when_done(stream, collector, "stream-categorize-score")
+    return StreamingResponse(stream, media_type="text/event-stream" if format == "sse" else "application/x-ndjson")
+
+
+async def run_extraction(
+    text: str,
+    json_schema: dict[str, Any],
+    json_schema_key: str,
+    response: Response,
+    hedge: bool,
+    cache_control: str | None,
+) -> dict[str, Any]:
+    async def compute():
+        with baml_client("extract", "default", PRIORITY_DEFAULT, hedge=hedge) as my_b:
+            if EXTRACT_CHUNK_CHARS and len(text) > EXTRACT_CHUNK_CHARS:
+                return jsonable_encoder(await extract_chunked(
+                    text, json_schema, my_b, max_chars=EXTRACT_CHUNK_CHARS, overlap=EXTRACT_CHUNK_OVERLAP,
+                    schema_cache=SCHEMA_REGISTRY,
+                ))
+            return jsonable_encoder(await fill_form(
+                text, json_schema, my_b, schema_cache=SCHEMA_REGISTRY, partition_size=EXTRACT_PARTITION_SIZE,
+                json_schema_key=json_schema_key,
+            ))
+
+    key = cache_key("extract", text, json_schema_key)
+    res, status = await RESULT_CACHE.get_or_compute(
+        "extract", key, lambda: SINGLE_FLIGHT.do(key, compute), cache_control
+    )
+    response.headers["X-Cache"] = status
+
+    return res
+
+def registered_schema(schema_id: str) -> dict[str, Any]:
+    json_schema = SCHEMA_REGISTRY.schema(schema_id)
+    if json_schema is None:
+        raise HTTPException(status_code=404, detail=f"Unknown schema {schema_id}")
+    return json_schema
+
 @app.post("/extract/")
-async def extract_informations(request: ExtractionInput) -> dict[str, Any]:
+async def extract_informations(
+    request: ExtractionInput,
+    response: Response,
+    hedge: bool = False,
+    cache_control: str | None = Header(default=None),
+) -> dict[str, Any]:
     """
     Extracts information from a user conversation and fills a form based on a predefined schema.
     """
-    collector = Collector(name="my-collector")
-    client_registry = ClientRegistry()
+    return await run_extraction(request.text, COMPLETION_FORM, COMPLETION_FORM_KEY, response, hedge, cache_control)
 
-    my_b = b.with_options(collector=collector, client_registry=client_registry)
+@app.post("/schemas/")
+async def register_schema(json_schema: dict[str, Any] = Body(...)) -> dict[str, Any]:
+    """
+    Registers a form JSON schema, validated and compiled once, and returns its id for
+    /extract/{schema_id} and /stream-extract/{schema_id}.
+    """
+    try:
+        schema_id = SCHEMA_REGISTRY.register(json_schema)
+    except InvalidSchema as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    res = await fill_form(request.text, COMPLETION_FORM, my_b)
-    
-    return res
+    return SCHEMA_REGISTRY.describe(schema_id)
+
+@app.get("/schemas/")
+async def list_schemas() -> dict[str, Any]:
+    """Lists the registered form schemas."""
+    return {"schemas": SCHEMA_REGISTRY.list()}
+
+@app.get("/schemas/{schema_id}")
+async def get_schema(schema_id: str) -> dict[str, Any]:
+    """Returns a registered form schema."""
+    return registered_schema(schema_id)
+
+@app.delete("/schemas/{schema_id}")
+async def delete_schema(schema_id: str) -> dict[str, Any]:
+    """Unregisters a form schema."""
+    if not SCHEMA_REGISTRY.delete(schema_id):
+        raise HTTPException(status_code=404, detail=f"Unknown schema {schema_id}")
+
+    return {"schema_id": schema_id, "deleted": True}
+
+def session_response(session_id: str, state: dict[str, Any]) -> dict[str, Any]:
+    return {"session_id": session_id, "offset": state["offset"], "data": jsonable_encoder(state["data"])}
+
+@app.post("/extract/sessions/{session_id}")
+async def update_extraction_session(session_id: str, request: ExtractionInput) -> dict[str, Any]:
+    """
+    Updates the form of a live conversation. `text` is the whole transcript so far: only the
+    part after the last processed offset is sent to the model, with the current form.
+    """
+    with baml_client("extract-session", "default", PRIORITY_INTERACTIVE) as my_b:
+        state = await EXTRACT_SESSIONS.update(session_id, request.text, COMPLETION_FORM, my_b)
+
+    return session_response(session_id, state)
+
+@app.get("/extract/sessions/{session_id}")
+async def get_extraction_session(session_id: str) -> dict[str, Any]:
+    """Returns the current form of a live conversation."""
+    state = await EXTRACT_SESSIONS.get(session_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+
+    return session_response(session_id, state)
+
+@app.delete("/extract/sessions/{session_id}")
+async def delete_extraction_session(session_id: str) -> dict[str, Any]:
+    """Forgets a live conversation."""
+    await EXTRACT_SESSIONS.delete(session_id)
+
+    return {"session_id": session_id, "deleted": True}
+
+def stream_extraction(text: str, json_schema: dict[str, Any], mode: str) -> StreamingResponse:
+    collector = Collector(name="stream-extract") if BAML_INSTRUMENTATION else None
+    my_b = pooled_client("default", PRIORITY_DEFAULT, collector)
+
+    if EXTRACT_CHUNK_CHARS and len(text) > EXTRACT_CHUNK_CHARS:
+        stream = stream_extract_chunked(
+            text, json_schema, my_b, max_chars=EXTRACT_CHUNK_CHARS, overlap=EXTRACT_CHUNK_OVERLAP,
+            delta=mode == "delta", schema_cache=SCHEMA_REGISTRY,
+        )
+    elif mode == "delta":
+        stream = stream_fill_form_delta(text, json_schema, my_b, schema_cache=SCHEMA_REGISTRY)
+    else:
+        stream = stream_fill_form(text, json_schema, my_b, schema_cache=SCHEMA_REGISTRY)
+    if collector is not None:
+        stream = harvest_when_done(stream, collector, "stream-extract")
+    return StreamingResponse(stream, media_type="text/event-stream")
 
 @app.post("/stream-extract/")
-async def stream_extract_informations(request: ExtractionInput) -> dict[str, Any]:
+async def stream_extract_informations(request: ExtractionInput, mode: Literal["snapshot", "delta"] = "snapshot") -> dict[str, Any]:
     """
     Streams information extraction from a user conversation and fills a form based on a predefined schema.
+
+    In "delta" mode each line is a JSON patch against the previous one, followed by a final full snapshot.
+    Long conversations (see EXTRACT_CHUNK_CHARS) stream the merged form each time a chunk is done.
+    """
+    return stream_extraction(request.text, COMPLETION_FORM, mode)
+
+@app.post("/extract/{schema_id}")
+async def extract_with_schema(
+    schema_id: str,
+    request: ExtractionInput,
+    response: Response,
+    hedge: bool = False,
+    cache_control: str | None = Header(default=None),
+) -> dict[str, Any]:
+    """Fills the registered form `schema_id` from a user conversation."""
+    json_schema = registered_schema(schema_id)
+
+    return await run_extraction(request.text, json_schema, SCHEMA_REGISTRY.key(schema_id), response, hedge, cache_control)
+
+@app.post("/stream-extract/{schema_id}")
+async def stream_extract_with_schema(
+    schema_id: str, request: ExtractionInput, mode: Literal["snapshot", "delta"] = "snapshot"
+) -> dict[str, Any]:
+    """Streams the filling of the registered form `schema_id`, as /stream-extract/."""
+    json_schema = registered_schema(schema_id)
+
+    return stream_extraction(request.text, json_schema, mode)
+
+@app.post("/jobs/")
+async def submit_job(data: JobInput) -> dict[str, Any]:
+    """
+    Submits a bulk job: one {"text": ...} object per JSONL line, inline in `jsonl` or read
+    from `path` inside JOB_INPUT_DIR. Lines are run in the background; poll
+    /jobs/{job_id}/results or stream /jobs/{job_id}/stream for the results.
+    """
+    if (data.jsonl is None) == (data.path is None):
+        raise HTTPException(status_code=400, detail="Give either jsonl or path")
+    if data.kind == "categorize":
+        # Lines may carry their own themes; inline lines are checked here, file lines without
+        # themes go to the dead letters.
+        if not data.themes and data.jsonl is not None and any(
+            item is not None and missing_themes(item) for _, item, _ in read_jsonl(data.jsonl.splitlines())
+        ):
+            raise HTTPException(status_code=400, detail="A categorize job needs themes, for the job or on every line")
+        params = {"themes": [theme.model_dump() for theme in data.themes]}
+    else:
+        params = {"schema": registered_schema(data.schema_id)}
+
+    job_queue = get_job_queue()
+    if data.jsonl is not None:
+        job_id = await job_queue.submit(data.kind, data.jsonl.splitlines(), params)
+    else:
+        if not JOB_INPUT_DIR:
+            raise HTTPException(status_code=400, detail="Input files are disabled (JOB_INPUT_DIR is not set)")
+        root = os.path.realpath(JOB_INPUT_DIR)
+        path = os.path.realpath(os.path.join(root, data.path))
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail=f"Unknown input file {data.path}")
+        with open(path, "r") as f:
+            job_id = await job_queue.submit(data.kind, f, params)
+
+    return await job_queue.status(job_id)
+
+async def job_status(job_id: str) -> dict[str, Any]:
+    status = await get_job_queue().status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return status
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> dict[str, Any]:
+    """Returns the progress of a bulk job."""
+    return await job_status(job_id)
+
+@app.get("/jobs/{job_id}/results")
+async def get_job_results(
+    job_id: str,
+    after: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, ge=1, le=1000),
+) -> dict[str, Any]:
+    """
+    Returns the finished lines of a job in completion order. Pass the `next` cursor of a page
+    as `after` to get the following one.
     """
-    collector = Collector(name="my-collector")
-    client_registry = ClientRegistry()
+    status = await job_status(job_id)
+    results = await asyncio.to_thread(get_job_queue().store.results, job_id, after, limit)
+
+    return {**status, "results": results, "next": results[-1]["seq"] if results else after}
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job_results(job_id: str, after: int = Query(default=0, ge=0)) -> StreamingResponse:
+    """Streams the finished lines of a job as NDJSON until the whole job is finished."""
+    await job_status(job_id)
+
+    async def lines():
+        async for result in get_job_queue().stream(job_id, after):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/jobs/{job_id}/dead-letters")
+async def get_job_dead_letters(job_id: str) -> dict[str, Any]:
+    """Returns the lines that failed on every attempt, with their last error."""
+    await job_status(job_id)
+    dead_letters = await asyncio.to_thread(get_job_queue().store.dead_letters, job_id)
+
+    return {"job_id": job_id, "dead_letters": dead_letters}
 
-    my_b = b.with_options(collector=collector, client_registry=client_registry)
+@app.delete("/jobs/{job_id}")
+async def delete_job(job_id: str) -> dict[str, Any]:
+    """Deletes a job and its results; its pending lines are dropped."""
+    if not await asyncio.to_thread(get_job_queue().store.delete, job_id):
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
 
-    return StreamingResponse(stream_fill_form(request.text, COMPLETION_FORM, my_b), media_type="text/event-stream")
\ No newline at end of file
+    return {"job_id": job_id, "deleted": True}
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import BaseModel
 
 class ClassificationClass(BaseModel):
@@ -8,5 +10,31 @@ class ClassificationInput(BaseModel):
     text: str
     themes: list[ClassificationClass]
 
+class BatchClassificationInput(BaseModel):
+    texts: list[str]
+    themes: list[ClassificationClass]
+
+class ThemeNode(BaseModel):
+    title: str
+    description: str
+    children: list["ThemeNode"] = []
+
+class HierarchicalClassificationInput(BaseModel):
+    text: str
+    themes: list[ThemeNode]
+
+class TaxonomyInput(BaseModel):
+    themes: list[ClassificationClass]
+
+class TaxonomyClassificationInput(BaseModel):
+    text: str
+
 class ExtractionInput(BaseModel):
-    text: str
\ No newline at end of file
+    text: str
+
+class JobInput(BaseModel):
+    kind: Literal["categorize", "extract"]
+    jsonl: str | None = None
+    path: str | None = None
+    themes: list[ClassificationClass] = []
+    schema_id: str = "completion_format"
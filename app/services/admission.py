@@ -0,0 +1,301 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+
+# Lower values are admitted first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKGROUND = 2
+
+# BAML client -> provider endpoint, mirroring baml_src/clients.baml: both clients call the
+# same Nebius endpoint, so their calls share one concurrency limit and priority queue.
+DEFAULT_ENDPOINTS = {
+    "CustomGenericProvider": "nebius",
+    "CustomGenericProviderTemp": "nebius",
+}
+
+
+@dataclass
+class ClientLimits:
+    max_concurrency: Optional[int] = 16
+    requests_per_second: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+class PrioritySemaphore:
+    '''
+    A semaphore whose waiters are woken by priority, then in arrival order.
+    '''
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = []
+        self._seq = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = PRIORITY_DEFAULT):
+        if self._value > 0 and self.queue_depth == 0:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over right before the cancellation: give it back.
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+class TokenBucket:
+    '''
+    Refills `rate` tokens per second up to `capacity`; acquiring waits until enough tokens are
+    available.
+    '''
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return
+            await asyncio.sleep((amount - self._tokens) / self.rate)
+
+
+class ClientLimiter:
+    '''
+    Concurrency, request rate and token rate limits of a single BAML client. Clients calling
+    the same provider endpoint pass the endpoint's shared `semaphore`, so that their calls
+    queue, by priority, in one line.
+    '''
+    def __init__(self, limits: ClientLimits, semaphore: Optional[PrioritySemaphore] = None):
+        self.limits = limits
+        if semaphore is None and limits.max_concurrency:
+            semaphore = PrioritySemaphore(limits.max_concurrency)
+        self._semaphore = semaphore
+        self._requests = (
+            TokenBucket(limits.requests_per_second, max(1.0, limits.requests_per_second))
+            if limits.requests_per_second else None
+        )
+        self._tokens = (
+            TokenBucket(limits.tokens_per_minute / 60, limits.tokens_per_minute)
+            if limits.tokens_per_minute else None
+        )
+        self.in_flight = 0
+        self.admitted = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._semaphore.queue_depth if self._semaphore else 0
+
+    @asynccontextmanager
+    async def admit(self, priority: int = PRIORITY_DEFAULT, tokens: float = 0.0):
+        start = time.perf_counter()
+        if self._semaphore:
+            await self._semaphore.acquire(priority)
+        try:
+            if self._requests:
+                await self._requests.acquire()
+            if self._tokens and tokens:
+                await self._tokens.acquire(tokens)
+        except BaseException:
+            if self._semaphore:
+                self._semaphore.release()
+            raise
+
+        wait = time.perf_counter() - start
+        self.admitted += 1
+        self.total_wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self._semaphore:
+                self._semaphore.release()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "total_wait_seconds": self.total_wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+def estimate_tokens(*args: Any, **kwargs: Any) -> float:
+    '''Rough token estimate of a call (about 4 characters per token).'''
+    return len(json.dumps([args, kwargs], default=str)) / 4
+
+
+class AdmissionController:
+    '''
+    Process-wide admission control of the provider calls, with one limiter per BAML client.
+
+    `endpoints` maps client names to the provider endpoint they call. Clients of one endpoint
+    share its concurrency limit (the `max_concurrency` of the endpoint name in `limits`) and
+    its priority queue, so that e.g. interactive calls of the temperature 0 client get ahead
+    of the sampling fan-out. Request and token rates stay per client.
+    '''
+    def __init__(
+        self,
+        limits: Dict[str, ClientLimits],
+        default_limits: ClientLimits = ClientLimits(),
+        endpoints: Optional[Dict[str, str]] = None,
+    ):
+        self.default_limits = default_limits
+        self.endpoints = dict(endpoints or {})
+        self._limits = dict(limits)
+        self._semaphores: Dict[str, Optional[PrioritySemaphore]] = {}
+        self._limiters: Dict[str, ClientLimiter] = {}
+        endpoint_names = set(self.endpoints.values())
+        for name in limits:
+            if name not in endpoint_names:
+                self.limiter(name)
+
+    def _endpoint_semaphore(self, endpoint: str) -> Optional[PrioritySemaphore]:
+        if endpoint not in self._semaphores:
+            max_concurrency = self._limits.get(endpoint, self.default_limits).max_concurrency
+            self._semaphores[endpoint] = PrioritySemaphore(max_concurrency) if max_concurrency else None
+        return self._semaphores[endpoint]
+
+    def limiter(self, client_name: str) -> ClientLimiter:
+        if client_name not in self._limiters:
+            endpoint = self.endpoints.get(client_name)
+            semaphore = self._endpoint_semaphore(endpoint) if endpoint is not None else None
+            self._limiters[client_name] = ClientLimiter(self._limits.get(client_name, self.default_limits), semaphore)
+        return self._limiters[client_name]
+
+    def admit(self, client_name: str, priority: int = PRIORITY_DEFAULT, tokens: float = 0.0):
+        return self.limiter(client_name).admit(priority, tokens)
+
+    def wrap(self, baml_client, client_name: str, priority: int = PRIORITY_DEFAULT) -> "LimitedBamlClient":
+        return LimitedBamlClient(baml_client, self, client_name, priority)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: limiter.stats() for name, limiter in self._limiters.items()}
+
+
+class LimitedStream:
+    '''Wraps a BamlStream so that the admission slot is held while the stream is consumed.'''
+    def __init__(self, stream, controller: AdmissionController, client_name: str, priority: int, tokens: float):
+        self._stream = stream
+        self._admit = lambda: controller.admit(client_name, priority, tokens)
+        self._consumed = False
+
+    async def __aiter__(self):
+        async with self._admit():
+            async for chunk in self._stream:
+                yield chunk
+            self._consumed = True
+
+    async def get_final_response(self):
+        if self._consumed:
+            return await self._stream.get_final_response()
+        async with self._admit():
+            return await self._stream.get_final_response()
+
+
+class _LimitedStreamClient:
+    def __init__(self, stream_client, controller: AdmissionController, client_name: str, priority: int):
+        self._stream_client = stream_client
+        self._controller = controller
+        self._client_name = client_name
+        self._priority = priority
+
+    def __getattr__(self, name: str):
+        function = getattr(self._stream_client, name)
+
+        def call(*args, **kwargs):
+            return LimitedStream(
+                function(*args, **kwargs), self._controller, self._client_name, self._priority,
+                estimate_tokens(*args, **kwargs),
+            )
+        return call
+
+
+class LimitedBamlClient:
+    '''
+    A BamlAsyncClient proxy running every BAML function call through the admission controller.
+    '''
+    def __init__(self, baml_client, controller: AdmissionController, client_name: str, priority: int = PRIORITY_DEFAULT):
+        self._client = baml_client
+        self._controller = controller
+        self._client_name = client_name
+        self._priority = priority
+
+    @property
+    def stream(self):
+        return _LimitedStreamClient(self._client.stream, self._controller, self._client_name, self._priority)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if not (name[:1].isupper() and asyncio.iscoroutinefunction(attr)):
+            return attr
+
+        async def call(*args, **kwargs):
+            async with self._controller.admit(self._client_name, self._priority, estimate_tokens(*args, **kwargs)):
+                return await attr(*args, **kwargs)
+        return call
+
+
+def build_admission_controller_from_env() -> AdmissionController:
+    '''
+    Builds the admission controller from the environment:
+
+    - PROVIDER_MAX_CONCURRENCY: concurrent calls per client (default 16, 0 for no limit)
+    - PROVIDER_REQUESTS_PER_SECOND / PROVIDER_TOKENS_PER_MINUTE: rate limits per client (default none)
+    - PROVIDER_LIMITS: JSON object overriding these limits per client name, e.g.
+      {"CustomGenericProviderTemp": {"max_concurrency": 4, "tokens_per_minute": 200000}};
+      the max_concurrency of a shared endpoint is set under the endpoint name
+    - PROVIDER_ENDPOINTS: JSON object mapping client names to the provider endpoint they
+      share (default DEFAULT_ENDPOINTS)
+    '''
+    def number(name: str, cast):
+        value = os.getenv(name)
+        return cast(value) if value else None
+
+    default_limits = ClientLimits(
+        max_concurrency=number("PROVIDER_MAX_CONCURRENCY", int) if os.getenv("PROVIDER_MAX_CONCURRENCY") else 16,
+        requests_per_second=number("PROVIDER_REQUESTS_PER_SECOND", float),
+        tokens_per_minute=number("PROVIDER_TOKENS_PER_MINUTE", float),
+    )
+    overrides = json.loads(os.getenv("PROVIDER_LIMITS", "{}"))
+    limits = {
+        name: ClientLimits(**{**default_limits.__dict__, **client_limits})
+        for name, client_limits in overrides.items()
+    }
+    endpoints = json.loads(os.getenv("PROVIDER_ENDPOINTS", "null")) or DEFAULT_ENDPOINTS
+    return AdmissionController(limits, default_limits, endpoints)
@@ -0,0 +1,226 @@
+from typing import Any, Awaitable, Callable, Dict, IO, Iterable, Optional, Set
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from app.schemas import ClassificationInput
+from app.services.categorize_query import categorize_query, categorize_with_confidence
+from app.services.client_pool import ClientPool
+from app.services.generate_form import fill_form, form_to_dict
+from app.services.job_queue import read_jsonl
+from baml_client.async_client import BamlAsyncClient, b
+
+MODES = ("categorize", "score", "extract")
+
+
+class Checkpoint:
+    '''
+    Sidecar file of a batch run, next to its output. It holds the highest input line up to
+    which everything is written (`watermark`), the lines written after it (unordered output
+    only) and the output size at that point.
+
+    It is replaced atomically after each write. On resume, the output is truncated back to
+    the recorded size, so that a line written just before a crash is done again rather than
+    duplicated.
+    '''
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.watermark = 0
+        self.written: Set[int] = set()
+        self.offset = 0
+
+    def load(self) -> bool:
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as f:
+            state = json.load(f)
+        self.watermark = state["watermark"]
+        self.written = set(state["written"])
+        self.offset = state["offset"]
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"watermark": self.watermark, "written": sorted(self.written), "offset": self.offset}, f)
+        os.replace(tmp_path, self.path)
+
+
+class Progress:
+    '''Reports the processed lines and the throughput every `interval` seconds.'''
+    def __init__(self, stream: IO[str] = sys.stderr, interval: float = 5.0):
+        self.stream = stream
+        self.interval = interval
+        self.start = self.last = time.perf_counter()
+        self.done = 0
+        self.errors = 0
+
+    def update(self, ok: bool):
+        self.done += 1
+        if not ok:
+            self.errors += 1
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        print(f"{self.done} lines, {self.errors} errors, {rate:.1f} lines/s", file=self.stream, flush=True)
+
+
+async def run_batch(
+    lines: Iterable[str],
+    out: IO[str],
+    handle: Callable[[Dict[str, Any]], Awaitable[Any]],
+    concurrency: int = 8,
+    ordered: bool = False,
+    checkpoint: Optional[Checkpoint] = None,
+    progress: Optional[Progress] = None,
+) -> Checkpoint:
+    '''
+    Runs `handle` on each JSONL line with at most `concurrency` calls in flight, and writes one
+    {"line", "result"} or {"line", "error"} object per input line to `out`, in input order with
+    `ordered`, as soon as each call returns otherwise.
+
+    Input lines are read lazily, and no line is started more than 4 x `concurrency` lines
+    ahead of the first unfinished one, so that memory stays constant whatever the file size.
+    Lines already covered by `checkpoint` are skipped.
+    '''
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    checkpoint = checkpoint or Checkpoint()
+    window = 4 * concurrency
+    finished: Dict[int, Optional[str]] = {}
+    in_flight: Dict[asyncio.Task, int] = {}
+    records = iter(read_jsonl(lines))
+    next_record = next(records, None)
+    last_line = checkpoint.watermark
+
+    def write(line: str):
+        out.write(line)
+        out.flush()
+        checkpoint.offset = out.tell()
+
+    def finish(number: int, line: Optional[str]):
+        if line is not None and not ordered:
+            write(line)
+            checkpoint.written.add(number)
+            line = None
+        finished[number] = line
+        while checkpoint.watermark + 1 in finished:
+            checkpoint.watermark += 1
+            buffered = finished.pop(checkpoint.watermark)
+            if buffered is not None:
+                write(buffered)
+            checkpoint.written.discard(checkpoint.watermark)
+        checkpoint.save()
+
+    async def run(item: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return {"result": await handle(item)}
+        except Exception as e:
+            return {"error": repr(e)}
+
+    while next_record is not None or in_flight:
+        while next_record is not None and len(in_flight) < concurrency and (
+            not in_flight or next_record[0] <= checkpoint.watermark + window
+        ):
+            number, item, error = next_record
+            next_record = next(records, None)
+            # Blank lines and lines done before a resume produce no output.
+            for blank in range(last_line + 1, number):
+                if blank > checkpoint.watermark and blank not in finished:
+                    finish(blank, None)
+            last_line = max(last_line, number)
+            if number <= checkpoint.watermark or number in checkpoint.written:
+                if number > checkpoint.watermark:
+                    finish(number, None)
+                continue
+            if error is not None:
+                finish(number, json.dumps({"line": number, "error": error}, ensure_ascii=False) + "\n")
+                if progress is not None:
+                    progress.update(False)
+                continue
+            in_flight[asyncio.ensure_future(run(item))] = number
+
+        if not in_flight:
+            continue
+        done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            number = in_flight.pop(task)
+            res = task.result()
+            finish(number, json.dumps({"line": number, **res}, ensure_ascii=False, default=str) + "\n")
+            if progress is not None:
+                progress.update("error" not in res)
+
+    return checkpoint
+
+
+def build_handler(
+    mode: str,
+    baml_client: BamlAsyncClient,
+    themes: Optional[list] = None,
+    json_schema: Optional[Dict[str, Any]] = None,
+    n: int = 10,
+) -> Callable[[Dict[str, Any]], Awaitable[Any]]:
+    '''Returns the service call of `mode` for one JSONL item; `themes` is used when a line has none.'''
+    async def categorize(item):
+        data = ClassificationInput(text=item["text"], themes=item.get("themes") or themes or [])
+        return await categorize_query(data, baml_client)
+
+    async def score(item):
+        data = ClassificationInput(text=item["text"], themes=item.get("themes") or themes or [])
+        return await categorize_with_confidence(data, baml_client, n)
+
+    async def extract(item):
+        return form_to_dict(await fill_form(item["text"], json_schema, baml_client))
+
+    return {"categorize": categorize, "score": score, "extract": extract}[mode]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run categorize, score or extract over a JSONL file.")
+    parser.add_argument("mode", choices=MODES)
+    parser.add_argument("input", help='JSONL file with a "text" (and optionally "themes") on each line')
+    parser.add_argument("output", help="JSONL file the results are written to")
+    parser.add_argument("--themes", help="JSON file with the themes of lines without themes")
+    parser.add_argument("--schema", default="app/data/completion_format.json", help="JSON schema of the form to fill")
+    parser.add_argument("--n", type=int, default=10, help="Samples per line in score mode")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--ordered", action="store_true", help="Write results in input order")
+    parser.add_argument("--resume", action="store_true", help="Continue from the checkpoint of a previous run")
+    parser.add_argument("--progress-interval", type=float, default=5.0)
+    args = parser.parse_args()
+
+    themes = None
+    if args.themes:
+        with open(args.themes, "r") as f:
+            themes = json.load(f)
+    json_schema = None
+    if args.mode == "extract":
+        with open(args.schema, "r") as f:
+            json_schema = json.load(f)
+    client = ClientPool(b).get("sampling" if args.mode == "score" else "default")
+    handle = build_handler(args.mode, client, themes=themes, json_schema=json_schema, n=args.n)
+
+    checkpoint = Checkpoint(f"{args.output}.checkpoint")
+    if not (args.resume and checkpoint.load()):
+        checkpoint = Checkpoint(checkpoint.path)
+        open(args.output, "w", encoding="utf-8").close()
+    progress = Progress(interval=args.progress_interval)
+    with open(args.input, "r", encoding="utf-8") as lines, open(args.output, "r+", encoding="utf-8") as out:
+        out.truncate(checkpoint.offset)
+        out.seek(checkpoint.offset)
+        asyncio.run(run_batch(lines, out, handle, args.concurrency, args.ordered, checkpoint, progress))
+    progress.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,351 @@
 import asyncio
+import math
+from contextlib import nullcontext
 
-from app.schemas import ClassificationInput
+import httpx
+
+from app.schemas import BatchClassificationInput, ClassificationInput
+from app.services.local_classifier import LocalClassifier
+from app.services.router import NoBackendAvailable
+from app.services.shortlist import shortlist_themes
+from app.services.taxonomy_registry import Taxonomy
 from baml_client.async_client import BamlAsyncClient
-from typing import Dict, Any
+from baml_client.types import Feedback
+from typing import AsyncContextManager, AsyncIterator, Callable, Dict, Any, List, Optional
 
-async def categorize_query(data: ClassificationInput, baml_client: BamlAsyncClient) -> Dict[str, Any]:
+async def categorize_query(
+    data: ClassificationInput,
+    baml_client: BamlAsyncClient,
+    shortlist_k: Optional[int] = None,
+    local_model: Optional[LocalClassifier] = None,
+    local_threshold: float = 0.9,
+) -> Dict[str, Any]:
     """
     Categorizes a query into one of the predefined categories.
 
     Args:
         query (str): The input query to categorize.
+        shortlist_k (int, optional): If set, only the `shortlist_k` themes most lexically
+            similar to the query are sent to the model.
+        local_model (LocalClassifier, optional): If set, queries the local classifier answers
+            with a probability of at least `local_threshold` skip the LLM and are marked
+            with `source: local`.
 
     Returns:
         str: The category of the query.
     """
+    if local_model is not None:
+        local = local_model.classify(data.text, data.themes, local_threshold)
+        if local is not None:
+            index, confidence = local
+            return {
+                "model_reasoning": f"Local classifier prediction with probability {confidence:.2f}",
+                "chosen_theme": {
+                    "title": data.themes[index].title,
+                    "description": data.themes[index].description,
+                },
+                "source": "local",
+            }
+
+    if shortlist_k is not None:
+        candidates = shortlist_themes(data.text, data.themes, shortlist_k)
+    else:
+        candidates = range(len(data.themes))
+
     res =  await baml_client.CategorizeFeedback(
         user_message=data.text,
-        categories=[{"title": class_.title, "description":class_.description} for class_ in data.themes]
+        categories=[{"title": data.themes[i].title, "description": data.themes[i].description} for i in candidates]
     )
 
-    
+    theme = data.themes[candidates[res.category - 1]]
 
     return {
         "model_reasoning": res.rationale,
         "chosen_theme": {
-            "title": data.themes[res.category - 1].title,
-            "description": data.themes[res.category - 1].description,
+            "title": theme.title,
+            "description": theme.description,
         },
     }
 
-async def categorize_with_confidence(data: ClassificationInput, baml_client: BamlAsyncClient, n: int) -> str:
+
+async def categorize_with_taxonomy(text: str, taxonomy: Taxonomy, baml_client: BamlAsyncClient) -> Dict[str, Any]:
+    """
+    Categorizes a query into one of the themes of a registered taxonomy, with its category
+    block rendered once at registration and placed before the query in the prompt.
+    """
+    res = await baml_client.CategorizeWithCatalog(catalog=taxonomy.catalog, user_message=text)
+
+    return {
+        "model_reasoning": res.rationale,
+        "chosen_theme": taxonomy.theme(res.category),
+    }
+
+
+def _count_vote(Counter: Dict[int, Dict[str, Any]], elem, data: ClassificationInput):
+    if elem.category not in Counter:
+        Counter[elem.category] = {
+            'num': 0,
+            'first': {
+                "model_reasoning": elem.rationale,
+                "chosen_theme": {
+                    "title": data.themes[elem.category - 1].title,
+                    "description": data.themes[elem.category - 1].description,
+                },
+            }
+        }
+    Counter[elem.category]['num'] += 1
+
+
+def wilson_lower_bound(votes: int, total: int, z: float = 1.96) -> float:
+    """
+    Lower bound of the Wilson score interval for a proportion of `votes` out of `total`.
+    """
+    if total == 0:
+        return 0.0
+    p = votes / total
+    denominator = 1 + z * z / total
+    centre = p + z * z / (2 * total)
+    margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total))
+    return (centre - margin) / denominator
+
+
+def _is_decided(Counter: Dict[int, Dict[str, Any]], used: int, n: int, stop_confidence: Optional[float]) -> bool:
+    counts = sorted((entry['num'] for entry in Counter.values()), reverse=True)
+    if not counts:
+        return False
+    leader = counts[0]
+    runner_up = counts[1] if len(counts) > 1 else 0
+    # The leader can no longer be caught up even if every remaining sample disagrees.
+    if leader > runner_up + (n - used):
+        return True
+    if stop_confidence is not None and wilson_lower_bound(leader, used) >= stop_confidence:
+        return True
+    return False
+
+
+async def sample_feedbacks_single_request(
+    data: ClassificationInput,
+    baml_client: BamlAsyncClient,
+    n: int,
+    http_client: Optional[httpx.AsyncClient] = None,
+    admit: Optional[Callable[[], AsyncContextManager]] = None,
+) -> List[Feedback]:
+    """
+    Asks the OpenAI-compatible provider for `n` choices in a single request and parses each
+    choice into a Feedback.
+
+    The request is sent with raw HTTP, outside the BAML client and its proxies: `admit`
+    returns the context (e.g. an admission slot) to send it in, which yields the BAML client
+    to render the request from (e.g. the handle of the backend picked by the router).
+    `http_client` should be shared so that connections are reused.
+
+    Choices that cannot be parsed are dropped, and if the request fails (HTTP or network
+    error, unreadable body, no backend available) or the provider ignores `n` and returns
+    fewer choices, the missing samples are requested with the usual fan-out.
+    """
+    categories = [{"title": class_.title, "description":class_.description} for class_ in data.themes]
+
+    async def send(client: httpx.AsyncClient) -> List[Dict[str, Any]]:
+        async with (admit() if admit is not None else nullcontext(baml_client)) as render_client:
+            request = await render_client.request.CategorizeFeedback(user_message=data.text, categories=categories)
+            body = request.body.json()
+            body["n"] = n
+            headers = {key: value for key, value in request.headers.items() if not key.startswith("baml-")}
+            response = await client.request(request.method, request.url, headers=headers, json=body)
+            response.raise_for_status()
+            return response.json().get("choices", [])
+
+    try:
+        if http_client is None:
+            async with httpx.AsyncClient(timeout=60) as client:
+                choices = await send(client)
+        else:
+            choices = await send(http_client)
+    except (httpx.HTTPError, ValueError, NoBackendAvailable):
+        choices = []
+
+    feedbacks = []
+    for choice in choices[:n]:
+        try:
+            feedbacks.append(baml_client.parse.CategorizeFeedback(choice["message"]["content"]))
+        except Exception:
+            continue
+
+    if len(feedbacks) < n:
+        feedbacks.extend(await asyncio.gather(*[
+            baml_client.CategorizeFeedback(user_message=data.text, categories=categories)
+            for _ in range(n - len(feedbacks))
+        ]))
+    return feedbacks
+
+
+async def categorize_with_confidence(
+    data: ClassificationInput,
+    baml_client: BamlAsyncClient,
+    n: int,
+    adaptive: bool = False,
+    wave_size: int = 3,
+    stop_confidence: Optional[float] = None,
+    single_request: bool = False,
+    http_client: Optional[httpx.AsyncClient] = None,
+    admit: Optional[Callable[[], AsyncContextManager]] = None,
+) -> Dict[str, Any]:
     """
     Categorizes a query into one of the predefined categories with confidence scores.
+
+    In adaptive mode, samples are sent in waves of `wave_size` and sampling stops as soon as
+    the leading category can no longer lose, or when the Wilson lower bound of its vote share
+    reaches `stop_confidence`. Outstanding calls are cancelled and the number of samples
+    actually used is reported in `samples_used`.
+
+    With `single_request`, all samples come from one provider call with `n` choices
+    (see `sample_feedbacks_single_request`); this takes precedence over adaptive mode.
     """
+    categories = [{"title": class_.title, "description":class_.description} for class_ in data.themes]
+
+    if single_request or not adaptive:
+        if single_request:
+            res = await sample_feedbacks_single_request(data, baml_client, n, http_client=http_client, admit=admit)
+        else:
+            tasks = [
+                baml_client.CategorizeFeedback(
+                    user_message=data.text,
+                    categories=categories,
+                    ) for _ in range(n)
+                ]
+            res =  await asyncio.gather(*tasks)
+
+        Counter = {}
+        for elem in res:
+            _count_vote(Counter, elem, data)
+
+        res = max(Counter.items(), key=lambda x: x[1]['num'])[1]
+        res['first']['confidence'] = res['num'] / n
 
-    tasks = [
-        baml_client.CategorizeFeedback(
-            user_message=data.text,
-            categories=[{"title": class_.title, "description":class_.description} for class_ in data.themes],
-            ) for _ in range(n)
-        ]
-    res =  await asyncio.gather(*tasks)
+        return res['first']
+
+    if wave_size < 1:
+        raise ValueError("wave_size must be at least 1")
 
     Counter = {}
-    for elem in res:
-        if elem.category not in Counter:
-            Counter[elem.category] = {
-                'num': 0,
-                'first': {
-                    "model_reasoning": elem.rationale,
-                    "chosen_theme": {
-                        "title": data.themes[elem.category - 1].title,
-                        "description": data.themes[elem.category - 1].description,
-                    },
-                }
-            }
-        Counter[elem.category]['num'] += 1
-    
+    used = 0
+    decided = False
+    while used < n and not decided:
+        pending = {
+            asyncio.ensure_future(baml_client.CategorizeFeedback(user_message=data.text, categories=categories))
+            for _ in range(min(wave_size, n - used))
+        }
+        try:
+            for next_done in asyncio.as_completed(pending):
+                elem = await next_done
+                used += 1
+                _count_vote(Counter, elem, data)
+                if _is_decided(Counter, used, n, stop_confidence):
+                    decided = True
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+
     res = max(Counter.items(), key=lambda x: x[1]['num'])[1]
-    res['first']['confidence'] = res['num'] / n
+    res['first']['confidence'] = res['num'] / used
+    res['first']['samples_used'] = used
+
+    return res['first']
+
+
+
+async def stream_categorize_with_confidence(
+    data: ClassificationInput,
+    baml_client: BamlAsyncClient,
+    n: int,
+    adaptive: bool = False,
+    stop_confidence: Optional[float] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streams the vote of `categorize_with_confidence`: the `n` samples are sent at once and,
+    as each one returns, the running vote counts (one per theme, in theme order), the current
+    leader and its vote share are yielded. A last message with `final: true` carries the
+    result, as `categorize_with_confidence` returns it.
+
+    In adaptive mode the vote stops early as in `categorize_with_confidence`. Outstanding
+    calls are cancelled when the vote stops or when the consumer stops iterating.
+    """
+    categories = [{"title": class_.title, "description": class_.description} for class_ in data.themes]
+    pending = [
+        asyncio.ensure_future(baml_client.CategorizeFeedback(user_message=data.text, categories=categories))
+        for _ in range(n)
+    ]
+    Counter = {}
+    used = 0
+    try:
+        for next_done in asyncio.as_completed(pending):
+            elem = await next_done
+            used += 1
+            _count_vote(Counter, elem, data)
+            leader = max(Counter.values(), key=lambda x: x['num'])
+            yield {
+                "samples": used,
+                "votes": [Counter[i]['num'] if i in Counter else 0 for i in range(1, len(data.themes) + 1)],
+                "leader": leader['first']['chosen_theme'],
+                "confidence": leader['num'] / used,
+            }
+            if adaptive and _is_decided(Counter, used, n, stop_confidence):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    yield {**leader['first'], "confidence": leader['num'] / used, "samples_used": used, "final": True}
+
+async def categorize_batch(
+    data: BatchClassificationInput,
+    baml_client: BamlAsyncClient,
+    batch_size: int = 10,
+    max_concurrency: int = 4,
+) -> List[Dict[str, Any]]:
+    """
+    Categorizes many messages sharing one theme list, packing `batch_size` messages into each
+    CategorizeFeedbackBatch call so that the category list is only rendered once per batch.
+
+    At most `max_concurrency` batches are in flight. Results keep the order of `data.texts`;
+    items the model skipped, answered with an unknown category, or whose batch failed are
+    reported individually with an `error`.
+    """
+    if batch_size < 1 or max_concurrency < 1:
+        raise ValueError("batch_size and max_concurrency must be at least 1")
+
+    categories = [{"title": class_.title, "description":class_.description} for class_ in data.themes]
+    results: List[Dict[str, Any]] = [
+        {"index": i, "error": "No answer returned for this message"} for i in range(len(data.texts))
+    ]
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_batch(start: int):
+        messages = data.texts[start:start + batch_size]
+        async with semaphore:
+            try:
+                res = await baml_client.CategorizeFeedbackBatch(user_messages=messages, categories=categories)
+            except Exception as e:
+                for i in range(start, start + len(messages)):
+                    results[i] = {"index": i, "error": str(e)}
+                return
+
+        for elem in res:
+            if not 1 <= elem.message_index <= len(messages):
+                continue
+            index = start + elem.message_index - 1
+            if not 1 <= elem.category <= len(data.themes):
+                results[index] = {"index": index, "error": f"Unknown category {elem.category}"}
+                continue
+            results[index] = {
+                "index": index,
+                "model_reasoning": elem.rationale,
+                "chosen_theme": {
+                    "title": data.themes[elem.category - 1].title,
+                    "description": data.themes[elem.category - 1].description,
+                },
+            }
 
-    return res['first']
\ No newline at end of file
+    await asyncio.gather(*[run_batch(start) for start in range(0, len(data.texts), batch_size)])
+    return results
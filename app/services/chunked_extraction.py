@@ -0,0 +1,172 @@
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+import json
+import re
+
+from app.services.generate_form import SCHEMA_CACHE, SchemaCache, fill_form, form_to_dict
+from app.services.json_patch import diff
+from baml_client.async_client import BamlAsyncClient
+
+# A turn starts with a short speaker label such as "Client :" or "Agent:".
+SPEAKER_RE = re.compile(r"^\s*[\w' .-]{1,40}\s?:", re.UNICODE)
+
+
+def split_turns(text: str) -> List[str]:
+    '''
+    Splits a conversation into turns: a new turn starts at each line opening with a speaker
+    label. Without speaker labels, paragraphs (blank-line separated) are used instead.
+    '''
+    lines = text.splitlines()
+    if any(SPEAKER_RE.match(line) for line in lines):
+        turns: List[List[str]] = []
+        for line in lines:
+            if SPEAKER_RE.match(line) or not turns:
+                turns.append([line])
+            else:
+                turns[-1].append(line)
+        return ["\n".join(turn).strip() for turn in turns if "".join(turn).strip()]
+    return [paragraph.strip() for paragraph in re.split(r"\n\s*\n", text) if paragraph.strip()]
+
+
+def chunk_turns(turns: List[str], max_chars: int, overlap: int = 1) -> List[str]:
+    '''
+    Packs consecutive turns into chunks of at most `max_chars` characters, never splitting a
+    turn. Each chunk repeats the last `overlap` turns of the previous one, so that facts
+    spread over a chunk boundary are seen together at least once.
+    '''
+    if max_chars < 1 or overlap < 0:
+        raise ValueError("max_chars must be at least 1 and overlap cannot be negative")
+
+    chunks: List[str] = []
+    start = 0
+    while start < len(turns):
+        end = start
+        size = 0
+        while end < len(turns) and (end == start or size + len(turns[end]) + 1 <= max_chars):
+            size += len(turns[end]) + 1
+            end += 1
+        chunks.append("\n".join(turns[start:end]))
+        if end == len(turns):
+            break
+        # Moving forward by at least one turn guarantees termination with a large overlap.
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+def _list_key(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def merge_forms(base: Any, update: Any) -> Any:
+    '''
+    Merges the form filled from a later chunk (`update`) into `base`: objects are merged
+    field by field, lists are unioned in order of first appearance, and otherwise the later
+    value wins unless it is null.
+    '''
+    if update is None:
+        return base
+    if isinstance(base, dict) and isinstance(update, dict):
+        merged = dict(base)
+        for key, value in update.items():
+            merged[key] = merge_forms(base.get(key), value)
+        return merged
+    if isinstance(base, list) and isinstance(update, list):
+        seen = {_list_key(item) for item in base}
+        merged_list = list(base)
+        for item in update:
+            if item is not None and _list_key(item) not in seen:
+                seen.add(_list_key(item))
+                merged_list.append(item)
+        return merged_list
+    return update
+
+
+def merge_all(parts: List[Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+    '''Merges the available partial forms in chunk order, whatever order they finished in.'''
+    merged: Dict[str, Any] = {}
+    for part in parts:
+        if part is not None:
+            merged = merge_forms(merged, part)
+    return merged
+
+
+async def _fill_chunks(
+    chunks: List[str],
+    json_schema: Dict[str, Any],
+    b: BamlAsyncClient,
+    schema_cache: SchemaCache,
+    max_concurrency: int,
+) -> AsyncIterator[List[Optional[Dict[str, Any]]]]:
+    '''Fills every chunk concurrently and yields the partial forms each time one finishes.'''
+    semaphore = asyncio.Semaphore(max_concurrency)
+    parts: List[Optional[Dict[str, Any]]] = [None] * len(chunks)
+
+    async def fill(index: int):
+        async with semaphore:
+            parts[index] = form_to_dict(await fill_form(chunks[index], json_schema, b, schema_cache))
+
+    tasks = [asyncio.ensure_future(fill(index)) for index in range(len(chunks))]
+    try:
+        for task in asyncio.as_completed(tasks):
+            await task
+            yield parts
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def extract_chunked(
+    message: str,
+    json_schema: Dict[str, Any],
+    b: BamlAsyncClient,
+    max_chars: int = 4000,
+    overlap: int = 1,
+    max_concurrency: int = 4,
+    schema_cache: SchemaCache = SCHEMA_CACHE,
+) -> Dict[str, Any]:
+    '''
+    Map-reduce extraction for long conversations: the conversation is split into chunks of
+    turns (see `chunk_turns`), the form is filled for each chunk concurrently, and the partial
+    forms are merged with `merge_forms`. The size of each call stays bounded by `max_chars`.
+    '''
+    chunks = chunk_turns(split_turns(message), max_chars, overlap)
+    parts: List[Optional[Dict[str, Any]]] = []
+    async for parts in _fill_chunks(chunks, json_schema, b, schema_cache, max_concurrency):
+        pass
+    return merge_all(parts)
+
+
+async def stream_extract_chunked(
+    message: str,
+    json_schema: Dict[str, Any],
+    b: BamlAsyncClient,
+    max_chars: int = 4000,
+    overlap: int = 1,
+    max_concurrency: int = 4,
+    delta: bool = False,
+    schema_cache: SchemaCache = SCHEMA_CACHE,
+):
+    '''
+    Streams the merged form each time a chunk finishes, one JSON line per update. With
+    `delta`, lines carry RFC 6902 patches as in `stream_fill_form_delta`, followed by the
+    final snapshot.
+    '''
+    chunks = chunk_turns(split_turns(message), max_chars, overlap)
+    seq = 0
+    previous = None
+    merged: Dict[str, Any] = {}
+    async for parts in _fill_chunks(chunks, json_schema, b, schema_cache, max_concurrency):
+        merged = merge_all(parts)
+        done = sum(part is not None for part in parts)
+        if not delta:
+            yield json.dumps({"chunks_done": done, "chunks_total": len(chunks), "data": merged}, default=str) + "\n"
+            continue
+        patch = diff(previous, merged) if previous is not None else [{"op": "add", "path": "", "value": merged}]
+        previous = merged
+        if patch:
+            yield json.dumps({"seq": seq, "patch": patch}, default=str) + "\n"
+            seq += 1
+
+    if delta:
+        yield json.dumps({"seq": seq, "final": True, "snapshot": merged}, default=str) + "\n"
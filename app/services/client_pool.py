@@ -0,0 +1,70 @@
+from typing import Any, Dict, List, Optional
+import os
+
+from baml_py import ClientRegistry, Collector
+from baml_client.async_client import BamlAsyncClient
+
+# Provider profile -> BAML client defined in baml_src/clients.baml
+PROFILES = {
+    "default": "CustomGenericProvider",
+    "sampling": "CustomGenericProviderTemp",
+}
+
+# Options of each profile applied on top of the routed backends, mirroring clients.baml
+PROFILE_OPTIONS = {
+    "default": {"temperature": 0.0},
+    "sampling": {"temperature": 0.6},
+}
+
+
+class ClientPool:
+    '''
+    Preconfigured BAML client handles, one per provider profile, built once and shared by
+    every request so that the provider connections stay warm.
+
+    When `backends` are given (see app.services.router), each profile also gets one handle per
+    OpenAI-compatible backend, for the router to choose from.
+    '''
+    def __init__(
+        self,
+        baml_client: BamlAsyncClient,
+        profiles: Dict[str, str] = PROFILES,
+        backends: Optional[List[Dict[str, Any]]] = None,
+    ):
+        self.client_names = dict(profiles)
+        self._handles: Dict[str, BamlAsyncClient] = {}
+        for profile, client_name in profiles.items():
+            client_registry = ClientRegistry()
+            client_registry.set_primary(client_name)
+            self._handles[profile] = baml_client.with_options(client_registry=client_registry)
+
+        self.backend_names = [backend["name"] for backend in backends or []]
+        self._backend_handles: Dict[str, Dict[str, BamlAsyncClient]] = {}
+        for profile, profile_options in PROFILE_OPTIONS.items():
+            for backend in backends or []:
+                options = {key: value for key, value in backend.items() if key not in ("name", "provider", "api_key_env")}
+                if "api_key_env" in backend:
+                    options["api_key"] = os.getenv(backend["api_key_env"], "")
+                options.update(profile_options)
+                client_name = f"{backend['name']}-{profile}"
+                client_registry = ClientRegistry()
+                # Retries are handled by the router, across backends.
+                client_registry.add_llm_client(client_name, backend.get("provider", "openai-generic"), options)
+                client_registry.set_primary(client_name)
+                self._backend_handles.setdefault(profile, {})[backend["name"]] = baml_client.with_options(
+                    client_registry=client_registry
+                )
+
+    def get(self, profile: str = "default", collector: Optional[Collector] = None) -> BamlAsyncClient:
+        '''Returns the handle of `profile`, attached to `collector` if one is given.'''
+        handle = self._handles[profile]
+        if collector is not None:
+            return handle.with_options(collector=collector)
+        return handle
+
+    def get_backends(self, profile: str = "default", collector: Optional[Collector] = None) -> Dict[str, BamlAsyncClient]:
+        '''Returns the handle of `profile` on every routed backend, or an empty dict without routing.'''
+        handles = self._backend_handles.get(profile, {})
+        if collector is not None:
+            return {name: handle.with_options(collector=collector) for name, handle in handles.items()}
+        return handles
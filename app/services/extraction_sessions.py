@@ -0,0 +1,120 @@
+from typing import Any, Dict, Optional
+import asyncio
+import hashlib
+import json
+import os
+import weakref
+
+from app.services.generate_form import SCHEMA_CACHE, SchemaCache, fill_form, form_to_dict
+from app.services.result_cache import MemoryCacheBackend, SQLiteCacheBackend
+from baml_client.async_client import BamlAsyncClient
+
+
+def _prefix_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SessionStore:
+    '''
+    Keeps, per session id, the last filled form and how much of the transcript it covers.
+
+    Any backend with get/set/delete (see app.services.result_cache) can be plugged in; states
+    expire `ttl` seconds after their last update. Backend calls run in a thread, so that a
+    SQLite backend does not block the event loop.
+    '''
+    def __init__(self, backend, ttl: float = 3600):
+        self.backend = backend
+        self.ttl = ttl
+
+    async def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        value = await asyncio.to_thread(self.backend.get, session_id)
+        return json.loads(value) if value is not None else None
+
+    async def save(self, session_id: str, state: Dict[str, Any]):
+        await asyncio.to_thread(self.backend.set, session_id, json.dumps(state, default=str), self.ttl)
+
+    async def delete(self, session_id: str):
+        await asyncio.to_thread(self.backend.delete, session_id)
+
+
+class ExtractionSessions:
+    '''
+    Incremental extraction for live conversations. Clients send the whole transcript so far;
+    only the text after the processed offset is sent to the model, along with the current
+    form, so that the cost of a turn follows the new text rather than the whole conversation.
+
+    If the transcript no longer starts with the text already processed (edited or reset),
+    the form is filled again from scratch.
+    '''
+    def __init__(self, store: SessionStore, schema_cache: SchemaCache = SCHEMA_CACHE):
+        self.store = store
+        self.schema_cache = schema_cache
+        self.full_fills = 0
+        self.incremental_fills = 0
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def _lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def update(
+        self,
+        session_id: str,
+        transcript: str,
+        json_schema: Dict[str, Any],
+        b: BamlAsyncClient,
+    ) -> Dict[str, Any]:
+        '''Brings the form of `session_id` up to date with `transcript` and returns the state.'''
+        # Updates of one session are serialized so that turns are never applied out of order.
+        async with self._lock(session_id):
+            state = await self.store.load(session_id)
+            if state is not None and (
+                len(transcript) < state["offset"] or _prefix_hash(transcript[:state["offset"]]) != state["prefix_hash"]
+            ):
+                state = None
+
+            if state is None:
+                form = form_to_dict(await fill_form(transcript, json_schema, b, self.schema_cache))
+                self.full_fills += 1
+            else:
+                new_text = transcript[state["offset"]:]
+                if not new_text.strip():
+                    return state
+                tb = self.schema_cache.get(json_schema)
+                response = await b.UpdateForm(json.dumps(state["data"], default=str), new_text, {"tb": tb})
+                form = form_to_dict(response.data)  # type: ignore
+                self.incremental_fills += 1
+
+            state = {"data": form, "offset": len(transcript), "prefix_hash": _prefix_hash(transcript)}
+            await self.store.save(session_id, state)
+            return state
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self.store.load(session_id)
+
+    async def delete(self, session_id: str):
+        await self.store.delete(session_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {"full_fills": self.full_fills, "incremental_fills": self.incremental_fills}
+
+
+def build_extraction_sessions_from_env() -> ExtractionSessions:
+    '''
+    Builds the extraction session store from the environment:
+
+    - EXTRACT_SESSION_BACKEND: "memory" (default) or "sqlite"
+    - EXTRACT_SESSION_PATH: SQLite file path (default "extract_sessions.sqlite3")
+    - EXTRACT_SESSION_MAX_SIZE: number of sessions kept by the memory backend (default 10000)
+    - EXTRACT_SESSION_TTL: seconds a session is kept after its last update (default 3600)
+    '''
+    kind = os.getenv("EXTRACT_SESSION_BACKEND", "memory").lower()
+    if kind == "memory":
+        backend = MemoryCacheBackend(max_size=int(os.getenv("EXTRACT_SESSION_MAX_SIZE", "10000")))
+    elif kind == "sqlite":
+        backend = SQLiteCacheBackend(os.getenv("EXTRACT_SESSION_PATH", "extract_sessions.sqlite3"), table="extract_sessions")
+    else:
+        raise ValueError(f"Unsupported extraction session backend: {kind}")
+    return ExtractionSessions(SessionStore(backend, ttl=float(os.getenv("EXTRACT_SESSION_TTL", "3600"))))
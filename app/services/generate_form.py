@@ -1,5 +1,10 @@
-from typing import Any, Dict
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib
+import json
+import threading
 
+from app.services.json_patch import diff
 from baml_client.type_builder import TypeBuilder
 from baml_client.async_client import BamlAsyncClient
 import asyncio
@@ -47,7 +52,6 @@ class SchemaAdder:
                         description = description.strip()
                     if len(description) > 0:
                         property.description(description)
-        print(type(new_cls), type(new_cls.type()))
         return new_cls.type()
 
     def _parse_string(self, json_schema: Dict[str, Any], title: str = None):
@@ -113,22 +117,242 @@ def parse_json_schema(json_schema: Dict[str, Any], tb: TypeBuilder):
     return parser.parse(json_schema)
 
 
-async def fill_form(message, json_schema, b: BamlAsyncClient) -> Dict[str, Any]:
+def schema_key(json_schema: Dict[str, Any]) -> str:
+    '''Returns a content hash of a JSON schema, independent of key order.'''
+    canonical = json.dumps(json_schema, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def compile_schema(json_schema: Dict[str, Any]) -> TypeBuilder:
+    '''Builds a TypeBuilder whose FilledForm.data field follows the given schema.'''
     tb = TypeBuilder()
     res = parse_json_schema(json_schema, tb)
     tb.FilledForm.add_property("data", res)
+    return tb
+
+
+class SchemaCache:
+    '''
+    A bounded LRU cache of compiled TypeBuilders, keyed by the content hash of the schema.
+    '''
+    def __init__(self, max_size: int = 32):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, TypeBuilder]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, json_schema: Dict[str, Any]) -> TypeBuilder:
+        key = schema_key(json_schema)
+        with self._lock:
+            tb = self._entries.get(key)
+            if tb is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return tb
+            self.misses += 1
+
+        tb = compile_schema(json_schema)
+        with self._lock:
+            self._entries[key] = tb
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return tb
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+SCHEMA_CACHE = SchemaCache()
+
+
+def count_fields(json_schema: Dict[str, Any]) -> int:
+    '''Counts the leaf fields of a schema, as a proxy for the size of the generated output.'''
+    if properties := json_schema.get("properties"):
+        return sum(count_fields(field_schema) for field_schema in properties.values())
+    if json_schema.get("type") == "array" and isinstance(json_schema.get("items"), dict):
+        return count_fields(json_schema["items"])
+    return 1
+
+
+def partition_schema(json_schema: Dict[str, Any], max_fields: int) -> List[Dict[str, Any]]:
+    '''
+    Splits the top-level properties of a schema into sub-schemas of about `max_fields` leaf
+    fields each, balancing their sizes. A property is never split, so a single large section
+    gets a sub-schema of its own. Definitions are kept in every sub-schema for `$ref`.
+    '''
+    properties = json_schema.get("properties") or {}
+    sizes = {name: count_fields(field_schema) for name, field_schema in properties.items()}
+    n_parts = min(len(properties), -(-sum(sizes.values()) // max_fields))
+    if n_parts <= 1:
+        return [json_schema]
+
+    parts: List[List[str]] = [[] for _ in range(n_parts)]
+    totals = [0] * n_parts
+    for name in sorted(properties, key=sizes.get, reverse=True):
+        smallest = totals.index(min(totals))
+        parts[smallest].append(name)
+        totals[smallest] += sizes[name]
+
+    required = json_schema.get("required", [])
+    sub_schemas = []
+    for names in parts:
+        names = [name for name in properties if name in names]
+        sub_schemas.append({
+            **json_schema,
+            "properties": {name: properties[name] for name in names},
+            "required": [name for name in required if name in names],
+        })
+    return sub_schemas
+
+
+class PartitionCache:
+    '''
+    A bounded LRU cache of schema partitions (see `partition_schema`), with the compiled
+    TypeBuilder of each sub-schema, keyed by the content hash of the schema and the partition
+    size. Schemas that are not split are cached as None.
+
+    Sub-schemas are compiled here rather than in a SchemaCache, so that they neither evict nor
+    get evicted by the whole schemas cached there.
+    '''
+    def __init__(self, max_size: int = 32):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, int], Optional[List[Tuple[Dict[str, Any], TypeBuilder]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self, json_schema: Dict[str, Any], max_fields: int, key: Optional[str] = None
+    ) -> Optional[List[Tuple[Dict[str, Any], TypeBuilder]]]:
+        '''Returns the (sub-schema, TypeBuilder) parts of `json_schema`, or None if it is not split.'''
+        entry_key = (key or schema_key(json_schema), max_fields)
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return self._entries[entry_key]
+            self.misses += 1
+
+        parts = None
+        if count_fields(json_schema) > max_fields:
+            sub_schemas = partition_schema(json_schema, max_fields)
+            if len(sub_schemas) > 1:
+                parts = [(sub_schema, compile_schema(sub_schema)) for sub_schema in sub_schemas]
+        with self._lock:
+            self._entries[entry_key] = parts
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return parts
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+PARTITION_CACHE = PartitionCache()
+
+
+def form_to_dict(data: Any) -> Dict[str, Any]:
+    '''Returns the filled form as a plain dict, whether BAML returned a model or a dict.'''
+    if hasattr(data, "model_dump"):
+        return data.model_dump()
+    return dict(data or {})
+
+
+async def fill_form(
+    message,
+    json_schema,
+    b: BamlAsyncClient,
+    schema_cache: SchemaCache = SCHEMA_CACHE,
+    partition_size: Optional[int] = None,
+    partition_cache: PartitionCache = PARTITION_CACHE,
+    json_schema_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    '''
+    Fills the form described by `json_schema` from `message`.
+
+    With `partition_size`, a form of more than `partition_size` leaf fields is split into
+    sub-forms (see `partition_schema`) that are filled concurrently and merged, so that the
+    latency follows the largest section rather than the whole form. The partition and its
+    TypeBuilders are cached in `partition_cache`; `json_schema_key` (the `schema_key` of the
+    schema, when the caller already has it) saves hashing the schema again.
+    '''
+    if partition_size is not None:
+        parts = partition_cache.get(json_schema, partition_size, json_schema_key)
+        if parts is not None:
+            responses = await asyncio.gather(*(b.FillForm(message, {"tb": tb}) for _, tb in parts))
+            merged: Dict[str, Any] = {}
+            for response in responses:
+                merged.update(form_to_dict(response.data))  # type: ignore
+            return {name: merged[name] for name in json_schema["properties"] if name in merged}
+
+    tb = schema_cache.get(json_schema)
     response = await b.FillForm(message, {"tb": tb})
     data = response.data  # type: ignore
     return data
 
 
-async def stream_fill_form(message: str, json_schema: Dict[str, Any], b: BamlAsyncClient):
-    tb = TypeBuilder()
-    res = parse_json_schema(json_schema, tb)
-    tb.FilledForm.add_property("data", res)
+async def stream_fill_form(message: str, json_schema: Dict[str, Any], b: BamlAsyncClient, schema_cache: SchemaCache = SCHEMA_CACHE):
+    tb = schema_cache.get(json_schema)
     stream = b.stream.FillForm(message, {"tb": tb})
     async for chunk in stream:
         yield (str(chunk.model_dump_json()) + "\n")
         await asyncio.sleep(
             0
         )
+
+
+async def stream_fill_form_delta(message: str, json_schema: Dict[str, Any], b: BamlAsyncClient, schema_cache: SchemaCache = SCHEMA_CACHE):
+    '''
+    Streams the form as RFC 6902 patches against the previous chunk instead of full snapshots.
+
+    Each line carries a sequence number. Chunks that change nothing are skipped, and the
+    stream ends with the full final form so that clients can resynchronise.
+    '''
+    tb = schema_cache.get(json_schema)
+    stream = b.stream.FillForm(message, {"tb": tb})
+    seq = 0
+    previous = None
+    async for chunk in stream:
+        current = chunk.model_dump(mode="json")
+        patch = diff(previous, current) if previous is not None else [{"op": "add", "path": "", "value": current}]
+        previous = current
+        if patch:
+            yield json.dumps({"seq": seq, "patch": patch}) + "\n"
+            seq += 1
+        await asyncio.sleep(
+            0
+        )
+
+    final = await stream.get_final_response()
+    yield json.dumps({"seq": seq, "final": True, "snapshot": final.model_dump(mode="json")}) + "\n"
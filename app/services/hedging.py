@@ -0,0 +1,148 @@
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+import asyncio
+import os
+import time
+
+
+class LatencyTracker:
+    '''Keeps the most recent latencies of a call to estimate its percentiles.'''
+    def __init__(self, window: int = 500):
+        self._latencies: Deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def record(self, latency: float):
+        self._latencies.append(latency)
+
+    def percentile(self, p: float) -> float:
+        ordered = sorted(self._latencies)
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+
+class HedgePolicy:
+    '''
+    Decides when to send a duplicate call: once the first call has been running for longer
+    than the `percentile` of the recent latencies of the same function, as long as hedges stay
+    below `budget` (a fraction of the calls).
+    '''
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        budget: float = 0.1,
+        min_samples: int = 20,
+        default_delay: float = 2.0,
+        window: int = 500,
+    ):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.window = window
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._trackers: Dict[str, LatencyTracker] = {}
+
+    def tracker(self, function_name: str) -> LatencyTracker:
+        if function_name not in self._trackers:
+            self._trackers[function_name] = LatencyTracker(self.window)
+        return self._trackers[function_name]
+
+    def delay(self, function_name: str) -> float:
+        tracker = self.tracker(function_name)
+        if len(tracker) < self.min_samples:
+            return self.default_delay
+        return tracker.percentile(self.percentile)
+
+    def can_hedge(self) -> bool:
+        return self.hedges < self.budget * self.calls
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+async def hedged_call(
+    function_name: str,
+    primary: Callable[[], Awaitable[Any]],
+    policy: HedgePolicy,
+    secondary: Optional[Callable[[], Awaitable[Any]]] = None,
+) -> Any:
+    '''
+    Runs `primary` and, if it has not returned after the hedge delay, races it against a
+    duplicate (`secondary`, or `primary` again). The first successful result wins and the
+    other call is cancelled.
+
+    The latency of the primary call is recorded however it ends, failures included. A primary
+    call cancelled because the duplicate won is recorded with its time so far, a lower bound
+    that is still above the hedge delay.
+    '''
+    policy.calls += 1
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(primary())]
+    tasks[0].add_done_callback(lambda _: policy.tracker(function_name).record(time.perf_counter() - start))
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=policy.delay(function_name))
+        if done or not policy.can_hedge():
+            return await tasks[0]
+
+        policy.hedges += 1
+        tasks.append(asyncio.ensure_future((secondary or primary)()))
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is tasks[1]:
+                        policy.hedge_wins += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+class HedgedBamlClient:
+    '''
+    A BamlAsyncClient proxy hedging every BAML function call according to `policy`, with an
+    optional secondary client for the duplicate call.
+    '''
+    def __init__(self, baml_client, policy: HedgePolicy, secondary_client=None):
+        self._client = baml_client
+        self._policy = policy
+        self._secondary = secondary_client
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if not (name[:1].isupper() and asyncio.iscoroutinefunction(attr)):
+            return attr
+
+        async def call(*args, **kwargs):
+            secondary = None
+            if self._secondary is not None:
+                secondary = lambda: getattr(self._secondary, name)(*args, **kwargs)
+            return await hedged_call(name, lambda: attr(*args, **kwargs), self._policy, secondary)
+        return call
+
+
+def build_hedge_policy_from_env() -> HedgePolicy:
+    '''
+    Builds the hedge policy from the environment:
+
+    - HEDGE_PERCENTILE: latency percentile after which a duplicate is sent (default 0.95)
+    - HEDGE_BUDGET: maximum fraction of extra calls (default 0.1)
+    - HEDGE_DEFAULT_DELAY: delay in seconds used until enough latencies are known (default 2)
+    '''
+    return HedgePolicy(
+        percentile=float(os.getenv("HEDGE_PERCENTILE", "0.95")),
+        budget=float(os.getenv("HEDGE_BUDGET", "0.1")),
+        default_delay=float(os.getenv("HEDGE_DEFAULT_DELAY", "2")),
+    )
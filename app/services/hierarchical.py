@@ -0,0 +1,74 @@
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.schemas import ClassificationClass, ClassificationInput, HierarchicalClassificationInput, ThemeNode
+from app.services.categorize_query import categorize_query, categorize_with_confidence
+from baml_client.async_client import BamlAsyncClient
+
+
+async def _decide(
+    text: str,
+    nodes: Sequence[ThemeNode],
+    baml_client: BamlAsyncClient,
+    n: Optional[int],
+    adaptive: bool,
+    stop_confidence: Optional[float],
+) -> Dict[str, Any]:
+    '''Picks one of `nodes` for `text`, with a vote over `n` samples in confidence mode.'''
+    if len(nodes) == 1:
+        res = {"model_reasoning": "Only one theme at this level", "index": 0}
+        if n is not None:
+            res["confidence"] = 1.0
+        return res
+    level = ClassificationInput(
+        text=text, themes=[ClassificationClass(title=node.title, description=node.description) for node in nodes]
+    )
+    if n is None:
+        res = await categorize_query(level, baml_client)
+    else:
+        res = await categorize_with_confidence(level, baml_client, n, adaptive=adaptive, stop_confidence=stop_confidence)
+    chosen = (res["chosen_theme"]["title"], res["chosen_theme"]["description"])
+    res["index"] = next(i for i, node in enumerate(nodes) if (node.title, node.description) == chosen)
+    return res
+
+
+async def categorize_hierarchical(
+    data: HierarchicalClassificationInput,
+    baml_client: BamlAsyncClient,
+    n: Optional[int] = None,
+    adaptive: bool = False,
+    stop_confidence: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Categorizes a query into a tree of themes, coarse to fine: a first prompt picks a branch
+    among the top-level groups, the next one a theme among that branch's children, and so on
+    until a leaf. Each prompt only lists the children of one node, so with a balanced tree
+    the prompt size grows with the logarithm of the number of leaves.
+
+    With `n`, each level is decided by a vote over `n` samples (see
+    `categorize_with_confidence`) and the overall confidence is the product of the level
+    confidences.
+    """
+    nodes: Sequence[ThemeNode] = data.themes
+    path: List[Dict[str, Any]] = []
+    confidence = 1.0
+    while True:
+        decision = await _decide(data.text, nodes, baml_client, n, adaptive, stop_confidence)
+
+        node = nodes[decision["index"]]
+        step = {"title": node.title, "description": node.description, "model_reasoning": decision["model_reasoning"]}
+        if "confidence" in decision:
+            step["confidence"] = decision["confidence"]
+            confidence *= decision["confidence"]
+        path.append(step)
+        if not node.children:
+            break
+        nodes = node.children
+
+    res = {
+        "model_reasoning": path[-1]["model_reasoning"],
+        "chosen_theme": {"title": path[-1]["title"], "description": path[-1]["description"]},
+        "path": path,
+    }
+    if n is not None:
+        res["confidence"] = confidence
+    return res
@@ -0,0 +1,420 @@
+from contextlib import AbstractContextManager
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from app.schemas import ClassificationInput
+from app.services.categorize_query import categorize_query
+from app.services.generate_form import SCHEMA_CACHE, SchemaCache, fill_form, form_to_dict
+from baml_client.async_client import BamlAsyncClient
+
+JOB_KINDS = ("categorize", "extract")
+
+logger = logging.getLogger(__name__)
+
+CLAIM_QUERY = (
+    "SELECT rowid, job_id, line, payload, attempts FROM job_items "
+    "WHERE status = 'pending' AND not_before <= ? ORDER BY rowid LIMIT 1"
+)
+
+
+def read_jsonl(
+    lines: Iterable[str], validate: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None
+) -> Iterable[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]:
+    '''
+    Parses JSONL lazily. Yields (line number, item, error) for each non-blank line, with the
+    error set instead of the item when the line is not a JSON object with a "text", or when
+    `validate` returns an error for it.
+    '''
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(item, dict) or not isinstance(item.get("text"), str):
+            yield number, None, 'Each line must be an object with a "text"'
+            continue
+        error = validate(item) if validate is not None else None
+        if error is not None:
+            yield number, None, error
+            continue
+        yield number, item, None
+
+
+def missing_themes(item: Dict[str, Any]) -> Optional[str]:
+    '''Validates a line of a categorize job without job-level themes: it needs its own.'''
+    return None if item.get("themes") else 'Each line needs "themes" when the job has none'
+
+
+class JobStore:
+    '''
+    SQLite persistence of the bulk jobs: one row per job and one row per input line. Each line
+    keeps its status ("pending", "running", "done" or "dead"), so that a restarted worker pool
+    resumes from the lines not done yet.
+
+    Finished lines get an increasing `seq`, which orders results by completion for polling
+    and streaming. The line counts per status of each job are counted once, then kept up to
+    date in memory, so that progress polling does not rescan the job.
+    '''
+    def __init__(self, path: str, insert_batch_size: int = 1000):
+        self.path = path
+        self.insert_batch_size = insert_batch_size
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+                "params TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_items (job_id TEXT NOT NULL, line INTEGER NOT NULL, "
+                "payload TEXT, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "not_before REAL NOT NULL DEFAULT 0, result TEXT, error TEXT, seq INTEGER, "
+                "PRIMARY KEY (job_id, line))"
+            )
+            # Pending lines only, in rowid order: claim() reads the first runnable one without
+            # sorting the backlog. The (status, not_before) index made SQLite sort every pending
+            # line on each claim, so it is dropped from older files.
+            self._conn.execute("DROP INDEX IF EXISTS job_items_status")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS job_items_pending ON job_items (status) WHERE status = 'pending'")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS job_items_seq ON job_items (job_id, seq)")
+            # Lines that were running when the process stopped are picked up again.
+            self._conn.execute("UPDATE job_items SET status = 'pending' WHERE status = 'running'")
+            self._seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM job_items").fetchone()[0]
+
+    def create_job(
+        self,
+        kind: str,
+        params: Dict[str, Any],
+        lines: Iterable[str],
+        validate: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None,
+    ) -> str:
+        '''
+        Stores a job and its lines, inserted in batches so that large files are read lazily.
+        Lines `validate` rejects go straight to the dead letters, as malformed lines do.
+        '''
+        job_id = uuid.uuid4().hex[:16]
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, kind, params, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, kind, json.dumps(params), time.time()),
+            )
+            self._counts[job_id] = {"pending": 0, "running": 0, "done": 0, "dead": 0}
+        batch = []
+        for number, item, error in read_jsonl(lines, validate):
+            batch.append((number, item, error))
+            if len(batch) >= self.insert_batch_size:
+                self._insert_items(job_id, batch)
+                batch = []
+        self._insert_items(job_id, batch)
+        return job_id
+
+    def _insert_items(self, job_id: str, batch: List[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]):
+        with self._lock, self._conn:
+            for number, item, error in batch:
+                if error is None:
+                    self._conn.execute(
+                        "INSERT INTO job_items (job_id, line, payload, status) VALUES (?, ?, ?, 'pending')",
+                        (job_id, number, json.dumps(item)),
+                    )
+                    self._move(job_id, None, "pending")
+                else:
+                    # Malformed lines go straight to the dead letters.
+                    self._seq += 1
+                    self._conn.execute(
+                        "INSERT INTO job_items (job_id, line, status, error, seq) VALUES (?, ?, 'dead', ?, ?)",
+                        (job_id, number, error, self._seq),
+                    )
+                    self._move(job_id, None, "dead")
+
+    def _move(self, job_id: str, source: Optional[str], target: Optional[str], n: int = 1):
+        '''Updates the counts of a job whose counts are loaded; called with the lock held.'''
+        counts = self._counts.get(job_id)
+        if counts is None or not n:
+            return
+        if source is not None:
+            counts[source] -= n
+        if target is not None:
+            counts[target] += n
+
+    def job(self, job_id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            row = self._conn.execute("SELECT kind, params FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def claim(self) -> Optional[Tuple[str, int, Dict[str, Any], int]]:
+        '''Marks the oldest runnable line as running and returns (job id, line, item, attempts).'''
+        with self._lock, self._conn:
+            row = self._conn.execute(CLAIM_QUERY, (time.time(),)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE job_items SET status = 'running' WHERE rowid = ?", (row[0],))
+            self._move(row[1], "pending", "running")
+        return row[1], row[2], json.loads(row[3]), row[4]
+
+    def complete(self, job_id: str, line: int, result: Any):
+        with self._lock, self._conn:
+            self._seq += 1
+            updated = self._conn.execute(
+                "UPDATE job_items SET status = 'done', result = ?, error = NULL, seq = ? "
+                "WHERE job_id = ? AND line = ? AND status = 'running'",
+                (json.dumps(result, default=str), self._seq, job_id, line),
+            ).rowcount
+            self._move(job_id, "running", "done", updated)
+
+    def fail(self, job_id: str, line: int, error: str, retry_at: Optional[float]):
+        '''Records a failed attempt: the line is retried at `retry_at`, or dead-lettered without it.'''
+        with self._lock, self._conn:
+            if retry_at is not None:
+                updated = self._conn.execute(
+                    "UPDATE job_items SET status = 'pending', attempts = attempts + 1, error = ?, not_before = ? "
+                    "WHERE job_id = ? AND line = ? AND status = 'running'",
+                    (error, retry_at, job_id, line),
+                ).rowcount
+                self._move(job_id, "running", "pending", updated)
+            else:
+                self._seq += 1
+                updated = self._conn.execute(
+                    "UPDATE job_items SET status = 'dead', attempts = attempts + 1, error = ?, seq = ? "
+                    "WHERE job_id = ? AND line = ? AND status = 'running'",
+                    (error, self._seq, job_id, line),
+                ).rowcount
+                self._move(job_id, "running", "dead", updated)
+
+    def release(self, job_id: str, line: int):
+        '''Puts a line interrupted by a shutdown back in the queue, without counting an attempt.'''
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                "UPDATE job_items SET status = 'pending' WHERE job_id = ? AND line = ? AND status = 'running'",
+                (job_id, line),
+            ).rowcount
+            self._move(job_id, "running", "pending", updated)
+
+    def counts(self, job_id: str) -> Dict[str, int]:
+        with self._lock:
+            counts = self._counts.get(job_id)
+            if counts is None:
+                rows = self._conn.execute(
+                    "SELECT status, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+                ).fetchall()
+                counts = self._counts[job_id] = {"pending": 0, "running": 0, "done": 0, "dead": 0}
+                counts.update(rows)
+            return dict(counts)
+
+    def results(self, job_id: str, after: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        '''Returns the finished lines with a `seq` above `after`, in completion order.'''
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, line, status, result, error FROM job_items "
+                "WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (job_id, after, limit),
+            ).fetchall()
+        return [
+            {"seq": seq, "line": line, "status": status, "result": json.loads(result) if result is not None else None, "error": error}
+            for seq, line, status, result, error in rows
+        ]
+
+    def dead_letters(self, job_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT line, payload, attempts, error FROM job_items WHERE job_id = ? AND status = 'dead' ORDER BY line",
+                (job_id,),
+            ).fetchall()
+        return [
+            {"line": line, "item": json.loads(payload) if payload is not None else None, "attempts": attempts, "error": error}
+            for line, payload, attempts, error in rows
+        ]
+
+    def delete(self, job_id: str) -> bool:
+        with self._lock, self._conn:
+            deleted = self._conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,)).rowcount
+            self._conn.execute("DELETE FROM job_items WHERE job_id = ?", (job_id,))
+            self._counts.pop(job_id, None)
+        return bool(deleted)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+async def run_item(
+    kind: str,
+    item: Dict[str, Any],
+    params: Dict[str, Any],
+    b: BamlAsyncClient,
+    schema_cache: SchemaCache = SCHEMA_CACHE,
+) -> Dict[str, Any]:
+    '''Runs one line of a job: `categorize_query` or `fill_form`, as the HTTP endpoints do.'''
+    if kind == "categorize":
+        data = ClassificationInput(text=item["text"], themes=item.get("themes") or params["themes"])
+        return await categorize_query(data, b)
+    if kind == "extract":
+        return form_to_dict(await fill_form(item["text"], params["schema"], b, schema_cache))
+    raise ValueError(f"Unsupported job kind: {kind}")
+
+
+class JobQueue:
+    '''
+    Bulk classification and extraction jobs, run by a pool of `concurrency` asyncio workers
+    over a JobStore.
+
+    A failed line is retried up to `max_attempts` times, `retry_delay` seconds later, doubled
+    at each attempt; it then goes to the dead letters of its job. `client_factory(kind)`
+    returns a context manager yielding the BAML client of one line.
+    '''
+    def __init__(
+        self,
+        store: JobStore,
+        client_factory: Callable[[str], AbstractContextManager],
+        concurrency: int = 4,
+        max_attempts: int = 3,
+        retry_delay: float = 1.0,
+        poll_interval: float = 0.5,
+        schema_cache: SchemaCache = SCHEMA_CACHE,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.store = store
+        self.client_factory = client_factory
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.schema_cache = schema_cache
+        self.processed = 0
+        self.retried = 0
+        self.dead = 0
+        self._workers: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def submit(self, kind: str, lines: Iterable[str], params: Optional[Dict[str, Any]] = None) -> str:
+        '''
+        Stores a job from JSONL lines (a file object is read lazily) and returns its id. In a
+        categorize job without `themes`, each line must carry its own.
+        '''
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unsupported job kind: {kind}")
+        params = params or {}
+        validate = missing_themes if kind == "categorize" and not params.get("themes") else None
+        job_id = await asyncio.to_thread(self.store.create_job, kind, params, lines, validate)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def start(self):
+        '''Starts the workers in the running event loop; pending lines of earlier runs resume.'''
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _work(self):
+        while True:
+            try:
+                claimed = await asyncio.to_thread(self.store.claim)
+            except Exception:
+                logger.exception("Could not claim a job line, retrying")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if claimed is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, line, item, attempts = claimed
+            try:
+                await self._run(job_id, line, item, attempts)
+            except asyncio.CancelledError:
+                self.store.release(job_id, line)
+                raise
+            except Exception:
+                # The line is put back in the queue; if the store is still failing, it stays
+                # running until the next restart resets it.
+                logger.exception("Could not record line %s of job %s, retrying", line, job_id)
+                try:
+                    await asyncio.to_thread(self.store.release, job_id, line)
+                except Exception:
+                    logger.exception("Could not release line %s of job %s", line, job_id)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run(self, job_id: str, line: int, item: Dict[str, Any], attempts: int):
+        job = await asyncio.to_thread(self.store.job, job_id)
+        if job is None:
+            return
+        kind, params = job
+        try:
+            with self.client_factory(kind) as b:
+                result = await run_item(kind, item, params, b, self.schema_cache)
+        except Exception as e:
+            if attempts + 1 < self.max_attempts:
+                self.retried += 1
+                await asyncio.to_thread(self.store.fail, job_id, line, repr(e), time.time() + self.retry_delay * 2 ** attempts)
+            else:
+                self.dead += 1
+                await asyncio.to_thread(self.store.fail, job_id, line, repr(e), None)
+            return
+        await asyncio.to_thread(self.store.complete, job_id, line, result)
+        self.processed += 1
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await asyncio.to_thread(self.store.job, job_id)
+        if job is None:
+            return None
+        counts = await asyncio.to_thread(self.store.counts, job_id)
+        finished = counts["pending"] == 0 and counts["running"] == 0
+        return {"job_id": job_id, "kind": job[0], "state": "finished" if finished else "running", **counts}
+
+    async def stream(self, job_id: str, after: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        '''Yields the results of `job_id` as lines finish, until the whole job is finished.'''
+        while True:
+            results = await asyncio.to_thread(self.store.results, job_id, after)
+            for result in results:
+                yield result
+                after = result["seq"]
+            if not results:
+                status = await self.status(job_id)
+                if status is None or status["state"] == "finished":
+                    return
+                await asyncio.sleep(self.poll_interval)
+
+    def stats(self) -> Dict[str, int]:
+        return {"workers": len(self._workers), "processed": self.processed, "retried": self.retried, "dead": self.dead}
+
+
+def build_job_queue_from_env(
+    client_factory: Callable[[str], AbstractContextManager], schema_cache: SchemaCache = SCHEMA_CACHE
+) -> JobQueue:
+    '''
+    Builds the bulk job queue from the environment:
+
+    - JOB_QUEUE_PATH: SQLite file path (default "jobs.sqlite3")
+    - JOB_CONCURRENCY: number of workers (default 4)
+    - JOB_MAX_ATTEMPTS: attempts per line before it is dead-lettered (default 3)
+    - JOB_RETRY_DELAY: seconds before the first retry, doubled at each attempt (default 1)
+    '''
+    return JobQueue(
+        JobStore(os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3")),
+        client_factory,
+        concurrency=int(os.getenv("JOB_CONCURRENCY", "4")),
+        max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+        retry_delay=float(os.getenv("JOB_RETRY_DELAY", "1")),
+        schema_cache=schema_cache,
+    )
@@ -0,0 +1,178 @@
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import argparse
+import json
+import math
+import random
+import sys
+import zlib
+
+from app.schemas import ClassificationClass
+from app.services.shortlist import tokenize
+
+MAGIC = b"LCLF1\n"
+
+
+def hashed_features(text: str, n_features: int) -> Dict[int, float]:
+    '''
+    Hashes the unigrams and bigrams of `text` into `n_features` buckets and L2-normalizes them.
+
+    crc32 is used instead of hash() because the latter is randomized per process.
+    '''
+    tokens = tokenize(text)
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    counts = Counter(zlib.crc32(gram.encode("utf-8")) % n_features for gram in grams)
+    norm = math.sqrt(sum(value * value for value in counts.values())) or 1.0
+    return {index: value / norm for index, value in counts.items()}
+
+
+class LocalClassifier:
+    '''
+    A hashed n-gram multinomial logistic regression, used to answer easy queries without
+    calling the LLM. Labels are theme titles.
+    '''
+    def __init__(self, labels: List[str], n_features: int, weights: array, bias: array):
+        assert len(weights) == len(labels) * n_features
+        assert len(bias) == len(labels)
+        self.labels = labels
+        self.n_features = n_features
+        self.weights = weights
+        self.bias = bias
+        self._label_index = {label: i for i, label in enumerate(labels)}
+
+    def _scores(self, features: Dict[int, float], label_indexes: Sequence[int]) -> List[float]:
+        scores = []
+        for label in label_indexes:
+            offset = label * self.n_features
+            scores.append(self.bias[label] + sum(self.weights[offset + f] * x for f, x in features.items()))
+        return scores
+
+    @staticmethod
+    def _softmax(scores: List[float]) -> List[float]:
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        total = sum(exps)
+        return [value / total for value in exps]
+
+    def predict_proba(self, text: str, labels: Optional[Sequence[str]] = None) -> Dict[str, float]:
+        '''Returns the probability of each label, restricted to `labels` if given.'''
+        label_indexes = [self._label_index[label] for label in labels] if labels is not None else range(len(self.labels))
+        probabilities = self._softmax(self._scores(hashed_features(text, self.n_features), label_indexes))
+        return {self.labels[label]: p for label, p in zip(label_indexes, probabilities)}
+
+    def classify(self, text: str, themes: Sequence[ClassificationClass], threshold: float) -> Optional[Tuple[int, float]]:
+        '''
+        Returns the index of the chosen theme and its probability, or None when the model does
+        not know every theme of the request or is not confident enough.
+        '''
+        titles = [theme.title for theme in themes]
+        if not titles or any(title not in self._label_index for title in titles):
+            return None
+        probabilities = self.predict_proba(text, titles)
+        best = max(range(len(titles)), key=lambda i: probabilities[titles[i]])
+        confidence = probabilities[titles[best]]
+        if confidence < threshold:
+            return None
+        return best, confidence
+
+    @classmethod
+    def train(
+        cls,
+        examples: Iterable[Tuple[str, str]],
+        n_features: int = 2 ** 16,
+        epochs: int = 5,
+        learning_rate: float = 0.5,
+        l2: float = 1e-6,
+        seed: int = 0,
+    ) -> "LocalClassifier":
+        '''Trains the model with plain SGD on (text, theme title) pairs.'''
+        examples = list(examples)
+        labels = sorted({label for _, label in examples})
+        label_index = {label: i for i, label in enumerate(labels)}
+        weights = array("f", bytes(4 * len(labels) * n_features))
+        bias = array("f", bytes(4 * len(labels)))
+        model = cls(labels, n_features, weights, bias)
+
+        samples = [(hashed_features(text, n_features), label_index[label]) for text, label in examples]
+        rng = random.Random(seed)
+        all_labels = range(len(labels))
+        for epoch in range(epochs):
+            rng.shuffle(samples)
+            rate = learning_rate / (1 + epoch)
+            for features, target in samples:
+                probabilities = cls._softmax(model._scores(features, all_labels))
+                for label, p in enumerate(probabilities):
+                    gradient = p - (1.0 if label == target else 0.0)
+                    offset = label * n_features
+                    for f, x in features.items():
+                        weights[offset + f] -= rate * (gradient * x + l2 * weights[offset + f])
+                    bias[label] -= rate * gradient
+        return model
+
+    def save(self, path: str):
+        header = json.dumps({"labels": self.labels, "n_features": self.n_features}).encode("utf-8")
+        weights, bias = self.weights, self.bias
+        if sys.byteorder != "little":
+            weights, bias = array("f", weights), array("f", bias)
+            weights.byteswap()
+            bias.byteswap()
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(4, "little"))
+            f.write(header)
+            f.write(bias.tobytes())
+            f.write(weights.tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> "LocalClassifier":
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a local classifier file")
+            header = json.loads(f.read(int.from_bytes(f.read(4), "little")))
+            labels, n_features = header["labels"], header["n_features"]
+            bias = array("f")
+            bias.frombytes(f.read(4 * len(labels)))
+            weights = array("f")
+            weights.frombytes(f.read(4 * len(labels) * n_features))
+        if sys.byteorder != "little":
+            bias.byteswap()
+            weights.byteswap()
+        return cls(labels, n_features, weights, bias)
+
+
+def read_training_examples(path: str) -> Iterable[Tuple[str, str]]:
+    '''
+    Reads logged (text, chosen_theme) pairs from a JSONL file. `chosen_theme` may be a title or
+    the theme object returned by /categorize/.
+    '''
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            theme = record["chosen_theme"]
+            yield record["text"], theme["title"] if isinstance(theme, dict) else theme
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local fast-path classifier from logged pairs.")
+    parser.add_argument("input", help="JSONL file with text and chosen_theme on each line")
+    parser.add_argument("output", help="Path of the model file to write")
+    parser.add_argument("--n-features", type=int, default=2 ** 16)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--learning-rate", type=float, default=0.5)
+    args = parser.parse_args()
+
+    model = LocalClassifier.train(
+        read_training_examples(args.input),
+        n_features=args.n_features,
+        epochs=args.epochs,
+        learning_rate=args.learning_rate,
+    )
+    model.save(args.output)
+    print(f"Trained {len(model.labels)} labels, {args.n_features} features -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+
+class Histogram:
+    '''
+    A cumulative histogram in the Prometheus sense. Observations only increment plain counters,
+    so no lock is taken on the request path (all observations happen on the event loop).
+    '''
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels: str) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    '''
+    Counters and histograms of the BAML calls, rendered in the Prometheus text format.
+    '''
+    def __init__(self):
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+
+    def counter(self, name: str, help_: str):
+        self._help[name] = ("counter", help_)
+        self._counters.setdefault(name, {})
+
+    def histogram(self, name: str, help_: str, buckets: Iterable[float]):
+        self._help[name] = ("histogram", help_)
+        self._histograms.setdefault(name, {})
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        series = self._counters[name]
+        key = _labels(**labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        series = self._histograms[name]
+        key = _labels(**labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self._buckets[name])
+        histogram.observe(value)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, (kind, help_) in self._help.items():
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for labels, value in list(self._counters[name].items()):
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            for labels, histogram in list(self._histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_value(float(bound))))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def build_baml_metrics() -> MetricsRegistry:
+    metrics = MetricsRegistry()
+    metrics.counter("baml_calls_total", "BAML function calls.")
+    metrics.counter("baml_input_tokens_total", "Input tokens sent to the provider.")
+    metrics.counter("baml_output_tokens_total", "Output tokens returned by the provider.")
+    metrics.counter("baml_retries_total", "Provider calls beyond the first one of a BAML function call.")
+    metrics.histogram("baml_input_tokens", "Input tokens per BAML function call.", TOKEN_BUCKETS)
+    metrics.histogram("baml_output_tokens", "Output tokens per BAML function call.", TOKEN_BUCKETS)
+    metrics.histogram("baml_provider_latency_seconds", "Duration of BAML function calls.", LATENCY_BUCKETS)
+    metrics.histogram(
+        "baml_time_to_first_token_seconds", "Time to the first parsed chunk of a stream.", LATENCY_BUCKETS
+    )
+    return metrics
+
+
+def record_collector(metrics: MetricsRegistry, collector, endpoint: str):
+    '''Harvests the function logs of a BAML Collector into `metrics`.'''
+    for log in collector.logs:
+        function = log.function_name
+        metrics.inc("baml_calls_total", endpoint=endpoint, function=function)
+
+        usage = log.usage
+        if usage.input_tokens is not None:
+            metrics.inc("baml_input_tokens_total", usage.input_tokens, endpoint=endpoint, function=function)
+            metrics.observe("baml_input_tokens", usage.input_tokens, endpoint=endpoint, function=function)
+        if usage.output_tokens is not None:
+            metrics.inc("baml_output_tokens_total", usage.output_tokens, endpoint=endpoint, function=function)
+            metrics.observe("baml_output_tokens", usage.output_tokens, endpoint=endpoint, function=function)
+
+        if log.timing.duration_ms is not None:
+            metrics.observe(
+                "baml_provider_latency_seconds", log.timing.duration_ms / 1000, endpoint=endpoint, function=function
+            )
+
+        retries = max(len(log.calls) - 1, 0)
+        if retries:
+            metrics.inc("baml_retries_total", retries, endpoint=endpoint, function=function)
+
+        # BAML times the first parsed chunk of a stream, which follows the first token closely.
+        if log.log_type == "stream" and log.timing.time_to_first_parsed_ms is not None:
+            metrics.observe(
+                "baml_time_to_first_token_seconds", log.timing.time_to_first_parsed_ms / 1000,
+                endpoint=endpoint, function=function,
+            )
+
+
+def render_gauges(prefix: str, stats: Dict, label: Optional[str] = None) -> str:
+    '''
+    Renders a stats dict (as returned by the caches and the admission controller) as
+    Prometheus gauges. Nested dicts are labelled with `label`.
+    '''
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, dict) and label is not None:
+            for name, inner in value.items():
+                if isinstance(inner, (int, float)):
+                    lines.append(f"{prefix}_{name}{_format_labels(_labels(**{label: key}))} {_format_value(inner)}")
+        elif isinstance(value, (int, float)):
+            lines.append(f"{prefix}_{key} {_format_value(value)}")
+    return "\n".join(lines) + ("\n" if lines else "")
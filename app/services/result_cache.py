@@ -0,0 +1,196 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def normalize_text(text: str) -> str:
+    '''Collapses whitespace so that trivially different resends share a cache entry.'''
+    return " ".join(text.split())
+
+
+def cache_key(endpoint: str, text: str, context: Any) -> str:
+    '''
+    Returns the cache key of a request: the endpoint, the normalized text and the request
+    context (theme list, schema hash...).
+    '''
+    payload = json.dumps([endpoint, normalize_text(text), context], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    '''
+    An in-memory LRU backend. Values are stored as JSON strings so that callers never share
+    mutable results.
+    '''
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCacheBackend:
+    '''
+    An on-disk backend backed by SQLite, so that cached results survive restarts.
+    '''
+    def __init__(self, path: str, table: str = "result_cache"):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table}")
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < time.time():
+                with self._conn:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return None
+            return value
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResultCache:
+    '''
+    Caches deterministic endpoint results with a TTL per endpoint.
+
+    Only use it for the temperature 0 client: sampled results (e.g. /categorize-score/) must
+    never be cached. An endpoint without a TTL is not cached.
+    '''
+    def __init__(self, backend, ttls: Dict[str, float]):
+        self.backend = backend
+        self.ttls = ttls
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, endpoint: str, name: str):
+        with self._lock:
+            counters = self._counters.setdefault(endpoint, {"hits": 0, "misses": 0, "bypasses": 0})
+            counters[name] += 1
+
+    async def get_or_compute(
+        self,
+        endpoint: str,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        cache_control: Optional[str] = None,
+    ) -> Tuple[Any, str]:
+        '''
+        Returns the cached result for `key`, or computes and stores it.
+
+        `cache_control` follows the Cache-Control request header: "no-cache" skips the lookup
+        but refreshes the entry, "no-store" skips the cache entirely. The second element of the
+        returned tuple is "HIT", "MISS" or "BYPASS".
+
+        Backend reads and writes run in a thread, so that a SQLite backend does not block
+        the event loop.
+        '''
+        ttl = self.ttls.get(endpoint)
+        directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+        if not ttl or "no-store" in directives:
+            self._count(endpoint, "bypasses")
+            return await compute(), "BYPASS"
+
+        if "no-cache" not in directives:
+            cached = await asyncio.to_thread(self.backend.get, key)
+            if cached is not None:
+                self._count(endpoint, "hits")
+                return json.loads(cached), "HIT"
+
+        self._count(endpoint, "misses")
+        value = await compute()
+        await asyncio.to_thread(self.backend.set, key, json.dumps(value), ttl)
+        return value, "MISS"
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            stats = {}
+            for endpoint, counters in self._counters.items():
+                lookups = counters["hits"] + counters["misses"]
+                stats[endpoint] = dict(counters, hit_rate=counters["hits"] / lookups if lookups else 0.0)
+            return stats
+
+
+def build_result_cache_from_env() -> ResultCache:
+    '''
+    Builds the result cache from the environment:
+
+    - RESULT_CACHE_BACKEND: "none" (default), "memory" or "sqlite"
+    - RESULT_CACHE_PATH: SQLite file path (default "result_cache.sqlite3")
+    - RESULT_CACHE_MAX_SIZE: number of entries kept by the memory backend (default 1024)
+    - RESULT_CACHE_TTL_CATEGORIZE / RESULT_CACHE_TTL_EXTRACT: TTLs in seconds (default 3600)
+    '''
+    kind = os.getenv("RESULT_CACHE_BACKEND", "none").lower()
+    if kind == "none":
+        return ResultCache(MemoryCacheBackend(max_size=1), ttls={})
+    if kind == "memory":
+        backend = MemoryCacheBackend(max_size=int(os.getenv("RESULT_CACHE_MAX_SIZE", "1024")))
+    elif kind == "sqlite":
+        backend = SQLiteCacheBackend(os.getenv("RESULT_CACHE_PATH", "result_cache.sqlite3"))
+    else:
+        raise ValueError(f"Unsupported result cache backend: {kind}")
+    return ResultCache(backend, ttls={
+        "categorize": float(os.getenv("RESULT_CACHE_TTL_CATEGORIZE", "3600")),
+        "extract": float(os.getenv("RESULT_CACHE_TTL_EXTRACT", "3600")),
+    })
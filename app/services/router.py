@@ -0,0 +1,244 @@
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import json
+import os
+import random
+import time
+
+
+class CircuitBreaker:
+    '''
+    Opens after `failure_threshold` consecutive failures and lets a single trial call through
+    once `reset_timeout` seconds have passed (half-open). A successful trial closes it again.
+    '''
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            now = time.monotonic()
+            # A trial that never reported back (e.g. cancelled) does not block the backend forever.
+            if not self._trial_in_flight or now - self._trial_started >= self.reset_timeout:
+                self._trial_in_flight = True
+                self._trial_started = now
+                return True
+        return False
+
+    def record(self, ok: bool):
+        if ok:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class BackendStats:
+    '''Exponentially weighted moving averages of the latency and error rate of a backend.'''
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, latency: float, ok: bool):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+        else:
+            self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        self.error_rate = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * self.error_rate
+
+
+class Router:
+    '''
+    Picks a backend per call: the one with the lowest latency average penalized by its error
+    rate, among the backends whose circuit breaker allows calls. Backends never called yet
+    are tried first; backends without any successful call come last, by error rate.
+    '''
+    def __init__(
+        self,
+        backends: List[str],
+        error_penalty: float = 4.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        if not backends:
+            raise ValueError("At least one backend is required")
+        self.backends = list(backends)
+        self.error_penalty = error_penalty
+        self.stats = {name: BackendStats() for name in backends}
+        self.breakers = {name: CircuitBreaker(failure_threshold, reset_timeout) for name in backends}
+        self.decisions = {name: 0 for name in backends}
+
+    def _score(self, name: str) -> Tuple[int, float]:
+        stats = self.stats[name]
+        if stats.calls == 0:
+            return (0, 0.0)
+        if stats.latency is None:
+            return (2, stats.error_rate)
+        return (1, stats.latency * (1 + self.error_penalty * stats.error_rate))
+
+    def choose(self, exclude: Optional[set] = None) -> Optional[str]:
+        exclude = exclude or set()
+        candidates = [name for name in self.backends if name not in exclude]
+        for name in sorted(candidates, key=self._score):
+            if self.breakers[name].allow():
+                self.decisions[name] += 1
+                return name
+        return None
+
+    def record(self, name: str, latency: float, ok: bool):
+        self.stats[name].record(latency, ok)
+        self.breakers[name].record(ok)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "state": self.breakers[name].state,
+                "latency_ewma": self.stats[name].latency,
+                "error_rate_ewma": self.stats[name].error_rate,
+                "calls": self.stats[name].calls,
+                "errors": self.stats[name].errors,
+                "decisions": self.decisions[name],
+            }
+            for name in self.backends
+        }
+
+
+class NoBackendAvailable(RuntimeError):
+    pass
+
+
+def backoff_delay(attempt: int, base: float = 0.2, cap: float = 5.0) -> float:
+    '''Exponential backoff with full jitter.'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RoutedStream:
+    '''
+    Wraps a BamlStream sent to `backend`, and reports its outcome to the router once it has
+    been consumed or has failed.
+    '''
+    def __init__(self, stream, router: Router, backend: str):
+        self._stream = stream
+        self._router = router
+        self._backend = backend
+        self._start = time.perf_counter()
+        self._recorded = False
+
+    def _record(self, ok: bool):
+        if not self._recorded:
+            self._recorded = True
+            self._router.record(self._backend, time.perf_counter() - self._start, ok)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True)
+
+    async def get_final_response(self):
+        try:
+            response = await self._stream.get_final_response()
+        except Exception:
+            self._record(False)
+            raise
+        self._record(True)
+        return response
+
+
+class _RoutedStreamClient:
+    def __init__(self, router: Router, clients: Dict[str, Any]):
+        self._router = router
+        self._clients = clients
+
+    def __getattr__(self, name: str):
+        def call(*args, **kwargs):
+            backend = self._router.choose()
+            if backend is None:
+                raise NoBackendAvailable("Every backend circuit breaker is open")
+            return RoutedStream(getattr(self._clients[backend].stream, name)(*args, **kwargs), self._router, backend)
+        return call
+
+
+class RoutedBamlClient:
+    '''
+    A BamlAsyncClient proxy sending each BAML function call to the backend chosen by `router`,
+    and retrying failed calls on another backend with jittered exponential backoff.
+    '''
+    def __init__(self, router: Router, clients: Dict[str, Any], max_attempts: int = 3):
+        self._router = router
+        self._clients = clients
+        self._max_attempts = max_attempts
+
+    @property
+    def stream(self):
+        return _RoutedStreamClient(self._router, self._clients)
+
+    def __getattr__(self, name: str):
+        default = self._clients[self._router.backends[0]]
+        attr = getattr(default, name)
+        if not (name[:1].isupper() and asyncio.iscoroutinefunction(attr)):
+            return attr
+
+        async def call(*args, **kwargs):
+            tried = set()
+            error: Optional[BaseException] = None
+            for attempt in range(self._max_attempts):
+                backend = self._router.choose(exclude=tried) or self._router.choose()
+                if backend is None:
+                    break
+                tried.add(backend)
+                start = time.perf_counter()
+                try:
+                    result = await getattr(self._clients[backend], name)(*args, **kwargs)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._router.record(backend, time.perf_counter() - start, ok=False)
+                    error = e
+                    if attempt + 1 < self._max_attempts:
+                        await asyncio.sleep(backoff_delay(attempt))
+                    continue
+                self._router.record(backend, time.perf_counter() - start, ok=True)
+                return result
+            if error is not None:
+                raise error
+            raise NoBackendAvailable("Every backend circuit breaker is open")
+        return call
+
+
+def load_backends_from_env() -> List[Dict[str, Any]]:
+    '''
+    Reads the OpenAI-compatible backends from PROVIDER_BACKENDS, a JSON list such as
+    [{"name": "nebius", "base_url": "https://api.studio.nebius.com/v1/",
+      "model": "meta-llama/Meta-Llama-3.1-70B-Instruct", "api_key_env": "NEBIUS_API_KEY"}].
+    An empty list (the default) disables routing.
+    '''
+    backends = json.loads(os.getenv("PROVIDER_BACKENDS", "[]"))
+    for backend in backends:
+        if "name" not in backend or "base_url" not in backend or "model" not in backend:
+            raise ValueError(f"Backends need a name, a base_url and a model: {backend}")
+    return backends
@@ -0,0 +1,107 @@
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import os
+import threading
+
+from app.services.generate_form import SCHEMA_CACHE, SchemaCache, compile_schema, count_fields, schema_key
+from baml_client.type_builder import TypeBuilder
+
+
+class InvalidSchema(ValueError):
+    pass
+
+
+class SchemaRegistry:
+    '''
+    Form schemas registered once and precompiled into their TypeBuilder, so that extraction
+    requests only carry a schema id.
+
+    Schema ids are content hashes, so registering the same schema twice returns the same id.
+    With `directory`, registered schemas are saved as JSON files and compiled again at start.
+    The registry can be passed to fill_form as its schema cache: registered schemas use their
+    precompiled TypeBuilder, other schemas (e.g. sub-forms) fall back to `fallback`.
+    '''
+    def __init__(self, directory: Optional[str] = None, fallback: SchemaCache = SCHEMA_CACHE):
+        self.directory = directory
+        self.fallback = fallback
+        self._schemas: Dict[str, Dict[str, Any]] = {}
+        self._keys: Dict[str, str] = {}
+        self._type_builders: Dict[str, TypeBuilder] = {}
+        # id() of the registered schema objects, so that lookups of those skip hashing.
+        self._by_object: Dict[int, Tuple[Dict[str, Any], TypeBuilder]] = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".json"):
+                    with open(os.path.join(directory, name), "r") as f:
+                        self.register(json.load(f), schema_id=name[:-len(".json")], persist=False)
+
+    def register(self, json_schema: Dict[str, Any], schema_id: Optional[str] = None, persist: bool = True) -> str:
+        '''Validates and compiles `json_schema`, and returns its id.'''
+        if not isinstance(json_schema, dict) or json_schema.get("type") != "object" or not json_schema.get("properties"):
+            raise InvalidSchema("A form schema must be an object with properties")
+        if not json_schema.get("title"):
+            raise InvalidSchema("A form schema needs a title")
+        try:
+            tb = compile_schema(json_schema)
+        except Exception as e:
+            raise InvalidSchema(f"Unsupported schema: {e}") from e
+
+        key = schema_key(json_schema)
+        schema_id = schema_id or key[:16]
+        with self._lock:
+            self._schemas[schema_id] = json_schema
+            self._keys[schema_id] = key
+            self._type_builders[key] = tb
+            self._by_object[id(json_schema)] = (json_schema, tb)
+        if persist and self.directory:
+            with open(os.path.join(self.directory, f"{schema_id}.json"), "w") as f:
+                json.dump(json_schema, f)
+        return schema_id
+
+    def schema(self, schema_id: str) -> Optional[Dict[str, Any]]:
+        return self._schemas.get(schema_id)
+
+    def key(self, schema_id: str) -> Optional[str]:
+        '''Returns the content hash of a registered schema.'''
+        return self._keys.get(schema_id)
+
+    def get(self, json_schema: Dict[str, Any]) -> TypeBuilder:
+        '''Returns the precompiled TypeBuilder of a registered schema (SchemaCache interface).'''
+        entry = self._by_object.get(id(json_schema))
+        if entry is not None and entry[0] is json_schema:
+            return entry[1]
+        tb = self._type_builders.get(schema_key(json_schema))
+        if tb is None:
+            return self.fallback.get(json_schema)
+        return tb
+
+    def describe(self, schema_id: str) -> Optional[Dict[str, Any]]:
+        json_schema = self._schemas.get(schema_id)
+        if json_schema is None:
+            return None
+        return {"schema_id": schema_id, "title": json_schema["title"], "fields": count_fields(json_schema)}
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [self.describe(schema_id) for schema_id in list(self._schemas)]
+
+    def delete(self, schema_id: str) -> bool:
+        with self._lock:
+            json_schema = self._schemas.pop(schema_id, None)
+            if json_schema is None:
+                return False
+            self._keys.pop(schema_id, None)
+            self._by_object.pop(id(json_schema), None)
+            key = schema_key(json_schema)
+            # Another id may still point to the same content.
+            if all(schema_key(other) != key for other in self._schemas.values()):
+                self._type_builders.pop(key, None)
+        if self.directory:
+            path = os.path.join(self.directory, f"{schema_id}.json")
+            if os.path.exists(path):
+                os.remove(path)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {"schemas": len(self._schemas), "compiled": len(self._type_builders)}
@@ -0,0 +1,135 @@
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Sequence, Tuple
+import argparse
+import json
+import math
+import re
+import threading
+import unicodedata
+
+from app.schemas import ClassificationClass
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _stem(token: str) -> str:
+    # Crude plural folding, enough for "sinistres" to match "sinistre".
+    if len(token) > 3 and token[-1] in "sx":
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    '''Lowercases, strips accents and plurals, and splits a text into word tokens.'''
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return [_stem(token) for token in _TOKEN_RE.findall(text) if len(token) > 1]
+
+
+class ThemeIndex:
+    '''
+    A BM25 index over the title and description of a list of themes.
+    '''
+    def __init__(self, themes: Sequence[ClassificationClass], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs = [Counter(tokenize(f"{theme.title} {theme.description}")) for theme in themes]
+        self._lengths = [sum(doc.values()) for doc in self._docs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        document_frequency = Counter(token for doc in self._docs for token in doc)
+        n = len(self._docs)
+        self._idf = {
+            token: math.log(1 + (n - df + 0.5) / (df + 0.5)) for token, df in document_frequency.items()
+        }
+
+    def scores(self, text: str) -> List[float]:
+        query = [token for token in set(tokenize(text)) if token in self._idf]
+        scores = []
+        for doc, length in zip(self._docs, self._lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self._avg_length) if self._avg_length else self.k1
+            score = 0.0
+            for token in query:
+                tf = doc.get(token, 0)
+                if tf:
+                    score += self._idf[token] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def top_k(self, text: str, k: int) -> List[int]:
+        '''
+        Returns the indexes of the `k` best matching themes, in their original order so that
+        the prompt keeps the caller's theme ordering.
+        '''
+        scores = self.scores(text)
+        best = sorted(range(len(scores)), key=lambda i: (-scores[i], i))[:k]
+        return sorted(best)
+
+
+class ThemeIndexCache:
+    '''
+    A bounded LRU cache of ThemeIndex, keyed by the theme set.
+    '''
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[Tuple[str, str], ...], ThemeIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, themes: Sequence[ClassificationClass]) -> ThemeIndex:
+        key = tuple((theme.title, theme.description) for theme in themes)
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+                return index
+
+        index = ThemeIndex(themes)
+        with self._lock:
+            self._entries[key] = index
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return index
+
+
+THEME_INDEX_CACHE = ThemeIndexCache()
+
+
+def shortlist_themes(text: str, themes: Sequence[ClassificationClass], k: int) -> List[int]:
+    '''Returns the indexes of the `k` themes most lexically similar to `text`.'''
+    if k >= len(themes):
+        return list(range(len(themes)))
+    return THEME_INDEX_CACHE.get(themes).top_k(text, k)
+
+
+def shortlist_recall(examples: Iterable[Dict], ks: Sequence[int]) -> Dict[int, float]:
+    '''
+    Measures, for each k, how often the labeled theme is kept in the shortlist.
+
+    Each example is a dict with "text", "themes" and "chosen_theme" (the expected title).
+    '''
+    kept = {k: 0 for k in ks}
+    total = 0
+    for example in examples:
+        themes = [ClassificationClass(**theme) for theme in example["themes"]]
+        titles = [theme.title for theme in themes]
+        expected = titles.index(example["chosen_theme"])
+        total += 1
+        for k in ks:
+            if expected in shortlist_themes(example["text"], themes, k):
+                kept[k] += 1
+    return {k: (kept[k] / total if total else 0.0) for k in ks}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report shortlist recall on a labeled JSONL file.")
+    parser.add_argument("path", help="JSONL file with text, themes and chosen_theme on each line")
+    parser.add_argument("--k", type=int, nargs="+", default=[5, 10, 20, 50])
+    args = parser.parse_args()
+
+    with open(args.path, "r") as f:
+        recall = shortlist_recall((json.loads(line) for line in f if line.strip()), args.k)
+    for k, value in recall.items():
+        print(f"k={k}\trecall={value:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+class SingleFlight:
+    '''
+    Deduplicates identical in-flight calls: the first caller for a key starts the call, later
+    callers with the same key await the same task.
+
+    A caller being cancelled (e.g. a client disconnecting) does not cancel the shared call
+    while other callers still wait on it. The call is only cancelled once every caller is gone.
+    Calls are only shared within one event loop.
+    '''
+    def __init__(self):
+        self._calls: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Task] = {}
+        self._waiters: Dict[Tuple[asyncio.AbstractEventLoop, str], int] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        key = (asyncio.get_running_loop(), key)
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(compute())
+            self._calls[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda _, key=key, task=task: self._forget(key, task))
+        else:
+            self.coalesced += 1
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(key) == 1:
+                task.cancel()
+            raise
+        finally:
+            if self._calls.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _forget(self, key: Tuple[asyncio.AbstractEventLoop, str], task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            del self._waiters[key]
+        if not task.cancelled():
+            # Retrieve the exception so that it is not reported as never retrieved when
+            # every caller is gone.
+            task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
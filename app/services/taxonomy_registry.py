@@ -0,0 +1,105 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import hashlib
+import json
+import os
+import threading
+
+from app.schemas import ClassificationClass
+
+
+def render_catalog(titles: Sequence[str], descriptions: Sequence[str]) -> str:
+    '''Renders the category block of CategorizeWithCatalog, as the Jinja loop of CategorizeFeedback does.'''
+    lines = [f"Category {i}: {title} // {description}" for i, (title, description) in enumerate(zip(titles, descriptions), start=1)]
+    lines.append(f"The categories are numbered from 1 to {len(lines)}.")
+    return "\n".join(lines)
+
+
+def taxonomy_key(titles: Sequence[str], descriptions: Sequence[str]) -> str:
+    '''Returns a content hash of a theme list, order included (it defines the category numbers).'''
+    canonical = json.dumps([list(titles), list(descriptions)], separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class Taxonomy:
+    '''
+    A registered theme list. Titles and descriptions are kept as two tuples, so that a
+    category number maps back to its theme by index, and the category block of the prompt is
+    rendered once.
+    '''
+    __slots__ = ("taxonomy_id", "key", "titles", "descriptions", "catalog")
+
+    def __init__(self, taxonomy_id: str, titles: Sequence[str], descriptions: Sequence[str]):
+        self.taxonomy_id = taxonomy_id
+        self.titles: Tuple[str, ...] = tuple(titles)
+        self.descriptions: Tuple[str, ...] = tuple(descriptions)
+        self.key = taxonomy_key(self.titles, self.descriptions)
+        self.catalog = render_catalog(self.titles, self.descriptions)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def theme(self, category: int) -> Dict[str, str]:
+        '''Returns the theme of a 1-based category number.'''
+        if not 1 <= category <= len(self.titles):
+            raise ValueError(f"Unknown category {category} for taxonomy {self.taxonomy_id}")
+        return {"title": self.titles[category - 1], "description": self.descriptions[category - 1]}
+
+    def themes(self) -> List[ClassificationClass]:
+        return [ClassificationClass(title=title, description=description) for title, description in zip(self.titles, self.descriptions)]
+
+
+class TaxonomyRegistry:
+    '''
+    Theme lists registered once for /categorize/{taxonomy_id}. Ids are content hashes, so
+    registering the same list twice returns the same id. With `directory`, registered
+    taxonomies are saved as JSON files and loaded again at start.
+    '''
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self._taxonomies: Dict[str, Taxonomy] = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".json"):
+                    with open(os.path.join(directory, name), "r") as f:
+                        stored = json.load(f)
+                    self._add(Taxonomy(name[:-len(".json")], stored["titles"], stored["descriptions"]))
+
+    def _add(self, taxonomy: Taxonomy):
+        with self._lock:
+            self._taxonomies[taxonomy.taxonomy_id] = taxonomy
+
+    def register(self, themes: Sequence[ClassificationClass]) -> Taxonomy:
+        if not themes:
+            raise ValueError("A taxonomy needs at least one theme")
+        titles = [theme.title for theme in themes]
+        descriptions = [theme.description for theme in themes]
+        taxonomy = Taxonomy(taxonomy_key(titles, descriptions)[:16], titles, descriptions)
+        self._add(taxonomy)
+        if self.directory:
+            with open(os.path.join(self.directory, f"{taxonomy.taxonomy_id}.json"), "w") as f:
+                json.dump({"titles": titles, "descriptions": descriptions}, f)
+        return taxonomy
+
+    def get(self, taxonomy_id: str) -> Optional[Taxonomy]:
+        return self._taxonomies.get(taxonomy_id)
+
+    def delete(self, taxonomy_id: str) -> bool:
+        with self._lock:
+            if self._taxonomies.pop(taxonomy_id, None) is None:
+                return False
+        if self.directory:
+            path = os.path.join(self.directory, f"{taxonomy_id}.json")
+            if os.path.exists(path):
+                os.remove(path)
+        return True
+
+    def describe(self, taxonomy: Taxonomy) -> Dict[str, Any]:
+        return {"taxonomy_id": taxonomy.taxonomy_id, "themes": len(taxonomy)}
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [self.describe(taxonomy) for taxonomy in list(self._taxonomies.values())]
+
+    def stats(self) -> Dict[str, int]:
+        return {"taxonomies": len(self._taxonomies)}
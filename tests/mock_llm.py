@@ -0,0 +1,220 @@
+"""
+Serveur LLM factice compatible OpenAI (/chat/completions), pour les benchmarks de bout en bout.
+
+Les réponses sont déterministes (graine fixe) : gabarits choisis selon le prompt, latence tirée
+d'une loi log-normale, cadence des tokens en streaming et taux d'erreurs injectées configurables.
+
+    uv run python -m tests.mock_llm --port 8100 --latency 0.2 --error-rate 0.05
+"""
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# (motif cherché dans le prompt, gabarit ou fonction prompt -> réponse)
+Responder = Tuple[str, Any]
+
+
+def _categorize_response(prompt: str) -> str:
+    '''Choisit la première catégorie dont le titre apparaît dans le message, sinon la première.'''
+    message = prompt.split("into one of the following categories", 1)[0].lower()
+    titles = [line.split(":", 1)[1].split("//", 1)[0].strip() for line in prompt.splitlines() if line.strip().startswith("Category ")]
+    category = next((index for index, title in enumerate(titles, start=1) if title.lower() in message), 1)
+    return json.dumps({"rationale": "Réponse du serveur factice", "category": category})
+
+
+def example_from_schema(schema: Dict[str, Any]) -> Any:
+    '''Exemple déterministe conforme à un JSON schema (premier enum, chaînes de démonstration).'''
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: example_from_schema(field_schema) for name, field_schema in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [example_from_schema(schema.get("items", {})) for _ in range(max(schema.get("minItems", 1), 1))]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    if schema.get("format") == "email":
+        return "jean.dupont@example.com"
+    return "exemple"
+
+
+def fill_form_responder(schema: Dict[str, Any]) -> Responder:
+    '''Répond à FillForm avec un formulaire exemple conforme à `schema`.'''
+    return ("You are given a conversation with a customer", json.dumps(example_from_schema(schema)))
+
+
+DEFAULT_RESPONDERS: List[Responder] = [
+    ("Categorize the following user message", _categorize_response),
+]
+
+
+@dataclass
+class MockLLMConfig:
+    latency_median: float = 0.05  # secondes avant la première réponse
+    latency_sigma: float = 0.3  # dispersion de la loi log-normale (0 : latence constante)
+    token_delay: float = 0.002  # secondes entre deux morceaux en streaming
+    chunk_size: int = 8  # caractères par morceau
+    error_rate: float = 0.0
+    error_status: int = 503
+    seed: int = 0
+    responders: List[Responder] = field(default_factory=lambda: list(DEFAULT_RESPONDERS))
+    default_response: str = "{}"
+
+
+class MockLLM:
+    '''Logique du serveur factice, indépendante du transport HTTP.'''
+    def __init__(self, config: MockLLMConfig):
+        self.config = config
+        self._random = random.Random(config.seed)
+        self.requests = 0
+        self.errors = 0
+
+    def latency(self) -> float:
+        if self.config.latency_sigma <= 0:
+            return self.config.latency_median
+        return self.config.latency_median * math.exp(self._random.gauss(0, self.config.latency_sigma))
+
+    def should_fail(self) -> bool:
+        return self._random.random() < self.config.error_rate
+
+    def respond(self, prompt: str) -> str:
+        for pattern, template in self.config.responders:
+            if pattern in prompt:
+                return template(prompt) if callable(template) else template
+        return self.config.default_response
+
+
+def _prompt_text(body: Dict[str, Any]) -> str:
+    parts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            parts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+        elif content:
+            parts.append(content)
+    return "\n".join(parts)
+
+
+def create_mock_llm_app(config: Optional[MockLLMConfig] = None) -> FastAPI:
+    mock = MockLLM(config or MockLLMConfig())
+    app = FastAPI()
+    app.state.mock = mock
+
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        mock.requests += 1
+        await asyncio.sleep(mock.latency())
+        if mock.should_fail():
+            mock.errors += 1
+            return JSONResponse({"error": {"message": "injected error"}}, status_code=mock.config.error_status)
+
+        prompt = _prompt_text(body)
+        content = mock.respond(prompt)
+        model = body.get("model", "mock")
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (len(prompt) + len(content)) // 4,
+        }
+
+        if not body.get("stream"):
+            choices = [
+                {"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                for i in range(body.get("n", 1))
+            ]
+            return {"id": "mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": choices, "usage": usage}
+
+        async def events():
+            size = mock.config.chunk_size
+            for start in range(0, len(content), size):
+                chunk = {"id": "mock", "object": "chat.completion.chunk", "model": model,
+                         "choices": [{"index": 0, "delta": {"content": content[start:start + size]}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(mock.config.token_delay)
+            last = {"id": "mock", "object": "chat.completion.chunk", "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            yield f"data: {json.dumps(last)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class MockLLMServer:
+    '''Lance le serveur factice dans un thread, le temps d'un bloc `with`.'''
+    def __init__(self, config: Optional[MockLLMConfig] = None, port: Optional[int] = None):
+        self.app = create_mock_llm_app(config)
+        self.port = port or _free_port()
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def mock(self) -> MockLLM:
+        return self.app.state.mock
+
+    def __enter__(self) -> "MockLLMServer":
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("The mock LLM server did not start")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Serveur LLM factice compatible OpenAI.")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.05, help="latence médiane (s)")
+    parser.add_argument("--sigma", type=float, default=0.3, help="dispersion log-normale de la latence")
+    parser.add_argument("--token-delay", type=float, default=0.002)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--response", action="append", default=[], metavar="MOTIF=FICHIER",
+                        help="réponse (contenu du fichier) renvoyée quand le prompt contient MOTIF")
+    args = parser.parse_args(argv)
+
+    with open("app/data/completion_format.json", "r") as f:
+        responders = [*DEFAULT_RESPONDERS, fill_form_responder(json.load(f))]
+    for item in args.response:
+        pattern, path = item.split("=", 1)
+        with open(path, "r") as f:
+            responders.insert(0, (pattern, f.read()))
+    config = MockLLMConfig(
+        latency_median=args.latency, latency_sigma=args.sigma, token_delay=args.token_delay,
+        error_rate=args.error_rate, responders=responders,
+    )
+    uvicorn.run(create_mock_llm_app(config), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
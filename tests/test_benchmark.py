@@ -0,0 +1,173 @@
+"""
+Benchmark de bout en bout : les quatre endpoints passent par le vrai client BAML (rendu du
+prompt, construction du schéma, parsing, streaming) face au serveur LLM factice de
+tests/mock_llm.py.
+
+Les p50/p95, le débit et la mémoire sont comparés à tests/benchmarks/baseline.json quand
+BENCHMARK_GATE=1 : ces mesures dépendent de la machine, la comparaison n'est donc pas faite
+par défaut. BENCHMARK_UPDATE_BASELINE=1 réécrit la référence, BENCHMARK_TOLERANCE (0.5 par
+défaut) fixe la dégradation relative tolérée.
+"""
+import asyncio
+import json
+import os
+import resource
+import statistics
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+
+import app.main
+from app.main import COMPLETION_FORM, app as api
+from app.services.client_pool import ClientPool
+from app.services.router import Router
+from baml_client.async_client import b
+from tests.mock_llm import DEFAULT_RESPONDERS, MockLLMConfig, MockLLMServer, fill_form_responder
+
+BASELINE_PATH = Path(__file__).parent / "benchmarks" / "baseline.json"
+TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", "0.5"))
+# Marge absolue (s) pour que le bruit sur des latences de quelques millisecondes ne fasse pas échouer.
+LATENCY_SLACK = 0.05
+
+THEMES = [
+    {"title": "Assurance", "description": "Questions relatives aux assurances"},
+    {"title": "Finance", "description": "Questions financières"},
+    {"title": "Sinistre", "description": "Déclaration de sinistre"},
+]
+
+# endpoint -> (chemin, paramètres, corps de la i-ème requête) ; les textes varient pour éviter la coalescence.
+SCENARIOS = {
+    "categorize": ("/categorize/", {}, lambda i: {"text": f"Question #{i} sur mon contrat Assurance", "themes": THEMES}),
+    "categorize-score": ("/categorize-score/", {"n": 5}, lambda i: {"text": f"Question #{i} sur mon épargne", "themes": THEMES}),
+    "extract": ("/extract/", {}, lambda i: {"text": f"Conversation #{i} : je m'appelle Jean Dupont"}),
+    "stream-extract": ("/stream-extract/", {}, lambda i: {"text": f"Conversation #{i} : je m'appelle Jean Dupont"}),
+}
+REQUESTS_PER_ENDPOINT = 40
+CONCURRENCY = 8
+
+
+@pytest.fixture
+def mock_backend(request):
+    """Démarre le serveur factice et y route les appels de l'API."""
+    config = getattr(request, "param", None) or MockLLMConfig()
+    config.responders = [*DEFAULT_RESPONDERS, fill_form_responder(COMPLETION_FORM)]
+    with MockLLMServer(config) as server:
+        backends = [{"name": "mock", "base_url": server.base_url, "model": "mock", "api_key": "mock"}]
+        previous_router = app.main.ROUTER
+        app.main.ROUTER = Router(["mock"])
+        api.state.client_pool = ClientPool(b, backends=backends)
+        try:
+            yield server
+        finally:
+            app.main.ROUTER = previous_router
+            api.state.client_pool = None
+
+
+def summarize(latencies, elapsed):
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50": quantiles[49],
+        "p95": quantiles[94],
+        "p99": quantiles[98],
+        "throughput": len(latencies) / elapsed,
+    }
+
+
+async def run_scenario(client, path, params, body, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(path, params=params, json=body(i))
+            assert response.status_code == 200, response.text
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def compare_to_baseline(results, baseline, tolerance=TOLERANCE):
+    """Renvoie la liste des régressions au-delà de la tolérance."""
+    regressions = []
+    for endpoint, metrics in results["endpoints"].items():
+        reference = baseline["endpoints"].get(endpoint)
+        if reference is None:
+            continue
+        # Sur quelques dizaines de requêtes, le p99 est proche du maximum : il est affiché, pas contrôlé.
+        for key in ("p50", "p95"):
+            if metrics[key] > reference[key] * (1 + tolerance) + LATENCY_SLACK:
+                regressions.append(f"{endpoint} {key}: {metrics[key]:.3f}s > {reference[key]:.3f}s")
+        if metrics["throughput"] < reference["throughput"] / (1 + tolerance):
+            regressions.append(f"{endpoint} throughput: {metrics['throughput']:.1f}/s < {reference['throughput']:.1f}/s")
+    if results["max_rss_mb"] > baseline["max_rss_mb"] * (1 + tolerance):
+        regressions.append(f"max RSS: {results['max_rss_mb']:.0f} MB > {baseline['max_rss_mb']:.0f} MB")
+    return regressions
+
+
+@pytest.mark.slow
+class TestBenchmark:
+    """Benchmark de bout en bout contre le serveur LLM factice."""
+
+    @pytest.mark.asyncio
+    @pytest.mark.skipif(
+        not (os.getenv("BENCHMARK_GATE") or os.getenv("BENCHMARK_UPDATE_BASELINE")),
+        reason="comparaison des temps à la référence : BENCHMARK_GATE=1 pour l'activer",
+    )
+    async def test_endpoints_against_baseline(self, mock_backend):
+        """Les percentiles, le débit et la mémoire ne régressent pas par rapport à la référence."""
+        transport = httpx.ASGITransport(app=api)
+        results = {"endpoints": {}}
+        async with httpx.AsyncClient(transport=transport, base_url="http://api", timeout=60) as client:
+            for endpoint, (path, params, body) in SCENARIOS.items():
+                results["endpoints"][endpoint] = await run_scenario(
+                    client, path, params, body, REQUESTS_PER_ENDPOINT, CONCURRENCY
+                )
+        results["max_rss_mb"] = max_rss_mb()
+
+        print("\n" + json.dumps(results, indent=2))
+        if os.getenv("BENCHMARK_UPDATE_BASELINE") or not BASELINE_PATH.exists():
+            BASELINE_PATH.parent.mkdir(exist_ok=True)
+            BASELINE_PATH.write_text(json.dumps(results, indent=2) + "\n")
+            return
+
+        baseline = json.loads(BASELINE_PATH.read_text())
+        assert compare_to_baseline(results, baseline) == []
+
+    @pytest.mark.asyncio
+    async def test_parsed_results(self, mock_backend):
+        """Les réponses du serveur factice sont bien parsées par BAML."""
+        transport = httpx.ASGITransport(app=api)
+        async with httpx.AsyncClient(transport=transport, base_url="http://api", timeout=60) as client:
+            categorized = await client.post("/categorize/", json=SCENARIOS["categorize"][2](0))
+            extracted = await client.post("/extract/", json=SCENARIOS["extract"][2](0))
+
+        assert categorized.json()["chosen_theme"]["title"] == "Assurance"
+        assert extracted.json()["personal_info"]["gender"] == "Male"
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("mock_backend", [MockLLMConfig(error_rate=0.3, seed=1)], indirect=True)
+    async def test_injected_errors_are_retried(self, mock_backend):
+        """Les erreurs injectées sont absorbées par les relances du routeur."""
+        transport = httpx.ASGITransport(app=api)
+        async with httpx.AsyncClient(transport=transport, base_url="http://api", timeout=60) as client:
+            for i in range(10):
+                response = await client.post("/categorize/", json=SCENARIOS["categorize"][2](i))
+                assert response.status_code == 200
+
+        assert mock_backend.mock.errors > 0
+
+    def test_regression_is_detected(self):
+        """Une dégradation au-delà de la tolérance est signalée."""
+        baseline = {"endpoints": {"extract": {"p50": 0.1, "p95": 0.2, "p99": 0.3, "throughput": 100}}, "max_rss_mb": 100}
+        results = {"endpoints": {"extract": {"p50": 0.1, "p95": 0.5, "p99": 0.3, "throughput": 100}}, "max_rss_mb": 100}
+
+        assert compare_to_baseline(results, baseline, tolerance=0.5) == ["extract p95: 0.500s > 0.200s"]
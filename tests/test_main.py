@@ -4,7 +4,10 @@ import json
 from fastapi.testclient import TestClient
 from httpx import AsyncClient
 
-from app.main import app
+from app.main import app, raw_call_admission
+from app.services.job_queue import JobQueue, JobStore
+from app.services.result_cache import MemoryCacheBackend, ResultCache
+from app.services.router import NoBackendAvailable, Router
 from app.schemas import ClassificationInput, ClassificationClass, ExtractionInput
 
 
@@ -63,8 +66,7 @@ class TestMainEndpoints:
 
     @patch('app.main.categorize_query')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
-    def test_categorize_endpoint(self, mock_registry, mock_collector, mock_categorize, client, sample_classification_input):
+    def test_categorize_endpoint(self, mock_collector, mock_categorize, client, sample_classification_input):
         """Test de l'endpoint /categorize/."""
         # Mock des retours
         mock_categorize.return_value = {"category": "Assurance", "confidence": 0.85}
@@ -79,8 +81,7 @@ class TestMainEndpoints:
 
     @patch('app.main.categorize_with_confidence')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
-    def test_categorize_score_endpoint(self, mock_registry, mock_collector, mock_categorize_conf, client, sample_classification_input):
+    def test_categorize_score_endpoint(self, mock_collector, mock_categorize_conf, client, sample_classification_input):
         """Test de l'endpoint /categorize-score/."""
         # Mock des retours
         mock_categorize_conf.return_value = {"category": "Assurance", "confidence": 0.92}
@@ -93,12 +94,58 @@ class TestMainEndpoints:
         assert "confidence" in data
         mock_categorize_conf.assert_called_once()
 
+    @pytest.mark.parametrize("format, media_type", [("ndjson", "application/x-ndjson"), ("sse", "text/event-stream")])
+    @patch('app.main.stream_categorize_with_confidence')
+    def test_stream_categorize_score_endpoint(self, mock_stream, client, sample_classification_input, format, media_type):
+        """Test de l'endpoint /stream-categorize-score/ en NDJSON et en SSE."""
+        async def messages(*args, **kwargs):
+            yield {"samples": 1, "votes": [1, 0], "leader": {"title": "Assurance"}, "confidence": 1.0}
+            yield {"chosen_theme": {"title": "Assurance"}, "confidence": 1.0, "final": True}
+        mock_stream.side_effect = messages
+
+        response = client.post("/stream-categorize-score/", params={"n": 2, "format": format}, json=sample_classification_input)
+
+        lines = [line.removeprefix("data: ") for line in response.text.splitlines() if line]
+        assert response.headers["content-type"].startswith(media_type)
+        assert [json.loads(line).get("final") for line in lines] == [None, True]
+        assert mock_stream.call_args.args[2] == 2
+
+    @pytest.mark.parametrize("params", [{"n": 0}, {"adaptive": "true", "wave_size": 0}])
+    def test_categorize_score_rejects_invalid_sampling(self, client, sample_classification_input, params):
+        """Test du rejet de n ou wave_size nuls par /categorize-score/."""
+        response = client.post("/categorize-score/", params=params, json=sample_classification_input)
+
+        assert response.status_code == 422
+
+    @patch('app.main.categorize_query')
+    def test_no_backend_available(self, mock_categorize, client, sample_classification_input):
+        """Test de la réponse 503 quand tous les disjoncteurs sont ouverts."""
+        mock_categorize.side_effect = NoBackendAvailable("Every backend circuit breaker is open")
+
+        response = client.post("/categorize/", json=sample_classification_input)
+
+        assert response.status_code == 503
+        assert response.json() == {"detail": "Every backend circuit breaker is open"}
+
+    @pytest.mark.asyncio
+    async def test_raw_call_is_routed(self):
+        """Test du choix du fournisseur par le routeur pour la requête brute de /categorize-score/."""
+        router = Router(["a", "b"], failure_threshold=1)
+        router.record("a", 0.1, ok=False)
+        pool = Mock(get_backends=Mock(return_value={"a": Mock(name="a"), "b": Mock(name="b")}))
+
+        with patch('app.main.ROUTER', router), patch.object(app.state, "client_pool", pool, create=True):
+            async with raw_call_admission("sampling", 2)() as handle:
+                pass
+
+        assert handle is pool.get_backends.return_value["b"]
+        assert router.snapshot()["b"]["calls"] == 1
+
     @patch('app.main.fill_form')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
     @patch('builtins.open', create=True)
     @patch('app.main.json.load')
-    def test_extract_endpoint(self, mock_json_load, mock_open, mock_registry, mock_collector, 
+    def test_extract_endpoint(self, mock_json_load, mock_open, mock_collector, 
                              mock_fill_form, client, sample_extraction_input, mock_completion_form):
         """Test de l'endpoint /extract/."""
         # Mock des retours
@@ -119,10 +166,9 @@ class TestMainEndpoints:
 
     @patch('app.main.stream_fill_form')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
     @patch('builtins.open', create=True)
     @patch('app.main.json.load')
-    def test_stream_extract_endpoint(self, mock_json_load, mock_open, mock_registry, mock_collector,
+    def test_stream_extract_endpoint(self, mock_json_load, mock_open, mock_collector,
                                    mock_stream_fill, client, sample_extraction_input, mock_completion_form):
         """Test de l'endpoint /stream-extract/."""
         # Mock des retours
@@ -135,6 +181,159 @@ class TestMainEndpoints:
         assert response.headers["content-type"] == "text/event-stream; charset=utf-8"
         mock_stream_fill.assert_called_once()
 
+    @patch('app.main.stream_fill_form_delta')
+    @patch('app.main.stream_fill_form')
+    @patch('app.main.Collector')
+    def test_stream_extract_delta_mode(self, mock_collector, mock_stream_fill,
+                                       mock_stream_delta, client, sample_extraction_input):
+        """Test de l'endpoint /stream-extract/ en mode delta."""
+        mock_stream_delta.return_value = iter([b'{"seq": 0, "patch": []}\n'])
+
+        response = client.post("/stream-extract/?mode=delta", json=sample_extraction_input)
+
+        assert response.status_code == 200
+        mock_stream_delta.assert_called_once()
+        mock_stream_fill.assert_not_called()
+
+    @patch('app.main.categorize_query')
+    @patch('app.main.Collector')
+    def test_categorize_result_cache(self, mock_collector, mock_categorize, client, sample_classification_input):
+        """Test du cache de résultats sur /categorize/."""
+        mock_categorize.return_value = {"category": "Assurance", "confidence": 0.85}
+        cache = ResultCache(MemoryCacheBackend(), ttls={"categorize": 60})
+
+        with patch('app.main.RESULT_CACHE', cache):
+            first = client.post("/categorize/", json=sample_classification_input)
+            second = client.post("/categorize/", json=sample_classification_input)
+            bypassed = client.post("/categorize/", json=sample_classification_input, headers={"Cache-Control": "no-store"})
+
+        assert first.headers["X-Cache"] == "MISS"
+        assert second.headers["X-Cache"] == "HIT"
+        assert bypassed.headers["X-Cache"] == "BYPASS"
+        assert second.json() == first.json()
+        assert mock_categorize.call_count == 2
+
+    @patch('app.main.categorize_batch')
+    @patch('app.main.Collector')
+    def test_categorize_batch_endpoint(self, mock_collector, mock_batch, client, sample_classification_input):
+        """Test de l'endpoint /categorize/batch."""
+        mock_batch.return_value = [{"index": 0, "chosen_theme": {"title": "Assurance"}}]
+        data = {"texts": [sample_classification_input["text"]], "themes": sample_classification_input["themes"]}
+
+        response = client.post("/categorize/batch?batch_size=5", json=data)
+
+        assert response.status_code == 200
+        assert response.json()["results"][0]["index"] == 0
+        assert mock_batch.call_args.kwargs["batch_size"] == 5
+
+    @patch('app.main.EXTRACT_SESSIONS')
+    def test_extraction_session_endpoints(self, mock_sessions, client, sample_extraction_input):
+        """Test des endpoints de sessions d'extraction incrémentale."""
+        mock_sessions.update = AsyncMock(return_value={"data": {"first_name": "Jean"}, "offset": 12, "prefix_hash": "x"})
+        mock_sessions.get = AsyncMock(return_value=None)
+
+        updated = client.post("/extract/sessions/call-1", json=sample_extraction_input)
+        missing = client.get("/extract/sessions/call-2")
+
+        assert updated.status_code == 200
+        assert updated.json() == {"session_id": "call-1", "offset": 12, "data": {"first_name": "Jean"}}
+        assert mock_sessions.update.call_args.args[:2] == ("call-1", sample_extraction_input["text"])
+        assert missing.status_code == 404
+
+    @patch('app.main.fill_form')
+    @patch('app.main.Collector')
+    def test_schema_registry_endpoints(self, mock_collector, mock_fill_form, client, sample_extraction_input):
+        """Test de l'enregistrement d'un schéma puis de l'extraction par identifiant."""
+        mock_fill_form.return_value = {"plate": "AB-123-CD"}
+        schema = {"title": "Vehicle", "type": "object", "properties": {"plate": {"type": "string"}}}
+
+        registered = client.post("/schemas/", json=schema)
+        schema_id = registered.json()["schema_id"]
+        extracted = client.post(f"/extract/{schema_id}", json=sample_extraction_input)
+        unknown = client.post("/extract/unknown", json=sample_extraction_input)
+        invalid = client.post("/schemas/", json={"type": "object"})
+
+        assert registered.status_code == 200
+        assert extracted.json() == {"plate": "AB-123-CD"}
+        assert mock_fill_form.call_args.args[1] == schema
+        assert unknown.status_code == 404
+        assert invalid.status_code == 400
+        assert client.delete(f"/schemas/{schema_id}").status_code == 200
+
+    @patch('app.main.categorize_with_taxonomy')
+    @patch('app.main.Collector')
+    def test_taxonomy_endpoints(self, mock_collector, mock_categorize, client, sample_classification_input):
+        """Test de l'enregistrement d'une taxonomie puis de la classification par identifiant."""
+        mock_categorize.return_value = {"chosen_theme": {"title": "Assurance"}}
+
+        registered = client.post("/taxonomies/", json={"themes": sample_classification_input["themes"]})
+        taxonomy_id = registered.json()["taxonomy_id"]
+        categorized = client.post(f"/categorize/{taxonomy_id}", json={"text": sample_classification_input["text"]})
+        unknown = client.post("/categorize/unknown", json={"text": "Bonjour"})
+
+        assert registered.json()["themes"] == len(sample_classification_input["themes"])
+        assert categorized.json() == {"chosen_theme": {"title": "Assurance"}}
+        assert mock_categorize.call_args.args[1].taxonomy_id == taxonomy_id
+        assert unknown.status_code == 404
+
+    @patch('app.main.categorize_hierarchical')
+    @patch('app.main.Collector')
+    def test_categorize_hierarchical_endpoint(self, mock_collector, mock_categorize, client):
+        """Test de la classification hiérarchique, avec et sans mode confiance."""
+        mock_categorize.return_value = {"chosen_theme": {"title": "Auto"}, "path": []}
+        data = {
+            "text": "Ma voiture a été rayée",
+            "themes": [{"title": "Assurance", "description": "Assurances", "children": [
+                {"title": "Auto", "description": "Assurance automobile"},
+            ]}],
+        }
+
+        response = client.post("/categorize-hierarchical/", json=data)
+        scored = client.post("/categorize-hierarchical/", params={"n": 3}, json=data)
+
+        assert response.json() == {"chosen_theme": {"title": "Auto"}, "path": []}
+        assert mock_categorize.call_args_list[0].args[0].themes[0].children[0].title == "Auto"
+        assert scored.status_code == 200
+        assert mock_categorize.call_args.kwargs["n"] == 3
+
+    def test_job_endpoints(self, client, tmp_path, sample_classification_input):
+        """Test de la soumission d'un traitement de masse puis du suivi de son avancement."""
+        app.state.job_queue = JobQueue(JobStore(str(tmp_path / "jobs.sqlite3")), lambda kind: None)
+        try:
+            jsonl = '{"text": "Mon contrat"}\n{"text": "Mon épargne"}\n{"texte": "?"}\n'
+            submitted = client.post("/jobs/", json={
+                "kind": "categorize", "jsonl": jsonl, "themes": sample_classification_input["themes"],
+            })
+            job_id = submitted.json()["job_id"]
+            polled = client.get(f"/jobs/{job_id}/results")
+            dead_letters = client.get(f"/jobs/{job_id}/dead-letters")
+            from_path = client.post("/jobs/", json={"kind": "extract", "path": "/etc/passwd"})
+            without_themes = client.post("/jobs/", json={"kind": "categorize", "jsonl": jsonl})
+            line_themes = client.post("/jobs/", json={"kind": "categorize", "jsonl": json.dumps({
+                "text": "Mon contrat", "themes": sample_classification_input["themes"],
+            })})
+            unknown = client.get("/jobs/unknown")
+        finally:
+            app.state.job_queue = None
+
+        assert submitted.json()["state"] == "running"
+        assert submitted.json()["pending"] == 2
+        assert [result["line"] for result in polled.json()["results"]] == [3]
+        assert dead_letters.json()["dead_letters"][0]["item"] is None
+        assert from_path.status_code == 400
+        assert without_themes.status_code == 400
+        assert line_themes.json()["pending"] == 1
+        assert unknown.status_code == 404
+
+    def test_metrics_endpoint(self, client):
+        """Test de l'endpoint /metrics au format Prometheus."""
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "# TYPE baml_input_tokens_total counter" in response.text
+        assert "schema_cache_hits" in response.text
+
     def test_invalid_classification_input(self, client):
         """Test avec des données de classification invalides."""
         invalid_data = {
@@ -167,8 +366,7 @@ class TestMainEndpoints:
 
     @patch('app.main.categorize_query')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
-    def test_categorize_with_complex_themes(self, mock_registry, mock_collector, mock_categorize, client):
+    def test_categorize_with_complex_themes(self, mock_collector, mock_categorize, client):
         """Test avec des thèmes complexes."""
         mock_categorize.return_value = {"category": "Assurance Auto", "confidence": 0.78}
         
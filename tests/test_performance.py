@@ -4,6 +4,7 @@ import time
 from unittest.mock import patch, Mock, AsyncMock
 from fastapi.testclient import TestClient
 from app.main import app
+from app.services.client_pool import ClientPool
 
 
 class TestPerformance:
@@ -31,8 +32,7 @@ class TestPerformance:
 
     @patch('app.main.categorize_query')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
-    def test_categorize_response_time(self, mock_registry, mock_collector, mock_categorize, client, sample_data):
+    def test_categorize_response_time(self, mock_collector, mock_categorize, client, sample_data):
         """Test du temps de réponse de l'endpoint de catégorisation."""
         mock_categorize.return_value = {"category": "Test", "confidence": 0.9}
         
@@ -47,10 +47,9 @@ class TestPerformance:
 
     @patch('app.main.fill_form')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
     @patch('builtins.open', create=True)
     @patch('app.main.json.load')
-    def test_extract_response_time(self, mock_json_load, mock_open, mock_registry, 
+    def test_extract_response_time(self, mock_json_load, mock_open, 
                                   mock_collector, mock_fill_form, client, sample_data):
         """Test du temps de réponse de l'endpoint d'extraction."""
         mock_json_load.return_value = {"test": "format"}
@@ -67,8 +66,7 @@ class TestPerformance:
 
     @patch('app.main.categorize_query')
     @patch('app.main.Collector')
-    @patch('app.main.ClientRegistry')
-    def test_concurrent_requests(self, mock_registry, mock_collector, mock_categorize, client, sample_data):
+    def test_concurrent_requests(self, mock_collector, mock_categorize, client, sample_data):
         """Test de requêtes concurrentes."""
         mock_categorize.return_value = {"category": "Test", "confidence": 0.9}
         
@@ -107,8 +105,7 @@ class TestPerformance:
         }
         
         with patch('app.main.categorize_query') as mock_categorize, \
-             patch('app.main.Collector'), \
-             patch('app.main.ClientRegistry'):
+             patch('app.main.Collector'):
             
             mock_categorize.return_value = {"category": "Test", "confidence": 0.9}
             
@@ -135,8 +132,7 @@ class TestPerformance:
         }
         
         with patch('app.main.categorize_query') as mock_categorize, \
-             patch('app.main.Collector'), \
-             patch('app.main.ClientRegistry'):
+             patch('app.main.Collector'):
             
             mock_categorize.return_value = {"category": "Theme1", "confidence": 0.9}
             
@@ -160,8 +156,7 @@ class TestLoadTesting:
     def test_sequential_load(self, client):
         """Test de charge séquentielle."""
         with patch('app.main.categorize_query') as mock_categorize, \
-             patch('app.main.Collector'), \
-             patch('app.main.ClientRegistry'):
+             patch('app.main.Collector'):
             
             mock_categorize.return_value = {"category": "Test", "confidence": 0.9}
             
@@ -201,8 +196,7 @@ class TestLoadTesting:
         import os
         
         with patch('app.main.categorize_query') as mock_categorize, \
-             patch('app.main.Collector'), \
-             patch('app.main.ClientRegistry'):
+             patch('app.main.Collector'):
             
             mock_categorize.return_value = {"category": "Test", "confidence": 0.9}
             
@@ -227,3 +221,30 @@ class TestLoadTesting:
             # La consommation mémoire ne doit pas exploser
             assert memory_increase < 100  # Moins de 100MB d'augmentation
 
+
+class TestClientReuse:
+    """Comparaison du coût par requête de la création des clients BAML."""
+
+    def test_pooled_handles_overhead(self):
+        """Réutiliser les clients du pool coûte moins que les recréer à chaque requête."""
+        from baml_py import ClientRegistry, Collector
+        from baml_client.async_client import b
+
+        iterations = 500
+
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            collector = Collector(name="my-collector")
+            client_registry = ClientRegistry()
+            client_registry.set_primary("CustomGenericProviderTemp")
+            b.with_options(collector=collector, client_registry=client_registry)
+        per_request = (time.perf_counter() - start_time) / iterations
+
+        pool = ClientPool(b)
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            pool.get("sampling")
+        pooled = (time.perf_counter() - start_time) / iterations
+
+        print(f"per-request: {per_request * 1e6:.1f}us, pooled: {pooled * 1e6:.1f}us")
+        assert pooled < per_request
@@ -0,0 +1,191 @@
+"""
+Micro-benchmark de SchemaAdder sur des schémas générés de taille et de profondeur croissantes
+(objets imbriqués, tableaux, énumérations et `$ref` partagées).
+
+Pour chaque schéma : temps et allocations Python (tracemalloc) de la compilation en
+TypeBuilder et du rendu du prompt de FillForm, et taille du prompt rendu. Les résultats sont
+comparés à tests/benchmarks/schema_baseline.json quand BENCHMARK_GATE=1 : les temps dépendent
+de la machine, la comparaison n'est donc pas faite par défaut. BENCHMARK_UPDATE_BASELINE=1
+réécrit la référence. Les allocations faites côté Rust par le TypeBuilder échappent à tracemalloc.
+"""
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from itertools import count
+from pathlib import Path
+
+import pytest
+
+from app.services.generate_form import compile_schema
+from baml_client.sync_client import b
+
+BASELINE_PATH = Path(__file__).parent / "benchmarks" / "schema_baseline.json"
+# Les temps de quelques millisecondes varient jusqu'à 1,6x d'une exécution à l'autre sur une
+# machine partagée : on compare le meilleur temps, avec une tolérance large.
+TIME_TOLERANCE = float(os.getenv("BENCHMARK_TOLERANCE", "1.0"))
+# Marge absolue (s) sous laquelle les écarts de temps sont du bruit.
+TIME_SLACK = 0.002
+# Les allocations et le prompt sont déterministes : les tolérances sont serrées.
+PEAK_TOLERANCE = 0.25
+PROMPT_TOLERANCE = 0.05
+
+# (nombre de champs feuilles, profondeur d'imbrication)
+CORPUS = [(10, 1), (50, 2), (200, 3), (500, 4), (1000, 4)]
+REPEATS = 7
+BRANCHING = 3
+
+ADDRESS = {
+    "title": "Address",
+    "type": "object",
+    "properties": {
+        "street": {"type": "string", "description": "Street and number"},
+        "city": {"type": "string", "description": "City"},
+        "zip": {"type": "string", "description": "Postal code"},
+    },
+}
+
+
+def generate_schema(n_fields, depth):
+    """Schéma d'environ `n_fields` champs feuilles répartis sur `depth` niveaux d'objets."""
+    leaf_ids, section_ids = count(), count()
+    kinds = ["string", "integer", "number", "boolean", "enum", "array", "object_array", "ref"]
+
+    def leaf():
+        i = next(leaf_ids)
+        kind = kinds[i % len(kinds)]
+        name = f"{kind}_{i}"
+        if kind == "enum":
+            return name, {"type": "string", "enum": ["A", "B", "C"], "description": f"Choice {i}"}
+        if kind == "array":
+            return name, {"type": "array", "items": {"type": "string"}, "description": f"List {i}"}
+        if kind == "object_array":
+            item = {"type": "object", "title": f"Item_{i}", "properties": {
+                "label": {"type": "string"}, "amount": {"type": "number"},
+            }}
+            return name, {"type": "array", "items": item, "description": f"Items {i}"}
+        if kind == "ref":
+            return name, {"$ref": "#/definitions/Address"}
+        return name, {"type": kind, "description": f"Field {i} of type {kind}"}
+
+    def build(level, n):
+        if level == depth:
+            return {"type": "object", "properties": dict(leaf() for _ in range(n))}
+        share, rest = divmod(n, BRANCHING)
+        properties = {}
+        for child in range(BRANCHING):
+            properties[f"section_{next(section_ids)}"] = build(level + 1, share + (child < rest))
+        return {"type": "object", "properties": properties, "required": list(properties)}
+
+    schema = build(1, n_fields)
+    schema["title"] = "GeneratedForm"
+    schema["definitions"] = {"Address": ADDRESS}
+    return schema
+
+
+def timed(fn):
+    timings = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"median": statistics.median(timings), "min": min(timings), "peak_bytes": peak}
+
+
+def prompt_text(request):
+    messages = request.body.json()["messages"]
+    return "".join(
+        part["text"] if isinstance(part, dict) else part
+        for message in messages
+        for part in (message["content"] if isinstance(message["content"], list) else [message["content"]])
+    )
+
+
+def measure(n_fields, depth):
+    schema = generate_schema(n_fields, depth)
+    tb, compile_stats = timed(lambda: compile_schema(schema))
+    request, render_stats = timed(lambda: b.request.FillForm("Bonjour", {"tb": tb}))
+    return {
+        "schema_bytes": len(json.dumps(schema)),
+        "compile": compile_stats,
+        "render": render_stats,
+        "prompt_chars": len(prompt_text(request)),
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=TIME_TOLERANCE):
+    """Renvoie la liste des régressions au-delà de la tolérance."""
+    regressions = []
+    for name, metrics in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        for step in ("compile", "render"):
+            if metrics[step]["min"] > reference[step]["min"] * (1 + tolerance) + TIME_SLACK:
+                regressions.append(f"{name} {step} time: {metrics[step]['min']:.4f}s > {reference[step]['min']:.4f}s")
+            if metrics[step]["peak_bytes"] > reference[step]["peak_bytes"] * (1 + PEAK_TOLERANCE):
+                regressions.append(f"{name} {step} peak: {metrics[step]['peak_bytes']} B > {reference[step]['peak_bytes']} B")
+        if metrics["prompt_chars"] > reference["prompt_chars"] * (1 + PROMPT_TOLERANCE):
+            regressions.append(f"{name} prompt: {metrics['prompt_chars']} chars > {reference['prompt_chars']} chars")
+    return regressions
+
+
+@pytest.mark.slow
+class TestSchemaBenchmark:
+    """Micro-benchmark de la compilation des schémas et du rendu du prompt."""
+
+    def test_generated_schemas_compile(self):
+        """Les schémas générés sont acceptés par SchemaAdder et rendus dans le prompt."""
+        schema = generate_schema(20, 2)
+        request = b.request.FillForm("Bonjour", {"tb": compile_schema(schema)})
+
+        text = prompt_text(request)
+        assert "enum_4" in text
+        assert "street" in text
+
+    @pytest.mark.skipif(
+        not (os.getenv("BENCHMARK_GATE") or os.getenv("BENCHMARK_UPDATE_BASELINE")),
+        reason="comparaison des temps à la référence : BENCHMARK_GATE=1 pour l'activer",
+    )
+    def test_corpus_against_baseline(self):
+        """Les temps, allocations et tailles de prompt ne régressent pas par rapport à la référence."""
+        results = {f"{n_fields}x{depth}": measure(n_fields, depth) for n_fields, depth in CORPUS}
+
+        print("\n" + json.dumps(results, indent=2))
+        if os.getenv("BENCHMARK_UPDATE_BASELINE") or not BASELINE_PATH.exists():
+            BASELINE_PATH.parent.mkdir(exist_ok=True)
+            BASELINE_PATH.write_text(json.dumps(results, indent=2) + "\n")
+            return
+
+        baseline = json.loads(BASELINE_PATH.read_text())
+        assert compare_to_baseline(results, baseline) == []
+
+    @pytest.mark.skipif(not BASELINE_PATH.exists(), reason="pas de référence enregistrée")
+    def test_prompt_sizes_against_baseline(self):
+        """La taille des prompts, déterministe, ne régresse pas par rapport à la référence."""
+        baseline = json.loads(BASELINE_PATH.read_text())
+        regressions = []
+        for n_fields, depth in CORPUS:
+            name = f"{n_fields}x{depth}"
+            request = b.request.FillForm("Bonjour", {"tb": compile_schema(generate_schema(n_fields, depth))})
+            chars = len(prompt_text(request))
+            if name in baseline and chars > baseline[name]["prompt_chars"] * (1 + PROMPT_TOLERANCE):
+                regressions.append(f"{name} prompt: {chars} chars > {baseline[name]['prompt_chars']} chars")
+
+        assert regressions == []
+
+    def test_prompt_growth_is_detected(self):
+        """Un prompt plus long que la référence est signalé."""
+        step = {"median": 0.01, "min": 0.01, "peak_bytes": 1000}
+        baseline = {"10x1": {"compile": step, "render": step, "prompt_chars": 1000}}
+        results = {"10x1": {"compile": step, "render": step, "prompt_chars": 1200}}
+
+        assert compare_to_baseline(results, baseline) == ["10x1 prompt: 1200 chars > 1000 chars"]
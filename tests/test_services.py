@@ -1 +1,1568 @@
-## TO DO
\ No newline at end of file
+import asyncio
+import io
+import json
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, nullcontext
+import httpx
+import pytest
+from unittest.mock import Mock, AsyncMock
+from baml_py import Timing
+
+from app.services.generate_form import (
+    PartitionCache,
+    SchemaCache,
+    count_fields,
+    fill_form,
+    partition_schema,
+    schema_key,
+    stream_fill_form_delta,
+)
+from app.services.json_patch import diff, apply_patch
+from app.services.chunked_extraction import (
+    chunk_turns,
+    extract_chunked,
+    merge_forms,
+    split_turns,
+    stream_extract_chunked,
+)
+from app.services.categorize_query import (
+    categorize_batch,
+    categorize_query,
+    categorize_with_confidence,
+    categorize_with_taxonomy,
+    sample_feedbacks_single_request,
+    stream_categorize_with_confidence,
+    wilson_lower_bound,
+)
+from app.services.result_cache import (
+    MemoryCacheBackend,
+    ResultCache,
+    SQLiteCacheBackend,
+    cache_key,
+)
+from app.services.single_flight import SingleFlight
+from app.services.schema_registry import InvalidSchema, SchemaRegistry
+from app.services.taxonomy_registry import TaxonomyRegistry
+from app.services.batch_cli import Checkpoint, Progress, run_batch
+from app.services.job_queue import CLAIM_QUERY, JobQueue, JobStore
+from app.services.hierarchical import categorize_hierarchical
+from baml_client.sync_client import b as sync_b
+from app.services.extraction_sessions import ExtractionSessions, SessionStore
+from app.services.admission import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    AdmissionController,
+    ClientLimits,
+    PrioritySemaphore,
+    TokenBucket,
+)
+from app.services.hedging import HedgedBamlClient, HedgePolicy, hedged_call
+from app.services.local_classifier import LocalClassifier
+from app.services.router import CircuitBreaker, RoutedBamlClient, Router
+from app.services.metrics import build_baml_metrics, record_collector
+from app.services.shortlist import shortlist_recall, shortlist_themes, tokenize
+from app.schemas import BatchClassificationInput, ClassificationClass, ClassificationInput, HierarchicalClassificationInput
+
+
+class FakeStream:
+    """Flux BAML factice renvoyant des résultats partiels prédéfinis."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield Mock(model_dump=Mock(return_value=chunk))
+
+    async def get_final_response(self):
+        return Mock(model_dump=Mock(return_value=self.chunks[-1]))
+
+
+@pytest.fixture
+def classification_input():
+    """Fixture pour les données de classification."""
+    return ClassificationInput(
+        text="J'aimerais souscrire à une assurance vie",
+        themes=[
+            {"title": "Assurance", "description": "Questions relatives aux assurances"},
+            {"title": "Finance", "description": "Questions financières"},
+        ],
+    )
+
+
+def feedback_client(categories):
+    """Client BAML factice renvoyant les catégories données, dans l'ordre."""
+    baml_client = Mock()
+    baml_client.CategorizeFeedback = AsyncMock(
+        side_effect=[Mock(category=category, rationale=f"reason {category}") for category in categories]
+    )
+    return baml_client
+
+
+@pytest.fixture
+def simple_schema():
+    """Fixture pour un schéma de formulaire simple."""
+    return {
+        "title": "Simple Form",
+        "type": "object",
+        "properties": {
+            "first_name": {"type": "string", "description": "First name"},
+            "age": {"type": "integer"}
+        }
+    }
+
+
+class TestSchemaCache:
+    """Tests pour le cache de schémas compilés."""
+
+    def test_schema_key_ignores_key_order(self, simple_schema):
+        """La clé de cache ne dépend pas de l'ordre des clés."""
+        reordered = dict(reversed(list(simple_schema.items())))
+        assert schema_key(simple_schema) == schema_key(reordered)
+
+    def test_cache_hit_and_miss(self, simple_schema):
+        """Le second appel réutilise le TypeBuilder compilé."""
+        cache = SchemaCache(max_size=2)
+        first = cache.get(simple_schema)
+        second = cache.get(dict(simple_schema))
+
+        assert first is second
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_cache_eviction(self, simple_schema):
+        """L'entrée la moins récemment utilisée est évincée."""
+        cache = SchemaCache(max_size=1)
+        other = dict(simple_schema, title="Other Form")
+        first = cache.get(simple_schema)
+        cache.get(other)
+
+        assert cache.stats()["size"] == 1
+        assert cache.get(simple_schema) is not first
+
+    def test_invalid_max_size(self):
+        """Une taille maximale nulle est refusée."""
+        with pytest.raises(ValueError):
+            SchemaCache(max_size=0)
+
+    @pytest.mark.asyncio
+    async def test_fill_form_uses_cache(self, simple_schema):
+        """fill_form ne recompile pas le schéma entre deux requêtes."""
+        cache = SchemaCache()
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(return_value=Mock(data={"first_name": "Jean"}))
+
+        await fill_form("Jean", simple_schema, baml_client, schema_cache=cache)
+        res = await fill_form("Jean", simple_schema, baml_client, schema_cache=cache)
+
+        assert res == {"first_name": "Jean"}
+        assert cache.stats() == {"size": 1, "max_size": 32, "hits": 1, "misses": 1}
+        first_tb = baml_client.FillForm.call_args_list[0].args[1]["tb"]
+        second_tb = baml_client.FillForm.call_args_list[1].args[1]["tb"]
+        assert first_tb is second_tb
+
+
+class TestTaxonomyRegistry:
+    """Tests pour le registre de taxonomies."""
+
+    def test_register_is_idempotent(self, classification_input):
+        """Une même liste de thèmes garde le même identifiant, et l'ordre compte."""
+        registry = TaxonomyRegistry()
+
+        first = registry.register(classification_input.themes)
+        second = registry.register(list(classification_input.themes))
+        reordered = registry.register(classification_input.themes[::-1])
+
+        assert first.taxonomy_id == second.taxonomy_id != reordered.taxonomy_id
+        assert first.theme(2) == {"title": "Finance", "description": "Questions financières"}
+        with pytest.raises(ValueError):
+            first.theme(3)
+
+    @pytest.mark.asyncio
+    async def test_categorize_with_taxonomy(self, classification_input):
+        """Le bloc de catégories rendu à l'enregistrement est envoyé tel quel."""
+        taxonomy = TaxonomyRegistry().register(classification_input.themes)
+        baml_client = Mock()
+        baml_client.CategorizeWithCatalog = AsyncMock(return_value=Mock(category=2, rationale="argent"))
+
+        res = await categorize_with_taxonomy("Mon épargne", taxonomy, baml_client)
+
+        assert res["chosen_theme"]["title"] == "Finance"
+        assert baml_client.CategorizeWithCatalog.call_args.kwargs["catalog"] == (
+            "Category 1: Assurance // Questions relatives aux assurances\n"
+            "Category 2: Finance // Questions financières\n"
+            "The categories are numbered from 1 to 2."
+        )
+
+    def test_prompt_prefix_is_shared(self, classification_input):
+        """Deux messages d'une même taxonomie partagent tout le prompt jusqu'au message."""
+        taxonomy = TaxonomyRegistry().register(classification_input.themes)
+
+        def prompt(text):
+            messages = sync_b.request.CategorizeWithCatalog(catalog=taxonomy.catalog, user_message=text).body.json()["messages"]
+            return json.dumps(messages, ensure_ascii=False)
+
+        first, second = prompt("Mon contrat"), prompt("Mon épargne")
+        prefix = first[:next(i for i, (a, c) in enumerate(zip(first, second)) if a != c)]
+
+        assert "Category 2: Finance" in prefix
+        assert "Answer in JSON" in prefix
+
+
+@pytest.fixture
+def theme_tree():
+    """Fixture pour une arborescence de thèmes à deux niveaux."""
+    return HierarchicalClassificationInput(
+        text="Ma voiture a été rayée sur le parking",
+        themes=[
+            {"title": "Assurance", "description": "Questions relatives aux assurances", "children": [
+                {"title": "Auto", "description": "Assurance automobile"},
+                {"title": "Habitation", "description": "Assurance habitation"},
+                {"title": "Vie", "description": "Assurance vie"},
+            ]},
+            {"title": "Finance", "description": "Questions financières", "children": [
+                {"title": "Épargne", "description": "Livrets et placements"},
+                {"title": "Crédit", "description": "Prêts et crédits"},
+            ]},
+        ],
+    )
+
+
+class TestHierarchicalClassification:
+    """Tests pour la classification hiérarchique, de la branche à la feuille."""
+
+    @pytest.mark.asyncio
+    async def test_descends_branch_then_leaf(self, theme_tree):
+        """Un prompt choisit la branche, un second la feuille parmi ses seuls enfants."""
+        baml_client = feedback_client([1, 1])
+
+        res = await categorize_hierarchical(theme_tree, baml_client)
+
+        assert res["chosen_theme"] == {"title": "Auto", "description": "Assurance automobile"}
+        assert [step["title"] for step in res["path"]] == ["Assurance", "Auto"]
+        first, second = baml_client.CategorizeFeedback.call_args_list
+        assert [c["title"] for c in first.kwargs["categories"]] == ["Assurance", "Finance"]
+        assert [c["title"] for c in second.kwargs["categories"]] == ["Auto", "Habitation", "Vie"]
+
+    @pytest.mark.asyncio
+    async def test_confidence_at_each_level(self, theme_tree):
+        """En mode confiance, chaque niveau est voté et les confiances se multiplient."""
+        baml_client = feedback_client([2, 2, 1, 2, 1, 2, 1, 1])
+
+        res = await categorize_hierarchical(theme_tree, baml_client, n=4)
+
+        assert res["chosen_theme"]["title"] == "Épargne"
+        assert [step["confidence"] for step in res["path"]] == [0.75, 0.75]
+        assert res["confidence"] == pytest.approx(0.5625)
+
+
+class TestSchemaRegistry:
+    """Tests pour le registre de schémas précompilés."""
+
+    def test_register_is_idempotent(self, simple_schema):
+        """Un même schéma enregistré deux fois garde le même identifiant."""
+        registry = SchemaRegistry()
+
+        first = registry.register(simple_schema)
+        second = registry.register(json.loads(json.dumps(simple_schema)))
+
+        assert first == second
+        assert registry.describe(first) == {"schema_id": first, "title": "Simple Form", "fields": 2}
+
+    @pytest.mark.parametrize("schema", [
+        {"type": "object", "properties": {"a": {"type": "string"}}},
+        {"title": "No properties", "type": "object"},
+        {"title": "Bad type", "type": "object", "properties": {"a": {"type": "date"}}},
+    ])
+    def test_invalid_schemas_are_rejected(self, schema):
+        """Les schémas invalides sont refusés à l'enregistrement."""
+        with pytest.raises(InvalidSchema):
+            SchemaRegistry().register(schema)
+
+    @pytest.mark.asyncio
+    async def test_fill_form_uses_precompiled_type_builder(self, simple_schema):
+        """fill_form utilise le TypeBuilder compilé à l'enregistrement, sans passer par le cache."""
+        fallback = SchemaCache()
+        registry = SchemaRegistry(fallback=fallback)
+        schema_id = registry.register(simple_schema)
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(return_value=Mock(data={"first_name": "Jean"}))
+
+        await fill_form("Jean", registry.schema(schema_id), baml_client, schema_cache=registry)
+
+        assert baml_client.FillForm.call_args.args[1]["tb"] is registry.get(simple_schema)
+        assert fallback.stats()["misses"] == 0
+
+    def test_schemas_persist_in_directory(self, tmp_path, simple_schema):
+        """Les schémas enregistrés sont rechargés au démarrage."""
+        schema_id = SchemaRegistry(str(tmp_path)).register(simple_schema)
+
+        reloaded = SchemaRegistry(str(tmp_path))
+        assert reloaded.schema(schema_id) == simple_schema
+        assert reloaded.delete(schema_id)
+        assert SchemaRegistry(str(tmp_path)).list() == []
+
+
+class TestPartitionedExtraction:
+    """Tests pour l'extraction en sous-formulaires parallèles."""
+
+    @pytest.fixture
+    def large_schema(self):
+        section = lambda n: {"type": "object", "properties": {f"f{i}": {"type": "string"} for i in range(n)}}
+        return {
+            "title": "Large Form",
+            "type": "object",
+            "properties": {"a": section(6), "b": section(2), "c": section(3), "d": section(1)},
+            "required": ["a", "c"],
+        }
+
+    def test_partition_balances_sections(self, large_schema):
+        """Les sections de premier niveau sont réparties en sous-schémas équilibrés."""
+        parts = partition_schema(large_schema, max_fields=6)
+
+        assert [list(part["properties"]) for part in parts] == [["a"], ["b", "c", "d"]]
+        assert [part["required"] for part in parts] == [["a"], ["c"]]
+        assert sum(count_fields(part) for part in parts) == count_fields(large_schema) == 12
+
+    def test_small_schema_is_not_partitioned(self, simple_schema):
+        """Un schéma sous le seuil n'est pas découpé."""
+        assert partition_schema(simple_schema, max_fields=10) == [simple_schema]
+
+    @pytest.mark.asyncio
+    async def test_parts_are_filled_concurrently_and_merged(self, large_schema):
+        """Les sous-formulaires sont remplis en parallèle puis fusionnés dans l'ordre du schéma."""
+        cache = PartitionCache()
+        (_, first), (_, second) = cache.get(large_schema, 6)
+        answers = {id(first): {"a": {"f0": "x"}}, id(second): {"d": {"f0": "y"}, "b": None}}
+        in_flight = max_in_flight = 0
+
+        async def fill(message, options):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return Mock(data=answers[id(options["tb"])])
+
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(side_effect=fill)
+
+        res = await fill_form("Jean", large_schema, baml_client, partition_size=6, partition_cache=cache)
+
+        assert max_in_flight == 2
+        assert res == {"a": {"f0": "x"}, "b": None, "d": {"f0": "y"}}
+        assert list(res) == ["a", "b", "d"]
+
+    @pytest.mark.asyncio
+    async def test_partition_is_cached(self, large_schema, simple_schema):
+        """Le découpage et ses TypeBuilders sont réutilisés, sans passer par le cache des schémas."""
+        schema_cache, partition_cache = SchemaCache(), PartitionCache()
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(return_value=Mock(data={}))
+
+        for _ in range(2):
+            await fill_form("Jean", large_schema, baml_client, schema_cache, partition_size=6, partition_cache=partition_cache)
+            await fill_form("Jean", simple_schema, baml_client, schema_cache, partition_size=6, partition_cache=partition_cache)
+
+        tbs = [call.args[1]["tb"] for call in baml_client.FillForm.call_args_list]
+        assert tbs[0] is tbs[3] and tbs[1] is tbs[4] and tbs[2] is tbs[5]
+        assert partition_cache.stats()["hits"] == 2
+        assert schema_cache.stats()["misses"] == 1
+
+
+class TestChunkedExtraction:
+    """Tests pour l'extraction map-reduce des longues conversations."""
+
+    TRANSCRIPT = "\n".join([
+        "Agent : Bonjour, à qui ai-je l'honneur ?",
+        "Client : Jean Dupont.",
+        "Agent : Votre email ?",
+        "Client : jean@example.com",
+        "et mon téléphone est le 0601020304",
+        "Agent : Merci.",
+    ])
+
+    def test_split_on_speaker_turns(self):
+        """Les tours de parole commencent à chaque locuteur, les lignes suivantes y sont rattachées."""
+        turns = split_turns(self.TRANSCRIPT)
+
+        assert len(turns) == 5
+        assert turns[3] == "Client : jean@example.com\net mon téléphone est le 0601020304"
+
+    def test_chunks_overlap_by_turns(self):
+        """Chaque morceau reprend le dernier tour du précédent."""
+        chunks = chunk_turns(["a" * 10, "b" * 10, "c" * 10, "d" * 10], max_chars=25, overlap=1)
+
+        assert chunks == ["a" * 10 + "\n" + "b" * 10, "b" * 10 + "\n" + "c" * 10, "c" * 10 + "\n" + "d" * 10]
+
+    def test_long_turn_gets_its_own_chunk(self):
+        """Un tour plus long que la limite n'est pas coupé et le découpage avance toujours."""
+        assert chunk_turns(["a" * 50, "b"], max_chars=10, overlap=3) == ["a" * 50, "b"]
+
+    def test_merge_rules(self):
+        """Le plus récent l'emporte, une valeur non nulle l'emporte, les listes sont unies."""
+        earlier = {"name": "Jean", "email": "old@example.com", "phone": "0601", "reasons": ["sinistre"]}
+        later = {"name": None, "email": "new@example.com", "phone": None, "reasons": ["sinistre", "contrat"]}
+
+        assert merge_forms(earlier, later) == {
+            "name": "Jean", "email": "new@example.com", "phone": "0601", "reasons": ["sinistre", "contrat"],
+        }
+
+    @pytest.mark.asyncio
+    async def test_merge_follows_chunk_order(self, simple_schema):
+        """La fusion suit l'ordre des morceaux, quel que soit l'ordre de fin des appels."""
+        async def fill(message, options):
+            # Le premier morceau répond en dernier.
+            await asyncio.sleep(0.02 if "Agent" in message.split("\n")[0] else 0)
+            return Mock(data={"first_name": message.split("\n")[-1][-4:]})
+
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(side_effect=fill)
+        text = "Agent : aaaa\nClient : bbbb\nClient : cccc"
+
+        res = await extract_chunked(text, simple_schema, baml_client, max_chars=28, overlap=0)
+
+        assert baml_client.FillForm.await_count == 2
+        assert res == {"first_name": "cccc"}
+
+    @pytest.mark.asyncio
+    async def test_stream_merged_forms(self, simple_schema):
+        """Le formulaire fusionné est envoyé à chaque morceau terminé."""
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(side_effect=[Mock(data={"first_name": "Jean", "age": None}), Mock(data={"age": 42})])
+
+        lines = [json.loads(line) async for line in stream_extract_chunked(
+            self.TRANSCRIPT, simple_schema, baml_client, max_chars=120, overlap=0, max_concurrency=1,
+        )]
+
+        assert len(lines) == 2
+        assert (lines[-1]["chunks_done"], lines[-1]["chunks_total"]) == (2, 2)
+        assert lines[-1]["data"] == {"first_name": "Jean", "age": 42}
+
+
+class TestExtractionSessions:
+    """Tests pour les sessions d'extraction incrémentale."""
+
+    @pytest.fixture
+    def sessions(self):
+        return ExtractionSessions(SessionStore(MemoryCacheBackend(), ttl=60), schema_cache=SchemaCache())
+
+    @pytest.fixture
+    def session_client(self):
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(return_value=Mock(data={"first_name": "Jean", "age": None}))
+        baml_client.UpdateForm = AsyncMock(return_value=Mock(data={"first_name": "Jean", "age": 42}))
+        return baml_client
+
+    @pytest.mark.asyncio
+    async def test_only_new_turns_are_sent(self, sessions, session_client, simple_schema):
+        """Après le premier appel, seuls les nouveaux tours et le formulaire courant sont envoyés."""
+        first = "Client : Je suis Jean.\n"
+        second = first + "Client : J'ai 42 ans.\n"
+
+        await sessions.update("call-1", first, simple_schema, session_client)
+        state = await sessions.update("call-1", second, simple_schema, session_client)
+
+        assert state["data"] == {"first_name": "Jean", "age": 42}
+        assert state["offset"] == len(second)
+        current_form, new_text = session_client.UpdateForm.call_args.args[:2]
+        assert json.loads(current_form) == {"first_name": "Jean", "age": None}
+        assert new_text == "Client : J'ai 42 ans.\n"
+        assert sessions.stats() == {"full_fills": 1, "incremental_fills": 1}
+
+    @pytest.mark.asyncio
+    async def test_unchanged_transcript_skips_the_model(self, sessions, session_client, simple_schema):
+        """Un transcript sans texte nouveau ne déclenche aucun appel."""
+        await sessions.update("call-1", "Client : Je suis Jean.", simple_schema, session_client)
+        await sessions.update("call-1", "Client : Je suis Jean.  ", simple_schema, session_client)
+
+        session_client.UpdateForm.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_edited_transcript_is_filled_again(self, sessions, session_client, simple_schema):
+        """Un transcript qui ne prolonge plus le texte traité est rempli de zéro."""
+        await sessions.update("call-1", "Client : Je suis Jean.", simple_schema, session_client)
+        await sessions.update("call-1", "Client : Je suis Paul, j'ai 30 ans.", simple_schema, session_client)
+
+        assert session_client.FillForm.await_count == 2
+        session_client.UpdateForm.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_sqlite_store(self, tmp_path, session_client, simple_schema):
+        """Les sessions survivent à un redémarrage avec le stockage SQLite."""
+        path = str(tmp_path / "sessions.sqlite3")
+        first = ExtractionSessions(SessionStore(SQLiteCacheBackend(path, table="extract_sessions")), SchemaCache())
+        await first.update("call-1", "Client : Je suis Jean.", simple_schema, session_client)
+
+        second = ExtractionSessions(SessionStore(SQLiteCacheBackend(path, table="extract_sessions")), SchemaCache())
+        assert (await second.get("call-1"))["data"] == {"first_name": "Jean", "age": None}
+        await second.delete("call-1")
+        assert await second.get("call-1") is None
+
+
+JOB_THEMES = {"themes": [
+    {"title": "Assurance", "description": "Questions relatives aux assurances"},
+    {"title": "Finance", "description": "Questions financières"},
+]}
+
+
+class TestJobQueue:
+    """Tests pour la file de traitements de masse persistée dans SQLite."""
+
+    def test_store_resumes_after_restart(self, tmp_path):
+        """Les lignes en cours à l'arrêt sont reprises ; les lignes invalides vont aux lettres mortes."""
+        path = str(tmp_path / "jobs.sqlite3")
+        store = JobStore(path, insert_batch_size=2)
+        job_id = store.create_job("categorize", JOB_THEMES, ['{"text": "a"}', "", "pas du json", '{"text": "b"}', '{"text": "c"}'])
+        assert store.claim()[:3] == (job_id, 1, {"text": "a"})
+        store.close()
+
+        reopened = JobStore(path)
+
+        assert reopened.counts(job_id) == {"pending": 3, "running": 0, "done": 0, "dead": 1}
+        assert reopened.dead_letters(job_id)[0]["line"] == 3
+        assert reopened.claim()[1] == 1
+
+    def test_claim_does_not_sort_the_backlog(self, tmp_path):
+        """Une réclamation lit la première ligne en attente par l'index, sans trier toute la file."""
+        store = JobStore(str(tmp_path / "jobs.sqlite3"))
+        store.create_job("categorize", JOB_THEMES, [f'{{"text": "{i}"}}' for i in range(10)])
+
+        plan = store._conn.execute(f"EXPLAIN QUERY PLAN {CLAIM_QUERY}", (0,)).fetchall()
+
+        assert "job_items_pending" in plan[0][-1]
+        assert not any("TEMP B-TREE" in row[-1] for row in plan)
+
+    def test_counts_are_kept_without_rescanning(self, tmp_path):
+        """Les compteurs par statut suivent les lignes sans relire tout le traitement."""
+        path = str(tmp_path / "jobs.sqlite3")
+        store = JobStore(path)
+        job_id = store.create_job("categorize", JOB_THEMES, ['{"text": "a"}', '{"text": "b"}', "?", '{"text": "c"}'])
+        first, second = store.claim(), store.claim()
+        store.complete(job_id, first[1], {"ok": True})
+        store.fail(job_id, second[1], "timeout", time.time())
+        third = store.claim()
+        store.release(job_id, third[1])
+        statements = []
+        store._conn.set_trace_callback(statements.append)
+
+        counts = store.counts(job_id)
+
+        assert counts == {"pending": 2, "running": 0, "done": 1, "dead": 1}
+        assert statements == []
+        store.close()
+        assert JobStore(path).counts(job_id) == counts
+
+    @pytest.mark.asyncio
+    async def test_workers_retry_failed_lines(self, tmp_path):
+        """Une ligne en erreur est relancée, puis le flux renvoie tous les résultats."""
+        baml_client = Mock()
+        baml_client.CategorizeFeedback = AsyncMock(side_effect=[
+            RuntimeError("timeout"), *[Mock(category=2, rationale="argent") for _ in range(3)]
+        ])
+        queue = JobQueue(
+            JobStore(str(tmp_path / "jobs.sqlite3")), lambda kind: nullcontext(baml_client),
+            concurrency=2, max_attempts=2, retry_delay=0, poll_interval=0.01,
+        )
+        job_id = await queue.submit("categorize", ['{"text": "a"}', '{"text": "b"}', '{"text": "c"}'], JOB_THEMES)
+
+        queue.start()
+        try:
+            results = [result async for result in queue.stream(job_id)]
+        finally:
+            await queue.stop()
+
+        assert sorted(result["line"] for result in results) == [1, 2, 3]
+        assert {result["result"]["chosen_theme"]["title"] for result in results} == {"Finance"}
+        assert (await queue.status(job_id))["done"] == 3
+        assert queue.stats()["retried"] == 1
+
+    @pytest.mark.asyncio
+    async def test_lines_need_themes_without_job_themes(self, tmp_path):
+        """Sans thèmes pour le traitement, une ligne sans thèmes part aux lettres mortes sans appel."""
+        queue = JobQueue(JobStore(str(tmp_path / "jobs.sqlite3")), lambda kind: None)
+        lines = [json.dumps({"text": "a", **JOB_THEMES}), '{"text": "b"}']
+
+        job_id = await queue.submit("categorize", io.StringIO("\n".join(lines)))
+
+        assert (await queue.status(job_id))["pending"] == 1
+        assert queue.store.dead_letters(job_id) == [
+            {"line": 2, "item": None, "attempts": 0, "error": 'Each line needs "themes" when the job has none'}
+        ]
+
+    @pytest.mark.asyncio
+    async def test_worker_survives_store_errors(self, tmp_path):
+        """Une erreur SQLite est journalisée et la ligne relancée, sans arrêter le worker."""
+        baml_client = Mock()
+        baml_client.CategorizeFeedback = AsyncMock(return_value=Mock(category=2, rationale="argent"))
+        store = JobStore(str(tmp_path / "jobs.sqlite3"))
+        queue = JobQueue(store, lambda kind: nullcontext(baml_client), concurrency=1, poll_interval=0.01)
+        job_id = await queue.submit("categorize", ['{"text": "a"}'], JOB_THEMES)
+        errors = [sqlite3.OperationalError("database is locked")]
+        complete = store.complete
+
+        def flaky_complete(*args):
+            if errors:
+                raise errors.pop()
+            return complete(*args)
+        store.complete = Mock(side_effect=flaky_complete)
+
+        queue.start()
+        try:
+            results = [result async for result in queue.stream(job_id)]
+        finally:
+            await queue.stop()
+
+        assert [result["line"] for result in results] == [1]
+        assert store.complete.call_count == 2
+        assert queue.stats()["processed"] == 1
+
+    @pytest.mark.asyncio
+    async def test_dead_letters(self, tmp_path, simple_schema):
+        """Une ligne qui échoue à chaque tentative part aux lettres mortes avec sa dernière erreur."""
+        baml_client = Mock()
+        baml_client.FillForm = AsyncMock(side_effect=RuntimeError("quota"))
+        queue = JobQueue(
+            JobStore(str(tmp_path / "jobs.sqlite3")), lambda kind: nullcontext(baml_client),
+            max_attempts=2, retry_delay=0, poll_interval=0.01,
+        )
+        job_id = await queue.submit("extract", ['{"text": "Je m\'appelle Jean"}'], {"schema": simple_schema})
+
+        queue.start()
+        try:
+            results = [result async for result in queue.stream(job_id)]
+        finally:
+            await queue.stop()
+
+        assert results[0]["status"] == "dead"
+        assert queue.store.dead_letters(job_id) == [
+            {"line": 1, "item": {"text": "Je m'appelle Jean"}, "attempts": 2, "error": "RuntimeError('quota')"}
+        ]
+        assert baml_client.FillForm.call_count == 2
+
+
+async def echo_after(item):
+    """Renvoie le texte après un délai inverse à sa position, pour terminer dans le désordre."""
+    await asyncio.sleep(item["delay"])
+    return item["text"]
+
+
+BATCH_LINES = [
+    '{"text": "a", "delay": 0.03}',
+    '',
+    '{"text": "b", "delay": 0.01}',
+    'pas du json',
+    '{"text": "c", "delay": 0.0}',
+]
+
+
+class TestBatchCli:
+    """Tests pour le traitement en flux de fichiers JSONL."""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("ordered, expected", [(True, [1, 3, 4, 5]), (False, [4, 5, 3, 1])])
+    async def test_output_order(self, tmp_path, ordered, expected):
+        """Les résultats suivent l'ordre du fichier, ou l'ordre d'achèvement."""
+        with open(tmp_path / "out.jsonl", "w+") as out:
+            await run_batch(BATCH_LINES, out, echo_after, concurrency=3, ordered=ordered)
+            out.seek(0)
+            results = [json.loads(line) for line in out]
+
+        assert [result["line"] for result in results] == expected
+        assert {result["line"]: result.get("result") for result in results}[5] == "c"
+        assert "error" in next(result for result in results if result["line"] == 4)
+
+    @pytest.mark.asyncio
+    async def test_resume_after_crash(self, tmp_path):
+        """Après un arrêt brutal, seules les lignes non écrites sont refaites, sans doublon."""
+        lines = [json.dumps({"text": str(i)}) for i in range(1, 7)]
+        path, checkpoint_path = tmp_path / "out.jsonl", str(tmp_path / "out.jsonl.checkpoint")
+
+        async def stuck_after_three(item):
+            if int(item["text"]) > 3:
+                await asyncio.sleep(3600)
+            return item["text"]
+
+        with open(path, "w") as out:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(run_batch(lines, out, stuck_after_three, concurrency=2, checkpoint=Checkpoint(checkpoint_path)), 0.1)
+            out.write('{"line": 4, "res')  # ligne à moitié écrite au moment de l'arrêt
+
+        checkpoint = Checkpoint(checkpoint_path)
+        assert checkpoint.load() and checkpoint.watermark == 3
+        handle = AsyncMock(side_effect=lambda item: item["text"])
+        report = io.StringIO()
+        with open(path, "r+") as out:
+            out.truncate(checkpoint.offset)
+            out.seek(checkpoint.offset)
+            await run_batch(lines, out, handle, concurrency=2, ordered=True, checkpoint=checkpoint, progress=Progress(report, interval=0))
+        with open(path) as out:
+            results = [json.loads(line) for line in out]
+
+        assert sorted(result["line"] for result in results) == [1, 2, 3, 4, 5, 6]
+        assert [result["line"] for result in results][3:] == [4, 5, 6]
+        assert handle.call_count == 3
+        assert report.getvalue().splitlines()[-1].startswith("3 lines, 0 errors")
+
+
+class TestDeltaStreaming:
+    """Tests pour le streaming par patchs JSON."""
+
+    def test_diff_round_trip(self):
+        """Appliquer le patch sur l'ancien document redonne le nouveau."""
+        old = {"data": {"name": "Je", "tags": ["a", "b"], "a/b": 1}}
+        new = {"data": {"name": "Jean", "tags": ["a"], "age": 30, "a/b": 2}}
+
+        patch = diff(old, new)
+
+        assert apply_patch(json.loads(json.dumps(old)), patch) == new
+        assert {"op": "replace", "path": "/data/name", "value": "Jean"} in patch
+        assert {"op": "replace", "path": "/data/a~1b", "value": 2} in patch
+
+    def test_diff_identical(self):
+        """Aucun patch n'est produit pour deux documents identiques."""
+        assert diff({"a": [1, {"b": None}]}, {"a": [1, {"b": None}]}) == []
+
+    @pytest.mark.asyncio
+    async def test_stream_fill_form_delta(self, simple_schema):
+        """Le flux émet des patchs numérotés puis un instantané final."""
+        chunks = [
+            {"data": None},
+            {"data": {"first_name": "Je"}},
+            {"data": {"first_name": "Je"}},
+            {"data": {"first_name": "Jean", "age": 30}},
+        ]
+        baml_client = Mock()
+        baml_client.stream.FillForm = Mock(return_value=FakeStream(chunks))
+
+        lines = [json.loads(line) async for line in stream_fill_form_delta("Jean", simple_schema, baml_client)]
+
+        assert [line["seq"] for line in lines] == [0, 1, 2, 3]
+        assert lines[-1] == {"seq": 3, "final": True, "snapshot": chunks[-1]}
+        document = None
+        for line in lines[:-1]:
+            document = apply_patch(document, line["patch"])
+        assert document == chunks[-1]
+
+
+class TestCategorizeWithConfidence:
+    """Tests pour la classification avec score de confiance."""
+
+    @pytest.mark.asyncio
+    async def test_full_voting(self, classification_input):
+        """Sans mode adaptatif, les n appels sont effectués."""
+        baml_client = feedback_client([1, 2, 1, 1])
+
+        res = await categorize_with_confidence(classification_input, baml_client, 4)
+
+        assert res["chosen_theme"]["title"] == "Assurance"
+        assert res["confidence"] == 0.75
+        assert baml_client.CategorizeFeedback.call_count == 4
+
+    @pytest.mark.asyncio
+    async def test_adaptive_stops_when_leader_cannot_lose(self, classification_input):
+        """Le vote s'arrête dès que la catégorie en tête ne peut plus perdre."""
+        baml_client = feedback_client([1] * 10)
+
+        res = await categorize_with_confidence(classification_input, baml_client, 10, adaptive=True, wave_size=3)
+
+        assert res["samples_used"] == 6
+        assert res["confidence"] == 1.0
+        assert baml_client.CategorizeFeedback.call_count == 6
+
+    @pytest.mark.asyncio
+    async def test_adaptive_stop_confidence(self, classification_input):
+        """Le seuil statistique permet un arrêt encore plus précoce."""
+        baml_client = feedback_client([1] * 10)
+
+        res = await categorize_with_confidence(
+            classification_input, baml_client, 10, adaptive=True, wave_size=2, stop_confidence=0.5
+        )
+
+        assert res["samples_used"] == 4
+        assert wilson_lower_bound(4, 4) >= 0.5 > wilson_lower_bound(2, 2)
+
+    @pytest.mark.asyncio
+    async def test_adaptive_split_votes_uses_all_samples(self, classification_input):
+        """Un vote partagé consomme tous les échantillons."""
+        baml_client = feedback_client([1, 2, 1, 2, 2])
+
+        res = await categorize_with_confidence(classification_input, baml_client, 5, adaptive=True, wave_size=2)
+
+        assert res["samples_used"] == 5
+        assert res["chosen_theme"]["title"] == "Finance"
+        assert res["confidence"] == 0.6
+
+
+class TestStreamCategorizeWithConfidence:
+    """Tests pour le vote diffusé au fil des échantillons."""
+
+    @pytest.mark.asyncio
+    async def test_running_distribution(self, classification_input):
+        """Chaque échantillon donne la distribution des votes et le thème en tête, puis un message final."""
+        baml_client = feedback_client([1, 2, 1])
+
+        messages = [m async for m in stream_categorize_with_confidence(classification_input, baml_client, 3)]
+
+        assert [m["votes"] for m in messages[:-1]] == [[1, 0], [1, 1], [2, 1]]
+        assert messages[-2]["leader"]["title"] == "Assurance"
+        assert messages[-1]["final"] is True
+        assert messages[-1]["confidence"] == pytest.approx(2 / 3)
+        assert messages[-1]["model_reasoning"] == "reason 1"
+
+    @pytest.mark.asyncio
+    async def test_adaptive_stops_early(self, classification_input):
+        """En mode adaptatif, le flux s'arrête dès que la catégorie en tête ne peut plus perdre."""
+        baml_client = feedback_client([1] * 5)
+
+        messages = [m async for m in stream_categorize_with_confidence(classification_input, baml_client, 5, adaptive=True)]
+
+        assert messages[-1]["samples_used"] == 3
+        assert len(messages) == 4
+
+    @pytest.mark.asyncio
+    async def test_consumer_stop_cancels_outstanding_calls(self, classification_input):
+        """Un client qui arrête de lire annule les appels encore en cours."""
+        cancelled = []
+
+        async def categorize(user_message, categories):
+            if not cancelled:
+                cancelled.append(False)
+                return Mock(category=1, rationale="rapide")
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        baml_client = Mock()
+        baml_client.CategorizeFeedback = categorize
+        stream = stream_categorize_with_confidence(classification_input, baml_client, 4)
+
+        first = await anext(stream)
+        await stream.aclose()
+        await asyncio.sleep(0)
+
+        assert first["leader"]["title"] == "Assurance"
+        assert cancelled == [False, True, True, True]
+
+
+class TestSingleRequestSampling:
+    """Tests pour l'échantillonnage en une seule requête (paramètre `n` du fournisseur)."""
+
+    @staticmethod
+    def provider_client(contents, captured):
+        """Client HTTP factice renvoyant un choix par contenu donné."""
+        def handler(request):
+            captured.append(json.loads(request.content))
+            return httpx.Response(200, json={"choices": [{"message": {"content": c}} for c in contents]})
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    @staticmethod
+    def baml_client(fallback_categories=()):
+        baml_client = feedback_client(fallback_categories)
+        baml_client.request.CategorizeFeedback = AsyncMock(return_value=Mock(
+            method="POST",
+            url="https://provider.test/v1/chat/completions",
+            headers={"authorization": "Bearer x", "baml-original-url": "https://provider.test/v1"},
+            body=Mock(json=Mock(return_value={"model": "m", "messages": []})),
+        ))
+        baml_client.parse.CategorizeFeedback = Mock(
+            side_effect=lambda content: Mock(**json.loads(content))
+        )
+        return baml_client
+
+    @pytest.mark.asyncio
+    async def test_single_request(self, classification_input):
+        """Les n choix proviennent d'un seul appel au fournisseur."""
+        captured = []
+        contents = [json.dumps({"category": c, "rationale": "r"}) for c in [1, 1, 2]]
+        baml_client = self.baml_client()
+
+        async with self.provider_client(contents, captured) as http_client:
+            res = await categorize_with_confidence(
+                classification_input, baml_client, 3, single_request=True, http_client=http_client
+            )
+
+        assert captured == [{"model": "m", "messages": [], "n": 3}]
+        assert res["chosen_theme"]["title"] == "Assurance"
+        assert res["confidence"] == 2 / 3
+        baml_client.CategorizeFeedback.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_fallback_when_provider_ignores_n(self, classification_input):
+        """Les échantillons manquants sont complétés par des appels séparés."""
+        captured = []
+        contents = [json.dumps({"category": 2, "rationale": "r"})]
+        baml_client = self.baml_client(fallback_categories=[2, 1])
+
+        async with self.provider_client(contents, captured) as http_client:
+            feedbacks = await sample_feedbacks_single_request(
+                classification_input, baml_client, 3, http_client=http_client
+            )
+
+        assert [f.category for f in feedbacks] == [2, 2, 1]
+        assert baml_client.CategorizeFeedback.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_fallback_when_provider_rejects_n(self, classification_input):
+        """Un fournisseur qui refuse `n` (4xx) bascule sur des appels séparés."""
+        baml_client = self.baml_client(fallback_categories=[1, 1])
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(400)))
+
+        async with http_client:
+            feedbacks = await sample_feedbacks_single_request(classification_input, baml_client, 2, http_client=http_client)
+
+        assert [f.category for f in feedbacks] == [1, 1]
+
+    @pytest.mark.asyncio
+    async def test_request_is_admitted(self, classification_input):
+        """La requête brute est envoyée dans le contexte d'admission fourni."""
+        events = []
+        contents = [json.dumps({"category": 1, "rationale": "r"})]
+
+        baml_client, backend = self.baml_client(), self.baml_client()
+
+        @asynccontextmanager
+        async def admit():
+            events.append("admitted")
+            yield backend
+            events.append("released")
+
+        async with self.provider_client(contents, events) as http_client:
+            await sample_feedbacks_single_request(classification_input, baml_client, 1, http_client=http_client, admit=admit)
+
+        assert events == ["admitted", {"model": "m", "messages": [], "n": 1}, "released"]
+        backend.request.CategorizeFeedback.assert_awaited_once()
+        baml_client.request.CategorizeFeedback.assert_not_called()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("handler", [
+        lambda request: (_ for _ in ()).throw(httpx.ConnectError("refused", request=request)),
+        lambda request: (_ for _ in ()).throw(httpx.ReadTimeout("timeout", request=request)),
+        lambda request: httpx.Response(200, text="<html>Bad gateway</html>"),
+    ])
+    async def test_fallback_on_network_errors(self, classification_input, handler):
+        """Une erreur réseau, un délai dépassé ou une réponse illisible basculent sur des appels séparés."""
+        baml_client = self.baml_client(fallback_categories=[2, 1])
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http_client:
+            feedbacks = await sample_feedbacks_single_request(classification_input, baml_client, 2, http_client=http_client)
+
+        assert [f.category for f in feedbacks] == [2, 1]
+
+
+class TestResultCache:
+    """Tests pour le cache de résultats."""
+
+    def test_cache_key_normalizes_text(self):
+        """Les espaces superflus ne changent pas la clé."""
+        assert cache_key("categorize", "  Bonjour   monde ", []) == cache_key("categorize", "Bonjour monde", [])
+        assert cache_key("categorize", "Bonjour", []) != cache_key("extract", "Bonjour", [])
+
+    def test_memory_backend_expiry(self):
+        """Une entrée expirée n'est plus renvoyée."""
+        backend = MemoryCacheBackend()
+        backend.set("key", "1", ttl=-1)
+        assert backend.get("key") is None
+
+    def test_sqlite_backend_survives_reopen(self, tmp_path):
+        """Le backend SQLite conserve les entrées après réouverture."""
+        path = str(tmp_path / "cache.sqlite3")
+        backend = SQLiteCacheBackend(path)
+        backend.set("key", '{"a": 1}', ttl=60)
+        backend.close()
+
+        assert SQLiteCacheBackend(path).get("key") == '{"a": 1}'
+
+    @pytest.mark.asyncio
+    async def test_get_or_compute(self):
+        """Le second appel est servi par le cache et les statistiques sont tenues."""
+        cache = ResultCache(MemoryCacheBackend(), ttls={"categorize": 60})
+        compute = AsyncMock(return_value={"chosen_theme": "Assurance"})
+
+        first = await cache.get_or_compute("categorize", "key", compute)
+        second = await cache.get_or_compute("categorize", "key", compute)
+
+        assert first == ({"chosen_theme": "Assurance"}, "MISS")
+        assert second == ({"chosen_theme": "Assurance"}, "HIT")
+        assert compute.call_count == 1
+        assert cache.stats()["categorize"]["hit_rate"] == 0.5
+
+    @pytest.mark.asyncio
+    async def test_backend_runs_off_the_event_loop(self, tmp_path):
+        """Les lectures et écritures du backend SQLite ne bloquent pas la boucle d'événements."""
+        backend = SQLiteCacheBackend(str(tmp_path / "cache.sqlite3"))
+        threads = []
+        for name in ("get", "set"):
+            method = getattr(backend, name)
+            setattr(backend, name, lambda *args, method=method: threads.append(threading.get_ident()) or method(*args))
+        cache = ResultCache(backend, ttls={"categorize": 60})
+
+        await cache.get_or_compute("categorize", "key", AsyncMock(return_value={"chosen_theme": "Assurance"}))
+        res, status = await cache.get_or_compute("categorize", "key", AsyncMock())
+
+        assert (res, status) == ({"chosen_theme": "Assurance"}, "HIT")
+        assert len(threads) == 3 and threading.get_ident() not in threads
+
+    @pytest.mark.asyncio
+    async def test_cache_control_bypass(self):
+        """Les en-têtes no-cache et no-store contournent le cache."""
+        cache = ResultCache(MemoryCacheBackend(), ttls={"categorize": 60})
+        compute = AsyncMock(return_value={"chosen_theme": "Assurance"})
+
+        await cache.get_or_compute("categorize", "key", compute)
+        _, refreshed = await cache.get_or_compute("categorize", "key", compute, cache_control="no-cache")
+        _, bypassed = await cache.get_or_compute("categorize", "key", compute, cache_control="no-store")
+
+        assert (refreshed, bypassed) == ("MISS", "BYPASS")
+        assert compute.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_endpoint_without_ttl_is_not_cached(self):
+        """Un endpoint sans TTL n'est jamais mis en cache."""
+        cache = ResultCache(MemoryCacheBackend(), ttls={"categorize": 60})
+        compute = AsyncMock(return_value={"confidence": 0.5})
+
+        await cache.get_or_compute("categorize-score", "key", compute)
+        _, status = await cache.get_or_compute("categorize-score", "key", compute)
+
+        assert status == "BYPASS"
+        assert compute.call_count == 2
+
+
+class TestSingleFlight:
+    """Tests pour la fusion des requêtes identiques en cours."""
+
+    @pytest.mark.asyncio
+    async def test_identical_calls_are_coalesced(self):
+        """Des appels identiques simultanés partagent un seul calcul."""
+        single_flight = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await release.wait()
+            return "done"
+
+        callers = [asyncio.ensure_future(single_flight.do("key", compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers)
+
+        assert results == ["done", "done", "done"]
+        assert len(calls) == 1
+        assert single_flight.stats() == {"in_flight": 0, "calls": 1, "coalesced": 2}
+
+    @pytest.mark.asyncio
+    async def test_cancelled_caller_does_not_cancel_shared_call(self):
+        """L'annulation d'un appelant n'interrompt pas l'appel partagé."""
+        single_flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def compute():
+            await release.wait()
+            return "done"
+
+        first = asyncio.ensure_future(single_flight.do("key", compute))
+        second = asyncio.ensure_future(single_flight.do("key", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await second == "done"
+        assert first.cancelled()
+
+    @pytest.mark.asyncio
+    async def test_call_cancelled_when_all_callers_leave(self):
+        """L'appel partagé est annulé quand plus personne ne l'attend."""
+        single_flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def compute():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.ensure_future(single_flight.do("key", compute))
+        await started.wait()
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+        await asyncio.sleep(0)
+        assert single_flight.stats()["in_flight"] == 0
+
+
+class TestCategorizeBatch:
+    """Tests pour la classification par lots."""
+
+    @staticmethod
+    def batch_input(n):
+        return BatchClassificationInput(
+            texts=[f"message {i}" for i in range(n)],
+            themes=[
+                {"title": "Assurance", "description": "Questions relatives aux assurances"},
+                {"title": "Finance", "description": "Questions financières"},
+            ],
+        )
+
+    @pytest.mark.asyncio
+    async def test_results_keep_order(self):
+        """Les résultats suivent l'ordre des messages, quel que soit l'ordre des réponses."""
+        async def batch_call(user_messages, categories):
+            return [
+                Mock(message_index=i + 1, category=1 if "0" in m or "2" in m else 2, rationale=m)
+                for i, m in reversed(list(enumerate(user_messages)))
+            ]
+        baml_client = Mock()
+        baml_client.CategorizeFeedbackBatch = AsyncMock(side_effect=batch_call)
+
+        res = await categorize_batch(self.batch_input(5), baml_client, batch_size=2)
+
+        assert baml_client.CategorizeFeedbackBatch.call_count == 3
+        assert [r["index"] for r in res] == [0, 1, 2, 3, 4]
+        assert [r["chosen_theme"]["title"] for r in res] == ["Assurance", "Finance", "Assurance", "Finance", "Finance"]
+        assert [r["model_reasoning"] for r in res] == [f"message {i}" for i in range(5)]
+
+    @pytest.mark.asyncio
+    async def test_failures_reported_per_item(self):
+        """Un lot en échec ou un message ignoré est signalé élément par élément."""
+        async def batch_call(user_messages, categories):
+            if "message 2" in user_messages:
+                raise RuntimeError("provider error")
+            return [Mock(message_index=1, category=7, rationale="r")]
+        baml_client = Mock()
+        baml_client.CategorizeFeedbackBatch = AsyncMock(side_effect=batch_call)
+
+        res = await categorize_batch(self.batch_input(3), baml_client, batch_size=2)
+
+        assert res[0] == {"index": 0, "error": "Unknown category 7"}
+        assert res[1] == {"index": 1, "error": "No answer returned for this message"}
+        assert res[2] == {"index": 2, "error": "provider error"}
+
+
+class TestShortlist:
+    """Tests pour la présélection lexicale des thèmes."""
+
+    @pytest.fixture
+    def themes(self):
+        return [
+            ClassificationClass(title=title, description=description)
+            for title, description in [
+                ("Assurance Auto", "Questions relatives à l'assurance automobile et aux véhicules"),
+                ("Assurance Habitation", "Questions relatives au logement"),
+                ("Sinistres", "Déclaration et gestion des sinistres"),
+                ("Épargne", "Placements et assurance vie"),
+            ]
+        ]
+
+    def test_tokenize_strips_accents(self):
+        """Les accents et la casse sont normalisés."""
+        assert tokenize("Épargne, Véhicules!") == ["epargne", "vehicule"]
+
+    def test_shortlist_keeps_best_themes_in_order(self, themes):
+        """Les k meilleurs thèmes sont renvoyés dans leur ordre d'origine."""
+        assert shortlist_themes("Mon véhicule a un sinistre", themes, 2) == [0, 2]
+        assert shortlist_themes("peu importe", themes, 10) == [0, 1, 2, 3]
+
+    @pytest.mark.asyncio
+    async def test_categorize_query_maps_back_to_original_theme(self, themes):
+        """L'indice renvoyé par le modèle est ramené au thème d'origine."""
+        data = ClassificationInput(text="Déclarer un sinistre sur mon véhicule", themes=themes)
+        baml_client = feedback_client([2])
+
+        res = await categorize_query(data, baml_client, shortlist_k=2)
+
+        sent = baml_client.CategorizeFeedback.call_args.kwargs["categories"]
+        assert [c["title"] for c in sent] == ["Assurance Auto", "Sinistres"]
+        assert res["chosen_theme"]["title"] == "Sinistres"
+
+    def test_shortlist_recall(self, themes):
+        """Le rappel de la présélection est mesuré pour chaque k."""
+        examples = [
+            {"text": "Mon véhicule est abîmé", "themes": [t.model_dump() for t in themes], "chosen_theme": "Assurance Auto"},
+            {"text": "Mon véhicule est abîmé", "themes": [t.model_dump() for t in themes], "chosen_theme": "Épargne"},
+        ]
+
+        assert shortlist_recall(examples, [1, 4]) == {1: 0.5, 4: 1.0}
+
+
+class TestLocalClassifier:
+    """Tests pour le classifieur local de premier niveau."""
+
+    @pytest.fixture
+    def model(self):
+        examples = [
+            ("problème de connexion internet", "Technical support"),
+            ("ma box internet ne marche plus", "Technical support"),
+            ("je veux un remboursement", "Refund"),
+            ("rembourser ma dernière facture", "Refund"),
+        ] * 5
+        return LocalClassifier.train(examples, n_features=2 ** 10, epochs=10)
+
+    @pytest.fixture
+    def themes(self):
+        return [
+            ClassificationClass(title="Technical support", description="Technical support"),
+            ClassificationClass(title="Refund", description="Refund"),
+        ]
+
+    def test_save_and_load(self, model, tmp_path):
+        """Le modèle rechargé donne les mêmes probabilités."""
+        path = str(tmp_path / "model.bin")
+        model.save(path)
+        loaded = LocalClassifier.load(path)
+
+        assert loaded.labels == model.labels
+        assert loaded.predict_proba("internet") == pytest.approx(model.predict_proba("internet"))
+
+    def test_classify_unknown_theme(self, model, themes):
+        """Un thème inconnu du modèle désactive le raccourci local."""
+        themes.append(ClassificationClass(title="Billing", description="Billing"))
+        assert model.classify("problème de connexion internet", themes, 0.5) is None
+
+    @pytest.mark.asyncio
+    async def test_categorize_query_local_fast_path(self, model, themes):
+        """Une prédiction sûre évite l'appel au LLM."""
+        data = ClassificationInput(text="ma connexion internet ne marche plus", themes=themes)
+        baml_client = feedback_client([2])
+
+        res = await categorize_query(data, baml_client, local_model=model, local_threshold=0.6)
+
+        assert res["source"] == "local"
+        assert res["chosen_theme"]["title"] == "Technical support"
+        baml_client.CategorizeFeedback.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_categorize_query_low_confidence_falls_back(self, model, themes):
+        """Une prédiction incertaine est confiée au LLM."""
+        data = ClassificationInput(text="bonjour", themes=themes)
+        baml_client = feedback_client([2])
+
+        res = await categorize_query(data, baml_client, local_model=model, local_threshold=0.99)
+
+        assert "source" not in res
+        assert res["chosen_theme"]["title"] == "Refund"
+
+
+class TestAdmission:
+    """Tests pour le contrôle d'admission des appels au fournisseur."""
+
+    @pytest.mark.asyncio
+    async def test_priority_order(self):
+        """Les appels interactifs passent avant les appels de fond en attente."""
+        semaphore = PrioritySemaphore(1)
+        order = []
+        await semaphore.acquire()
+
+        async def waiter(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+            semaphore.release()
+
+        tasks = [
+            asyncio.ensure_future(waiter("background", 2)),
+            asyncio.ensure_future(waiter("interactive", 0)),
+        ]
+        await asyncio.sleep(0)
+        assert semaphore.queue_depth == 2
+        semaphore.release()
+        await asyncio.gather(*tasks)
+
+        assert order == ["interactive", "background"]
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_is_skipped(self):
+        """Un appel annulé en file d'attente ne bloque pas le suivant."""
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        cancelled = asyncio.ensure_future(semaphore.acquire(0))
+        waiting = asyncio.ensure_future(semaphore.acquire(1))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        semaphore.release()
+
+        await asyncio.wait_for(waiting, timeout=1)
+
+    @pytest.mark.asyncio
+    async def test_token_bucket_waits(self):
+        """Le seau à jetons temporise au-delà de sa capacité."""
+        bucket = TokenBucket(rate=100, capacity=1)
+        start = asyncio.get_running_loop().time()
+        for _ in range(3):
+            await bucket.acquire()
+
+        assert asyncio.get_running_loop().time() - start >= 0.015
+
+    @pytest.mark.asyncio
+    async def test_wrapped_client_caps_concurrency(self):
+        """Le client encapsulé ne dépasse pas la concurrence autorisée."""
+        controller = AdmissionController({"client": ClientLimits(max_concurrency=2)})
+        running = []
+        peak = []
+
+        class Client:
+            async def CategorizeFeedback(self, **kwargs):
+                running.append(1)
+                peak.append(len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+                return "ok"
+
+        wrapped = controller.wrap(Client(), "client")
+        results = await asyncio.gather(*[wrapped.CategorizeFeedback(user_message="m") for _ in range(5)])
+
+        assert results == ["ok"] * 5
+        assert max(peak) == 2
+        assert controller.stats()["client"]["admitted"] == 5
+        assert controller.stats()["client"]["in_flight"] == 0
+
+    @pytest.mark.asyncio
+    async def test_clients_of_one_endpoint_share_priorities(self):
+        """Deux clients d'un même fournisseur partagent une file : l'interactif passe devant l'échantillonnage."""
+        controller = AdmissionController(
+            {"nebius": ClientLimits(max_concurrency=1)},
+            endpoints={"CustomGenericProvider": "nebius", "CustomGenericProviderTemp": "nebius"},
+        )
+        order = []
+
+        async def call(client_name, priority):
+            async with controller.admit(client_name, priority):
+                order.append(client_name)
+
+        async with controller.admit("CustomGenericProviderTemp", PRIORITY_BACKGROUND):
+            tasks = [
+                asyncio.ensure_future(call("CustomGenericProviderTemp", PRIORITY_BACKGROUND)),
+                asyncio.ensure_future(call("CustomGenericProvider", PRIORITY_INTERACTIVE)),
+            ]
+            await asyncio.sleep(0)
+            assert controller.stats()["CustomGenericProvider"]["queue_depth"] == 2
+        await asyncio.gather(*tasks)
+
+        assert order == ["CustomGenericProvider", "CustomGenericProviderTemp"]
+
+
+class TestMetrics:
+    """Tests pour les métriques extraites du Collector BAML."""
+
+    @staticmethod
+    def function_log(log_type="call", calls=1, first_token_ms=None):
+        return Mock(
+            function_name="CategorizeFeedback",
+            log_type=log_type,
+            usage=Mock(input_tokens=120, output_tokens=30),
+            timing=Mock(spec=Timing, duration_ms=800, time_to_first_parsed_ms=first_token_ms),
+            calls=[Mock()] * calls,
+        )
+
+    def test_record_collector(self):
+        """Les tokens, latences et relances sont agrégés par endpoint et fonction."""
+        metrics = build_baml_metrics()
+        collector = Mock(logs=[self.function_log(), self.function_log(calls=3)])
+
+        record_collector(metrics, collector, "categorize")
+        output = metrics.render()
+
+        labels = '{endpoint="categorize",function="CategorizeFeedback"}'
+        assert f"baml_calls_total{labels} 2" in output
+        assert f"baml_input_tokens_total{labels} 240" in output
+        assert f"baml_retries_total{labels} 2" in output
+        assert 'baml_provider_latency_seconds_bucket{endpoint="categorize",function="CategorizeFeedback",le="1.0"} 2' in output
+        assert 'baml_provider_latency_seconds_bucket{endpoint="categorize",function="CategorizeFeedback",le="0.5"} 0' in output
+        assert "# TYPE baml_provider_latency_seconds histogram" in output
+
+    def test_stream_time_to_first_token(self):
+        """Le délai avant le premier token est mesuré pour les appels en streaming."""
+        metrics = build_baml_metrics()
+        collector = Mock(logs=[self.function_log(log_type="stream", first_token_ms=200)])
+
+        record_collector(metrics, collector, "stream-extract")
+
+        assert 'baml_time_to_first_token_seconds_count{endpoint="stream-extract",function="CategorizeFeedback"} 1' in metrics.render()
+
+
+class TestHedging:
+    """Tests pour les requêtes dupliquées (hedging)."""
+
+    @pytest.mark.asyncio
+    async def test_fast_call_is_not_hedged(self):
+        """Un appel rapide n'est pas dupliqué."""
+        policy = HedgePolicy(budget=1.0, default_delay=0.5)
+        primary = AsyncMock(return_value="ok")
+
+        assert await hedged_call("CategorizeFeedback", primary, policy) == "ok"
+        assert policy.stats() == {"calls": 1, "hedges": 0, "hedge_wins": 0}
+
+    @pytest.mark.asyncio
+    async def test_slow_call_is_hedged_and_cancelled(self):
+        """Un appel lent est doublé ; le plus rapide l'emporte et l'autre est annulé."""
+        policy = HedgePolicy(budget=1.0, default_delay=0.01)
+        cancelled = asyncio.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        async def fast():
+            return "secondary"
+
+        assert await hedged_call("FillForm", slow, policy, secondary=fast) == "secondary"
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        assert policy.stats() == {"calls": 1, "hedges": 1, "hedge_wins": 1}
+
+    @pytest.mark.asyncio
+    async def test_primary_latency_is_recorded(self):
+        """La latence de l'appel principal est retenue, en cas d'échec comme de duplication gagnante."""
+        policy = HedgePolicy(budget=1.0, default_delay=0.02)
+
+        async def failing():
+            raise RuntimeError("timeout")
+
+        async def slow():
+            await asyncio.sleep(10)
+
+        async def fast():
+            return "secondary"
+
+        with pytest.raises(RuntimeError):
+            await hedged_call("FillForm", failing, policy)
+        await hedged_call("FillForm", slow, policy, secondary=fast)
+        await asyncio.sleep(0.01)  # le temps que l'annulation de l'appel principal aboutisse
+
+        latencies = sorted(policy.tracker("FillForm")._latencies)
+        assert len(latencies) == 2
+        assert latencies[1] >= 0.02
+
+    @pytest.mark.asyncio
+    async def test_budget_limits_hedges(self):
+        """Le budget borne la proportion d'appels supplémentaires."""
+        policy = HedgePolicy(budget=0.0, default_delay=0.01)
+
+        async def slow():
+            await asyncio.sleep(0.03)
+            return "primary"
+
+        assert await hedged_call("FillForm", slow, policy) == "primary"
+        assert policy.hedges == 0
+
+    @pytest.mark.asyncio
+    async def test_delay_follows_recent_latencies(self):
+        """Le délai de duplication suit le percentile des latences récentes."""
+        policy = HedgePolicy(percentile=0.9, min_samples=10, default_delay=5)
+        for latency in range(1, 11):
+            policy.tracker("FillForm").record(latency / 10)
+
+        assert policy.delay("FillForm") == 1.0
+        assert policy.delay("CategorizeFeedback") == 5
+
+    @pytest.mark.asyncio
+    async def test_hedged_client(self, classification_input):
+        """categorize_query fonctionne avec un client dupliqué."""
+        policy = HedgePolicy(budget=1.0)
+        baml_client = HedgedBamlClient(feedback_client([1]), policy)
+
+        res = await categorize_query(classification_input, baml_client)
+
+        assert res["chosen_theme"]["title"] == "Assurance"
+        assert policy.calls == 1
+
+
+class TestRouting:
+    """Tests pour le routage entre fournisseurs et le disjoncteur."""
+
+    def test_breaker_opens_then_half_opens(self):
+        """Le disjoncteur s'ouvre après N échecs puis laisse passer un seul essai."""
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.0)
+        breaker.record(ok=False)
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.record(ok=False)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.record(ok=True)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_open_breaker_rejects_calls(self):
+        """Un disjoncteur ouvert refuse les appels jusqu'au délai de réinitialisation."""
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record(ok=False)
+        assert not breaker.allow()
+
+    def test_router_prefers_fast_backend(self):
+        """Le routeur choisit le fournisseur le plus rapide parmi ceux disponibles."""
+        router = Router(["slow", "fast"], failure_threshold=1, reset_timeout=60)
+        router.record("slow", 2.0, ok=True)
+        router.record("fast", 0.5, ok=True)
+        assert router.choose() == "fast"
+
+        router.record("fast", 0.5, ok=False)
+        assert router.choose() == "slow"
+
+    def test_backend_without_success_comes_last(self):
+        """Un fournisseur qui n'a jamais réussi passe après les autres, même jamais appelés."""
+        router = Router(["failing", "healthy", "new"])
+        router.record("failing", 0.1, ok=False)
+        router.record("healthy", 1.0, ok=True)
+
+        assert sorted(router.backends, key=router._score) == ["new", "healthy", "failing"]
+
+    @pytest.mark.asyncio
+    async def test_stream_outcome_is_recorded(self):
+        """Un flux réussi ou en échec est comptabilisé pour le fournisseur choisi."""
+        class Stream:
+            def __init__(self, error=None):
+                self.error = error
+
+            async def __aiter__(self):
+                yield "chunk"
+                if self.error:
+                    raise self.error
+
+            async def get_final_response(self):
+                return "final"
+
+        ok, failing = Mock(), Mock()
+        ok.stream.FillForm = Mock(return_value=Stream())
+        failing.stream.FillForm = Mock(return_value=Stream(RuntimeError("reset")))
+        router = Router(["failing", "ok"], failure_threshold=1)
+        baml_client = RoutedBamlClient(router, {"failing": failing, "ok": ok})
+
+        with pytest.raises(RuntimeError):
+            [chunk async for chunk in baml_client.stream.FillForm("m")]
+        stream = baml_client.stream.FillForm("m")
+        chunks = [chunk async for chunk in stream]
+
+        snapshot = router.snapshot()
+        assert chunks == ["chunk"]
+        assert await stream.get_final_response() == "final"
+        assert snapshot["failing"]["errors"] == 1 and snapshot["failing"]["state"] == "open"
+        assert snapshot["ok"]["calls"] == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_call_is_retried_on_other_backend(self, classification_input, monkeypatch):
+        """Un appel en échec est rejoué sur un autre fournisseur."""
+        monkeypatch.setattr("app.services.router.backoff_delay", lambda attempt: 0)
+        failing = Mock()
+        failing.CategorizeFeedback = AsyncMock(side_effect=RuntimeError("503"))
+        router = Router(["failing", "healthy"])
+        baml_client = RoutedBamlClient(router, {"failing": failing, "healthy": feedback_client([1])})
+
+        res = await categorize_query(classification_input, baml_client)
+
+        assert res["chosen_theme"]["title"] == "Assurance"
+        snapshot = router.snapshot()
+        assert snapshot["failing"]["errors"] == 1
+        assert snapshot["healthy"]["calls"] == 1